@@ -79,6 +79,8 @@ partial_kinematic_vars = [
 
 kinematic_dist_vars = static_dist_vars + partial_kinematic_vars
 
+hypo_vars = ['nucleation_x', 'nucleation_y']
+
 interseismic_catalog = {
     'geodetic': interseismic_vars}
 
@@ -164,11 +166,16 @@ default_decimation_factors = {
 
 seismic_data_name = 'seismic_data.pkl'
 geodetic_data_name = 'geodetic_data.pkl'
+seismic_data_dir_name = 'seismic_data'
+geodetic_data_dir_name = 'geodetic_data'
 
 linear_gf_dir_name = 'linear_gfs'
 fault_geometry_name = 'fault_geometry.pkl'
-geodetic_linear_gf_name = 'linear_geodetic_gfs.pkl'
+model_cache_dir_name = 'model_cache'
+kite_cache_dir_name = 'kite_cache'
+geodetic_linear_gf_name = 'linear_geodetic_gfs.json'
 seismic_static_linear_gf_name = 'linear_seismic_gfs.pkl'
+seismic_kinematic_linear_gf_name = 'linear_seismic_kinematic_gfs.json'
 
 sample_p_outname = 'sample.params'
 
@@ -209,6 +216,10 @@ class GFConfig(Object):
         help='Depth limit [km] for varying the velocity model. Below that '
              'depth the velocity model is not varied based on the errors '
              'defined above!')
+    variation_seed = Int.T(
+        default=0,
+        help='Seed of the random number generator for the velocity model'
+             ' variations. The same seed gives the same variations.')
 
 
 class NonlinearGFConfig(GFConfig):
@@ -326,6 +337,37 @@ class LinearGFConfig(GFConfig):
         help='Extend reference sources by this factor in each'
              ' strike-direction. 0.1 means extension of the fault by 10% in'
              ' each direction, i.e. 20% in total.')
+    nworkers = Int.T(
+        default=1,
+        help='Number of processors to use for calculating the GFs')
+    chunksize = Int.T(
+        default=100,
+        help='Number of patches to calculate in one request. Finished chunks'
+             ' are kept, if the calculation is interrupted.')
+
+
+class SeismicLinearGFConfig(LinearGFConfig):
+    """
+    Config for the library of seismic Green's Function traces of the
+    fault patches for the kinematic forward model.
+    """
+    reference_location = ReferenceLocation.T(
+        default=None,
+        help="Reference location for the midpoint of the Green's Function "
+             "grid.",
+        optional=True)
+    earth_model_name = String.T(
+        default='ak135-f-average.m',
+        help='Name of the reference earthmodel, see '
+             'pyrocko.cake.builtin_models() for alternatives.')
+    sample_rate = Float.T(
+        default=2.,
+        help='Sample rate for the Greens Functions.')
+    stf_type = StringChoice.T(
+        default='boxcar',
+        choices=['boxcar', 'triangular'],
+        help='Source time function of the patches, which is convolved with'
+             ' the Green\'s Function traces.')
 
 
 class WaveformFitConfig(Object):
@@ -421,6 +463,12 @@ class GeodeticConfig(Object):
         default=False,
         help='Flag for inverting for additional plane parameters on each'
              ' SAR datatype')
+    lowrank_covariance = Bool.T(
+        default=False,
+        help='Flag for representing the velocity model prediction covariance'
+             ' as low-rank factor of the "n_variations" realisations.'
+             ' Avoids dense n x n weight matrixes for diagonal data'
+             ' covariances.')
     gf_config = GFConfig.T(default=GeodeticGFConfig.D())
 
     def get_hypernames(self):
@@ -459,6 +507,13 @@ class ProblemConfig(Object):
         help='Hyperparameters to weight different types of datatypes.')
     priors = Dict.T(
         help='Priors of the variables in question.')
+    marginalize_linear = Bool.T(
+        default=False,
+        help='Only for "static" mode: Flag for marginalising the linear slip'
+             ' components analytically instead of sampling them. The'
+             ' uniform slip priors are approximated by Gaussians of same mean'
+             ' and variance. Only the hyperparameters (and ramps) are'
+             ' sampled.')
 
     def init_vars(self, variables=None):
         """
@@ -474,7 +529,7 @@ class ProblemConfig(Object):
 
         self.priors = OrderedDict()
         for variable in variables:
-            if variable in block_vars:
+            if variable in block_vars or variable in hypo_vars:
                 nvars = 1
             else:
                 nvars = self.n_sources
@@ -665,6 +720,33 @@ class SMCConfig(SamplerParameters):
                      help='Remove existing stage results prior to sampling.')
 
 
+class NUTSConfig(SamplerParameters):
+    """
+    Config for optimization parameters of the No-U-Turn Sampler (NUTS).
+    Requires the gradients of the model, i.e. is available for geodetic
+    static problems.
+    """
+    n_samples = Int.T(default=2000,
+                      help='Number of samples to draw from each chain.')
+    tune = Int.T(default=500,
+                 help='Number of tuning steps for step size adaptation.'
+                      ' Tuning samples are discarded.')
+    target_accept = Float.T(
+        default=0.8,
+        help='Target acceptance rate for the step size adaptation.')
+    n_jobs = Int.T(
+        default=1,
+        help='Number of processors to use, i.e. chains to sample in parallel.')
+    update_covariances = Bool.T(
+        default=False,
+        optional=True,
+        help='Update model prediction covariance matrixes. Not supported'
+             ' for NUTS!')
+    rm_flag = Bool.T(default=False,
+                     help='Remove existing sampling results prior to'
+                          ' sampling.')
+
+
 class SamplerConfig(Object):
     """
     Config for the sampler specific parameters.
@@ -673,7 +755,7 @@ class SamplerConfig(Object):
     name = String.T(
         default='SMC',
         help='Sampler to use for sampling the solution space.'
-             ' Metropolis/ SMC')
+             ' Metropolis/ SMC/ NUTS')
     progressbar = Bool.T(
         default=True,
         help='Display progressbar(s) during sampling.')
@@ -694,6 +776,9 @@ class SamplerConfig(Object):
         if self.name == 'SMC':
             self.parameters = SMCConfig(**kwargs)
 
+        if self.name == 'NUTS':
+            self.parameters = NUTSConfig(**kwargs)
+
 
 class BEATconfig(Object, Cloneable):
     """
@@ -886,6 +971,45 @@ def init_config(name, date=None, min_magnitude=6.0, main_path='./',
             'Problem config has to be updated. After deciding on the patch'
             ' dimensions and extension factors please run: import')
 
+    elif mode == 'kinematic':
+
+        if source_type != 'RectangularSource':
+            raise TypeError('Kinematic distributed slip is so far only'
+                            ' supported for RectangularSource(s)')
+
+        gc = load_config(c.project_dir, 'geometry')
+
+        if gc is not None:
+            logger.info('Taking information from geometry_config ...')
+            n_sources = gc.problem_config.n_sources
+            point = {k: v.testvalue
+                     for k, v in gc.problem_config.priors.iteritems()}
+            source_points = utility.split_point(point)
+            reference_sources = [RectangularSource(
+                **source_points[i]) for i in range(n_sources)]
+
+            sgf = gc.seismic_config.gf_config
+            c.date = gc.date
+            c.event = gc.event
+            c.seismic_config = gc.seismic_config
+            c.seismic_config.gf_config = SeismicLinearGFConfig(
+                store_superdir=sgf.store_superdir,
+                n_variations=sgf.n_variations,
+                reference_location=sgf.reference_location,
+                earth_model_name=sgf.earth_model_name,
+                sample_rate=sgf.sample_rate,
+                reference_sources=reference_sources)
+        else:
+            logger.info('Found no geometry setup, init blank ...')
+            c.seismic_config = SeismicConfig(
+                gf_config=SeismicLinearGFConfig())
+            c.seismic_config.init_waveforms(waveforms)
+            c.date = 'dummy'
+
+        logger.info(
+            'Problem config has to be updated. After deciding on the patch'
+            ' dimensions and extension factors please run: build_gfs')
+
     c.problem_config = ProblemConfig(
         n_sources=n_sources, datatypes=datatypes, mode=mode,
         source_type=source_type)
@@ -6,7 +6,7 @@ from time import time
 import logging
 import copy
 
-from beat import heart
+from beat import heart, paripool
 
 
 logger = logging.getLogger('covariance')
@@ -15,10 +15,31 @@ logger = logging.getLogger('covariance')
 __all__ = [
     'geodetic_cov_velocity_models',
     'geodetic_cov_velocity_models_pscmp',
+    'geodetic_velocity_model_factors',
+    'parallel_seismic_velocity_model_factors',
     'seismic_cov_velocity_models',
+    'seismic_velocity_model_factors',
     'seismic_data_covariance']
 
 
+def covariance_factor(synths):
+    """
+    Low-rank factor U of the covariance of a set of model predictions, such
+    that U * U^T = num.cov(synths, rowvar=0).
+
+    Parameters
+    ----------
+    synths : :class:`numpy.ndarray`
+        n_variations x n_samples model predictions
+
+    Returns
+    -------
+    :class:`numpy.ndarray` n_samples x n_variations
+    """
+    n_var = synths.shape[0]
+    return (synths - synths.mean(axis=0)).T / num.sqrt(n_var - 1.)
+
+
 def sub_data_covariance(n, dt, tzero):
     '''
     Calculate sub-covariance matrix without variance.
@@ -222,7 +243,8 @@ def model_prediction_sensitivity(engine, *args, **kwargs):
 
 
 def seismic_cov_velocity_models(engine, sources, targets,
-                  arrival_taper, wavename, filterer, plot=False, n_jobs=1):
+                  arrival_taper, wavename, filterer, plot=False, n_jobs=1,
+                  lowrank=False):
     '''
     Calculate model prediction uncertainty matrix with respect to uncertainties
     in the velocity model for station and channel.
@@ -243,6 +265,9 @@ def seismic_cov_velocity_models(engine, sources, targets,
         open snuffler and browse traces if True
     n_jobs : int
         number of processors to be used for calculation
+    lowrank : boolean
+        if set, the low-rank factor U (n x n_variations) of the covariance
+        (Cov = U * U^T) is returned instead of the dense n x n matrix
 
     Returns
     -------
@@ -268,11 +293,159 @@ def seismic_cov_velocity_models(engine, sources, targets,
     t1 = time()
     logger.debug('Trace generation time %f' % (t1 - t0))
 
+    if lowrank:
+        return covariance_factor(synths)
+
     return num.cov(synths, rowvar=0)
 
 
+def seismic_velocity_model_factors(
+        engine, sources, targets, arrival_taper, wavename, filterer,
+        plot=False, n_jobs=1):
+    '''
+    Calculate the low-rank factors of the model prediction uncertainty
+    matrixes with respect to uncertainties in the velocity model for several
+    stations of one channel at once. The synthetics for all velocity model
+    variations and stations are calculated in one request.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+        contains synthetics generation machine
+    sources : list
+        of :class:`pyrocko.gf.seismosizer.Source`
+    targets : list
+        of lists of :class:`heart.DynamicTarget`, for each station the targets
+        of all velocity model variations, the first being the reference
+    arrival_taper : :class: `heart.ArrivalTaper`
+        determines tapering around phase Arrival
+    filterer : :class:`heart.Filter`
+        determines the bandpass-filtering corner frequencies
+    plot : boolean
+        open snuffler and browse traces if True
+    n_jobs : int
+        number of processors to be used for calculation
+
+    Returns
+    -------
+    list of :class:`numpy.ndarray` (n_samples x n_variations) low-rank factors
+    for each station
+    '''
+
+    all_targets = []
+    taperers = []
+    for station_targets in targets:
+        reference_taperer = heart.get_phase_taperer(
+            engine,
+            sources[0],
+            wavename=wavename,
+            target=station_targets[0],
+            arrival_taper=arrival_taper)
+
+        all_targets.extend(station_targets)
+        taperers.extend([reference_taperer] * len(station_targets))
+
+    t0 = time()
+    synths, _ = heart.seis_synthetics(
+        engine=engine, sources=sources, targets=all_targets,
+        arrival_taper=arrival_taper, wavename=wavename,
+        filterer=filterer, nprocs=n_jobs,
+        reference_taperer=taperers, plot=plot,
+        pre_stack_cut=True, outmode='array')
+    t1 = time()
+    logger.debug('Trace generation time %f' % (t1 - t0))
+
+    factors = []
+    i = 0
+    for station_targets in targets:
+        n_var = len(station_targets)
+        factors.append(covariance_factor(synths[i:i + n_var, :]))
+        i += n_var
+
+    return factors
+
+
+def _seismic_velocity_model_factors_worker(
+        store_superdirs, sources, targets, arrival_taper, wavename, filterer):
+    '''
+    Worker process: the engine is initialised once per work package, so that
+    the stores stay open for all its stations.
+    '''
+    engine = gf.LocalEngine(store_superdirs=store_superdirs)
+    factors = seismic_velocity_model_factors(
+        engine=engine, sources=sources, targets=targets,
+        arrival_taper=arrival_taper, wavename=wavename, filterer=filterer)
+    engine.close_cashed_stores()
+    return factors
+
+
+def parallel_seismic_velocity_model_factors(
+        engine, sources, targets, arrival_taper, wavename, filterer,
+        n_jobs=1):
+    '''
+    Calculate the low-rank factors of the model prediction uncertainty
+    matrixes with respect to uncertainties in the velocity model for several
+    stations in parallel. The stations are split into n_jobs packages that
+    are processed by :func:`seismic_velocity_model_factors`.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+        contains synthetics generation machine
+    sources : list
+        of :class:`pyrocko.gf.seismosizer.Source`
+    targets : list
+        of lists of :class:`heart.DynamicTarget`, for each station the targets
+        of all velocity model variations, the first being the reference
+    arrival_taper : :class: `heart.ArrivalTaper`
+        determines tapering around phase Arrival
+    filterer : :class:`heart.Filter`
+        determines the bandpass-filtering corner frequencies
+    n_jobs : int
+        number of processes to be used for calculation
+
+    Returns
+    -------
+    list of :class:`numpy.ndarray` (n_samples x n_variations) low-rank factors
+    for each station
+    '''
+    n_jobs = min(n_jobs, len(targets))
+
+    if n_jobs < 2:
+        return seismic_velocity_model_factors(
+            engine=engine, sources=sources, targets=targets,
+            arrival_taper=arrival_taper, wavename=wavename,
+            filterer=filterer)
+
+    packages = num.array_split(num.arange(len(targets)), n_jobs)
+
+    workpackage = [(
+        engine.store_superdirs, sources,
+        [targets[i] for i in package], arrival_taper, wavename, filterer)
+        for package in packages]
+
+    factors = []
+    for results in paripool.paripool(
+            _seismic_velocity_model_factors_worker, workpackage,
+            nprocs=n_jobs, chunksize=1, initmessage=False):
+        for result in results:
+            if result is None:
+                raise Exception(
+                    'Velocity model covariance worker timed out!')
+
+            factors.extend(result)
+
+    if len(factors) != len(targets):
+        raise Exception(
+            'Velocity model covariance calculation failed for some'
+            ' stations!')
+
+    return factors
+
+
 def geodetic_cov_velocity_models(
-        engine, sources, targets, dataset, plot=False, event=None, n_jobs=1):
+        engine, sources, targets, dataset, plot=False, event=None, n_jobs=1,
+        lowrank=False):
     """
     Calculate model prediction uncertainty matrix with respect to uncertainties
     in the velocity model for geodetic targets using fomosto GF stores.
@@ -288,6 +461,9 @@ def geodetic_cov_velocity_models(
         matrix
     plot : boolean
         if set, a plot is produced and not covariance matrix is returned
+    lowrank : boolean
+        if set, the low-rank factor U (n x n_variations) of the covariance
+        (Cov = U * U^T) is returned instead of the dense n x n matrix
 
     Returns
     -------
@@ -317,9 +493,64 @@ def geodetic_cov_velocity_models(
         plt.colorbar(im)
         plt.show()
 
+    if lowrank:
+        return covariance_factor(synths)
+
     return num.cov(synths, rowvar=0)
 
 
+def geodetic_velocity_model_factors(engine, sources, targets, datasets):
+    """
+    Calculate the low-rank factors of the model prediction uncertainty
+    matrixes with respect to uncertainties in the velocity model for several
+    geodetic datasets at once. The synthetics for all velocity model
+    variations and datasets are calculated in one request, with one target
+    for all datasets for each velocity model variation.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+        contains synthetics generation machine
+    sources : list
+        of :py:class:`pyrocko.gf.seismosizer.Source` determines the covariance
+        matrix
+    targets : list
+        of :class:`pyrocko.gf.targets.StaticTarget` for each velocity model
+        variation with the observation points of all datasets, as returned
+        by :func:`heart.merge_geodetic_targets`
+    datasets : list
+        of :class:`heart.GeodeticDataset`
+
+    Returns
+    -------
+    list of :class:`numpy.ndarray` (n_samples x n_variations) low-rank factors
+    for each dataset
+    """
+    t0 = time()
+    displacements = heart.geo_synthetics(
+        engine=engine,
+        targets=targets,
+        sources=sources,
+        outmode='stacked_arrays')
+    t1 = time()
+    logger.debug('Synthetics generation time %f' % (t1 - t0))
+
+    los_vectors = num.vstack([dataset.los_vector for dataset in datasets])
+    odws = num.hstack([dataset.odw for dataset in datasets])
+
+    # (n_variations x n_observations of all datasets)
+    synths = num.vstack([
+        (disp * los_vectors).sum(axis=1) for disp in displacements]) * odws
+
+    factors = []
+    i = 0
+    for dataset in datasets:
+        factors.append(covariance_factor(synths[:, i:i + dataset.samples]))
+        i += dataset.samples
+
+    return factors
+
+
 def geodetic_cov_velocity_models_pscmp(
     store_superdir, crust_inds, target, sources):
     """
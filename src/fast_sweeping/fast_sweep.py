@@ -2,7 +2,9 @@
 Fast_sweeping algorithm
 
 Determines rupture onset times of patches along planar rectangular fault with
-respect to an initial nucleation point.
+respect to an initial (continuous) nucleation point. Batches of slowness fields and
+fault geometries with several (coupled) sub-faults are supported by the
+C implementation.
 
 References
 ----------
@@ -20,13 +22,71 @@ from theano.ifelse import ifelse
 
 km = 1000.
 
+def get_nucleation_corners(n_patch_strike, n_patch_dip, nuc_x, nuc_y):
+    """
+    Patches and bilinear weights of the cells enclosing continuous
+    nucleation points.
+
+    The rupture onset times for a continuous nucleation point are the
+    bilinear interpolation of the onset times for nucleation at the patches
+    of the enclosing cell. Thus, they vary continuously with the nucleation
+    point and are identical to the integer case at the patch centers.
+
+    Parameters
+    ----------
+    n_patch_strike : int
+        Number of patches in strike direction of fault-plane
+    n_patch_dip : int
+        Number of patches in dip direction of fault-plane
+    nuc_x : float or :class:`numpy.NdArray`
+        (n_fields) nucleation points along strike in patch coordinates
+    nuc_y : float or :class:`numpy.NdArray`
+        (n_fields) nucleation points along dip in patch coordinates
+
+    Returns
+    -------
+    fields : :class:`numpy.NdArray`
+        (n_corners) of indexes to the nucleation points
+    idxs : :class:`numpy.NdArray`
+        (n_corners) of indexes to the flat patch arrays (as for
+        :func:`get_rupture_times_c`) of the cell corners
+    weights : :class:`numpy.NdArray`
+        (n_corners) of bilinear weights, only non-zero weights are returned
+    """
+    nuc_x = num.atleast_1d(num.clip(nuc_x, 0., n_patch_strike - 1))
+    nuc_y = num.atleast_1d(num.clip(nuc_y, 0., n_patch_dip - 1))
+    n_fields = max(nuc_x.size, nuc_y.size)
+    nuc_x = num.zeros(n_fields) + nuc_x
+    nuc_y = num.zeros(n_fields) + nuc_y
+
+    x0 = num.floor(nuc_x).astype(num.int64)
+    y0 = num.floor(nuc_y).astype(num.int64)
+    fx = nuc_x - x0
+    fy = nuc_y - y0
+
+    fields = []
+    idxs = []
+    weights = []
+    for dx in range(2):
+        for dy in range(2):
+            w = (fx if dx else 1. - fx) * (fy if dy else 1. - fy)
+            valid = w > 0.
+
+            fields.append(num.arange(n_fields)[valid])
+            idxs.append(
+                (x0[valid] + dx) * n_patch_dip + (y0[valid] + dy))
+            weights.append(w[valid])
+
+    return num.hstack(fields), num.hstack(idxs), num.hstack(weights)
+
 
 def get_rupture_times_c(
     Slowness, patch_size, n_patch_strike, n_patch_dip, nuc_x, nuc_y):
     """
     C Implementation wrapper
 
-    Slowness array has to be a flat array (1d).
+    Slowness array has to be a flat array (1d). The nucleation point may be
+    continuous, see :func:`get_nucleation_corners`.
     """
     return fast_sweep_ext.fast_sweep(
         Slowness, patch_size,
@@ -34,6 +94,196 @@ def get_rupture_times_c(
         n_patch_strike, n_patch_dip)
 
 
+def get_rupture_times_c_batch(
+    Slownesses, patch_size, n_patch_strike, n_patch_dip, nuc_x, nuc_y):
+    """
+    C Implementation wrapper for a batch of slowness fields and nucleation
+    points. The GIL is released during the calculation.
+
+    Parameters
+    ----------
+    Slownesses : :class:`numpy.NdArray`
+        (n_fields x n_patches) of flat slowness arrays, as for
+        :func:`get_rupture_times_c`
+    patch_size : float
+        Size of slip patches [km]
+    n_patch_strike : int
+        Number of patches in strike direction of fault-plane
+    n_patch_dip : int
+        Number of patches in dip direction of fault-plane
+    nuc_x : :class:`numpy.NdArray`
+        (n_fields) of nucleation points along strike in patch coordinates
+    nuc_y : :class:`numpy.NdArray`
+        (n_fields) of nucleation points along dip in patch coordinates
+
+    Returns
+    -------
+    tzero : :class:`numpy.NdArray`
+        (n_fields x n_patches) rupture onset times in s after hypocentral
+        time
+    """
+    Slownesses = num.ascontiguousarray(
+        num.atleast_2d(Slownesses), dtype=num.float64)
+
+    fields, idxs, weights = get_nucleation_corners(
+        n_patch_strike, n_patch_dip, nuc_x, nuc_y)
+
+    init_times = num.empty((fields.size, Slownesses.shape[1]))
+    init_times.fill(num.inf)
+    init_times[num.arange(fields.size), idxs] = 0.
+
+    corner_times = fast_sweep_ext.fast_sweep_batch(
+        num.ascontiguousarray(Slownesses[fields]), init_times,
+        patch_size, n_patch_strike, n_patch_dip)
+
+    tzeros = num.zeros_like(Slownesses)
+    num.add.at(tzeros, fields, weights[:, num.newaxis] * corner_times)
+    return tzeros
+
+
+def get_rupture_times_subfaults(
+    Slownesses, patch_sizes, ordering, nuc_subfault, nuc_x, nuc_y,
+    patch_centers=None, n_iter_max=20, tolerance=1e-6):
+    """
+    Rupture onset times on several sub-faults of a
+    :class:`beat.heart.FaultGeometry` for a batch of slowness fields.
+
+    Each sub-fault is swept on its own patch grid. If the patch centers are
+    given, the sub-fault grids are coupled: every patch is additionally
+    seeded by the onset times of the patches of the other sub-faults plus
+    the travel-time of the direct path in between. Sweeping and seeding are
+    repeated until the onset times do not change anymore.
+
+    Parameters
+    ----------
+    Slownesses : :class:`numpy.NdArray`
+        (n_fields x n_patches) of slownesses [s / km] in the patch ordering
+        of the fault geometry, i.e. for each sub-fault row-wise from top to
+        bottom
+    patch_sizes : list
+        of float, size of the slip patches [km] of each sub-fault
+    ordering : :class:`beat.utility.FaultOrdering`
+        of the fault geometry
+    nuc_subfault : int or :class:`numpy.NdArray`
+        (n_fields) index to the nucleating sub-fault
+    nuc_x : float or :class:`numpy.NdArray`
+        (n_fields) nucleation points along strike on the nucleating
+        sub-faults in patch coordinates
+    nuc_y : float or :class:`numpy.NdArray`
+        (n_fields) nucleation points along dip on the nucleating sub-faults
+        in patch coordinates
+    patch_centers : :class:`numpy.NdArray`
+        (n_patches x 3) of patch center coordinates [km], if None the
+        sub-faults are not coupled
+    n_iter_max : int
+        maximum number of coupling iterations
+    tolerance : float
+        maximum change of onset times [s] for coupling convergence
+
+    Returns
+    -------
+    tzero : :class:`numpy.NdArray`
+        (n_fields x n_patches) rupture onset times in s after hypocentral
+        time, in the patch ordering of the fault geometry
+    """
+    Slownesses = num.atleast_2d(Slownesses).astype(num.float64)
+    n_fields = Slownesses.shape[0]
+    field_idxs = num.arange(n_fields)
+
+    nuc_subfault = num.zeros(n_fields, dtype=num.int64) + \
+        num.asarray(nuc_subfault, dtype=num.int64)
+    nuc_x, nuc_y = [num.zeros(n_fields) + a for a in (nuc_x, nuc_y)]
+
+    # expand the fields to the corners of the nucleation cells
+    corners = []
+    for pmap in ordering.vmap:
+        npw, npl = pmap.shp
+        nuc_fields = field_idxs[nuc_subfault == pmap.count]
+        fields, idxs, weights = get_nucleation_corners(
+            npl, npw, nuc_x[nuc_fields], nuc_y[nuc_fields])
+        corners.append((nuc_fields[fields], idxs, weights))
+
+    corner_fields = num.hstack([c[0] for c in corners])
+    corner_weights = num.hstack([c[2] for c in corners])
+    n_corners = corner_fields.size
+
+    Slownesses_c = Slownesses[corner_fields]
+
+    def to_sweep_order(arr, shp):
+        npw, npl = shp
+        return num.ascontiguousarray(
+            arr.reshape((n_corners, npw, npl)).transpose(0, 2, 1).reshape(
+                (n_corners, npw * npl)))
+
+    def from_sweep_order(arr, shp):
+        npw, npl = shp
+        return arr.reshape((n_corners, npl, npw)).transpose(0, 2, 1).reshape(
+            (n_corners, npw * npl))
+
+    sweep_slownesses = []
+    init_times = []
+    start = 0
+    for pmap, (fields, idxs, _) in zip(ordering.vmap, corners):
+        sweep_slownesses.append(
+            to_sweep_order(Slownesses_c[:, pmap.slc], pmap.shp))
+
+        times = num.empty((n_corners, pmap.npatches))
+        times.fill(num.inf)
+        times[num.arange(start, start + fields.size), idxs] = 0.
+        start += fields.size
+        init_times.append(times)
+
+    def sweep_all(seeds):
+        tzeros = num.empty_like(Slownesses_c)
+        for pmap, slownesses, times in zip(
+                ordering.vmap, sweep_slownesses, seeds):
+            npw, npl = pmap.shp
+            tzeros[:, pmap.slc] = from_sweep_order(
+                fast_sweep_ext.fast_sweep_batch(
+                    slownesses, times, patch_sizes[pmap.count], npl, npw),
+                pmap.shp)
+        return tzeros
+
+    tzeros = sweep_all(init_times)
+
+    if patch_centers is not None and len(ordering.vmap) > 1:
+        patch_centers = num.asarray(patch_centers)
+        distances = num.sqrt(num.sum(
+            (patch_centers[:, num.newaxis, :] -
+             patch_centers[num.newaxis, :, :]) ** 2, axis=2))
+
+        # exclude coupling of patches within the same sub-fault
+        for pmap in ordering.vmap:
+            distances[pmap.slc, pmap.slc] = num.inf
+
+        for i in range(n_iter_max):
+            # onset time arriving at patch p from any patch q on another fault
+            arrivals = num.empty_like(tzeros)
+            for k in range(n_corners):
+                arrivals[k] = num.min(
+                    tzeros[k][:, num.newaxis] +
+                    distances * Slownesses_c[k][num.newaxis, :], axis=0)
+
+            seeds = []
+            for pmap, times in zip(ordering.vmap, init_times):
+                seeds.append(to_sweep_order(
+                    num.minimum(
+                        from_sweep_order(times, pmap.shp),
+                        arrivals[:, pmap.slc]),
+                    pmap.shp))
+
+            new_tzeros = sweep_all(seeds)
+            change = num.abs(new_tzeros - tzeros).max()
+            tzeros = new_tzeros
+            if change < tolerance:
+                break
+
+    tzeros_out = num.zeros_like(Slownesses)
+    num.add.at(
+        tzeros_out, corner_fields, corner_weights[:, num.newaxis] * tzeros)
+    return tzeros_out
+
+
 def get_rupture_times_numpy(
     Slowness, patch_size, n_patch_strike, n_patch_dip, nuc_x, nuc_y):
     """
@@ -50,12 +300,12 @@ def get_rupture_times_numpy(
         Number of patches in strike direction of fault-plane
     n_patch_dip : int
         Number of patches in dip direction of fault-plane
-    nuc_x : int
+    nuc_x : float
         Nucleation point of rupture in patch coordinate system on fault
-        along strike [integer 0 left, n_patch_str right]
-    nuc_y : int
+        along strike [0 left, n_patch_str - 1 right]
+    nuc_y : float
         Nucleation point of rupture in patch coordinate system on fault
-        along dip [integer 0 top n_patch_dip bottom]
+        along dip [0 top n_patch_dip - 1 bottom]
 
     Returns
     -------
@@ -63,8 +313,31 @@ def get_rupture_times_numpy(
         rupture onset times in s after hypocentral time
     """
 
-    StartTimes = num.ones((n_patch_dip, n_patch_strike)) * 1e8
-    StartTimes[nuc_y, nuc_x] = 0
+    _, idxs, weights = get_nucleation_corners(
+        n_patch_strike, n_patch_dip, nuc_x, nuc_y)
+
+    tzero = num.zeros((n_patch_dip, n_patch_strike))
+    for idx, weight in zip(idxs, weights):
+        tzero += weight * _get_rupture_times_numpy(
+            Slowness, patch_size, n_patch_strike, n_patch_dip,
+            idx // n_patch_dip, idx % n_patch_dip)
+
+    return tzero
+
+
+def _get_rupture_times_numpy(
+    Slowness, patch_size, n_patch_strike, n_patch_dip, nuc_x, nuc_y,
+        start_times=None):
+    """
+    Sweep from the nucleation patch or, if given, from the initial
+    start_times (n_patch_dip x n_patch_strike), 1e8 for patches that are
+    not seeded.
+    """
+    if start_times is None:
+        StartTimes = num.ones((n_patch_dip, n_patch_strike)) * 1e8
+        StartTimes[nuc_y, nuc_x] = 0
+    else:
+        StartTimes = num.array(start_times, dtype=num.float64)
 
     ### Upwind scheme ###
     def upwind(dip_ind, str_ind, StartTimes, Slowness,
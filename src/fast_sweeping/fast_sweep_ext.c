@@ -113,8 +113,9 @@ void upwind(float64_t NewVal[1], float64_t *StartTime, npy_intp i, npy_intp j, f
     return;
 }
 
-void fast_sweep(float64_t *Slowness, float64_t *StartTime, float64_t PatchSize, npy_intp HypoInStk, npy_intp HypoInDip, npy_intp NumInStk, npy_intp NumInDip){
-    int num_iter;
+void sweep(float64_t *Slowness, float64_t *StartTime, float64_t *Time_old, float64_t PatchSize, npy_intp NumInStk, npy_intp NumInDip){
+    /* Iterate the four sweeping directions on the pre-initialised
+       StartTime array until convergence. */
     npy_intp i, j, ii;
     npy_intp PatchNum;
     npy_intp VectPos[1];
@@ -123,32 +124,11 @@ void fast_sweep(float64_t *Slowness, float64_t *StartTime, float64_t PatchSize,
     float64_t err      = 1.0E+6; //high dummy value;
     float64_t NewVal[1];
 
-    float64_t *Time_old;
-
-    num_iter = 0;
     PatchNum = NumInStk*NumInDip;
 
-    Time_old = (float64_t *) malloc((size_t) ((PatchNum)*sizeof(float64_t)));
-
-    int cnt = 0;
-
-    for (i = 0; i < NumInStk; i++){
-        for (j = 0; j < NumInDip; j++){
-            Vect_from_Mat(VectPos, i, j, NumInDip);
-            StartTime[ VectPos[0] ] = +INFINITY;
-            cnt++;
-        }
-    }
-
-    Vect_from_Mat(VectPos, HypoInStk, HypoInDip, NumInDip);
-    StartTime[ VectPos[0] ] = 0.0;
-
     while (err > epsilon){
-        for (i = 0; i < NumInStk; i++){
-            for (j = 0; j < NumInDip; j++){
-                Vect_from_Mat(VectPos, i, j, NumInDip);
-                Time_old[ VectPos[0] ] = StartTime[ VectPos[0] ];
-            }
+        for (i = 0; i < PatchNum; i++){
+            Time_old[i] = StartTime[i];
         }
 
         for (ii = 0; ii < 4; ii++){
@@ -194,22 +174,108 @@ void fast_sweep(float64_t *Slowness, float64_t *StartTime, float64_t PatchSize,
         for (i = 0; i < PatchNum; i++){
             err += pow((StartTime[i]-Time_old[i]),2.0);
         }
-        num_iter++;
     }
 
     return;
 }
 
+int fast_sweep(float64_t *Slowness, float64_t *StartTime, float64_t PatchSize, float64_t HypoInStk, float64_t HypoInDip, npy_intp NumInStk, npy_intp NumInDip){
+    /* The nucleation point may be continuous. The onset times are then the
+       bilinear interpolation of the onset times for nucleation at the
+       patches of the enclosing cell, so that they vary continuously with
+       the nucleation point. */
+    npy_intp i, i0, j0, di, dj, k;
+    npy_intp PatchNum;
+    npy_intp VectPos[1];
+    float64_t fi, fj, w;
+
+    float64_t *Time_old, *Time_corner;
+
+    PatchNum = NumInStk*NumInDip;
+
+    Time_old = (float64_t *) malloc((size_t) ((PatchNum)*sizeof(float64_t)));
+    Time_corner = (float64_t *) malloc((size_t) ((PatchNum)*sizeof(float64_t)));
+    if (Time_old == NULL || Time_corner == NULL){
+        free(Time_old);
+        free(Time_corner);
+        return 0;
+    }
+
+    HypoInStk = (HypoInStk < 0.0) ? 0.0 : HypoInStk;
+    HypoInStk = (HypoInStk > (NumInStk - 1)) ? (NumInStk - 1) : HypoInStk;
+    HypoInDip = (HypoInDip < 0.0) ? 0.0 : HypoInDip;
+    HypoInDip = (HypoInDip > (NumInDip - 1)) ? (NumInDip - 1) : HypoInDip;
+
+    i0 = (npy_intp) floor(HypoInStk);
+    j0 = (npy_intp) floor(HypoInDip);
+    fi = HypoInStk - i0;
+    fj = HypoInDip - j0;
+
+    for (k = 0; k < PatchNum; k++){
+        StartTime[k] = 0.0;
+    }
+
+    for (di = 0; di < 2; di++){
+        for (dj = 0; dj < 2; dj++){
+            w = ((di == 0) ? (1.0 - fi) : fi) * ((dj == 0) ? (1.0 - fj) : fj);
+            if (w <= 0.0){
+                continue;
+            }
+
+            for (k = 0; k < PatchNum; k++){
+                Time_corner[k] = +INFINITY;
+            }
+
+            Vect_from_Mat(VectPos, i0 + di, j0 + dj, NumInDip);
+            Time_corner[ VectPos[0] ] = 0.0;
+
+            sweep(Slowness, Time_corner, Time_old, PatchSize, NumInStk, NumInDip);
+
+            for (i = 0; i < PatchNum; i++){
+                StartTime[i] += w * Time_corner[i];
+            }
+        }
+    }
+
+    free(Time_old);
+    free(Time_corner);
+    return 1;
+}
+
+int fast_sweep_batch(float64_t *Slownesses, float64_t *StartTimes, float64_t PatchSize, npy_intp NumInStk, npy_intp NumInDip, npy_intp NumFields){
+    /* Sweep NumFields slowness fields, each starting from its own initial
+       times (+INFINITY for patches that are not seeded). */
+    npy_intp k;
+    npy_intp PatchNum;
+
+    float64_t *Time_old;
+
+    PatchNum = NumInStk*NumInDip;
+
+    Time_old = (float64_t *) malloc((size_t) ((PatchNum)*sizeof(float64_t)));
+    if (Time_old == NULL){
+        return 0;
+    }
+
+    for (k = 0; k < NumFields; k++){
+        sweep(&Slownesses[k * PatchNum], &StartTimes[k * PatchNum], Time_old, PatchSize, NumInStk, NumInDip);
+    }
+
+    free(Time_old);
+    return 1;
+}
+
 PyObject* w_fast_sweep(PyObject *dummy, PyObject *args){
     PyObject *slowness_arr;
     PyArrayObject *c_slowness_arr, *tzero_arr;
 
-    float64_t patch_size, *slowness, *tzero;
-    npy_intp h_strk, h_dip, num_strk, num_dip, arr_size[1];
+    float64_t patch_size, h_strk, h_dip, *slowness, *tzero;
+    npy_intp num_strk, num_dip, arr_size[1];
+    int ok;
 
     (void) dummy;
 
-    if (!PyArg_ParseTuple(args, "Odkkkk", &slowness_arr, &patch_size, &h_strk, &h_dip, &num_strk, &num_dip)){
+    if (!PyArg_ParseTuple(args, "Odddkk", &slowness_arr, &patch_size, &h_strk, &h_dip, &num_strk, &num_dip)){
         PyErr_SetString(FastSweepExtError, "Invalid call to fast_sweep! \n usage: fast_sweep(slowness_arr, patch_size, h_strk, h_dip, num_strk, num_dip)");
         return NULL;
     }
@@ -224,20 +290,81 @@ PyObject* w_fast_sweep(PyObject *dummy, PyObject *args){
     c_slowness_arr = PyArray_GETCONTIGUOUS((PyArrayObject*) slowness_arr);
 
     tzero_arr = (PyArrayObject*) PyArray_EMPTY(1, arr_size, NPY_FLOAT64, 0);
+    if (tzero_arr == NULL){
+        Py_DECREF(c_slowness_arr);
+        return NULL;
+    }
 
     slowness = PyArray_DATA(c_slowness_arr);
     tzero = PyArray_DATA(tzero_arr);
 
-    fast_sweep(slowness, tzero, patch_size, h_strk, h_dip, num_strk, num_dip);
+    Py_BEGIN_ALLOW_THREADS
+    ok = fast_sweep(slowness, tzero, patch_size, h_strk, h_dip, num_strk, num_dip);
+    Py_END_ALLOW_THREADS
 
     Py_DECREF(c_slowness_arr);
 
+    if (!ok){
+        Py_DECREF(tzero_arr);
+        return PyErr_NoMemory();
+    }
+
     return (PyObject*) tzero_arr;
 }
 
+PyObject* w_fast_sweep_batch(PyObject *dummy, PyObject *args){
+    PyObject *slownesses_arr, *init_times_arr;
+    PyArrayObject *tzeros_arr;
+
+    float64_t patch_size, *slownesses, *tzeros;
+    npy_intp num_strk, num_dip, num_fields, shape_want[2];
+    int ok;
+
+    (void) dummy;
+
+    if (!PyArg_ParseTuple(args, "OOdkk", &slownesses_arr, &init_times_arr, &patch_size, &num_strk, &num_dip)){
+        PyErr_SetString(FastSweepExtError, "Invalid call to fast_sweep_batch! \n usage: fast_sweep_batch(slownesses_arr, init_times_arr, patch_size, num_strk, num_dip)");
+        return NULL;
+    }
+
+    shape_want[0] = -1;
+    shape_want[1] = num_strk * num_dip;
+    if (!good_array(slownesses_arr, NPY_FLOAT64, -1, 2, shape_want)){
+        return NULL;
+    }
+
+    num_fields = PyArray_DIMS((PyArrayObject*) slownesses_arr)[0];
+    shape_want[0] = num_fields;
+    if (!good_array(init_times_arr, NPY_FLOAT64, -1, 2, shape_want)){
+        return NULL;
+    }
+
+    tzeros_arr = (PyArrayObject*) PyArray_NewCopy((PyArrayObject*) init_times_arr, NPY_CORDER);
+    if (tzeros_arr == NULL){
+        return NULL;
+    }
+
+    slownesses = PyArray_DATA((PyArrayObject*) slownesses_arr);
+    tzeros = PyArray_DATA(tzeros_arr);
+
+    Py_BEGIN_ALLOW_THREADS
+    ok = fast_sweep_batch(slownesses, tzeros, patch_size, num_strk, num_dip, num_fields);
+    Py_END_ALLOW_THREADS
+
+    if (!ok){
+        Py_DECREF(tzeros_arr);
+        return PyErr_NoMemory();
+    }
+
+    return (PyObject*) tzeros_arr;
+}
+
 static PyMethodDef FastSweepExtMethods[] = {
     {"fast_sweep", w_fast_sweep, METH_VARARGS,
-"Fast Sweeping Algorithm to calculate rupture onset-times on patches of a plane given slowness of the rupturing patches.\n"},
+"Fast Sweeping Algorithm to calculate rupture onset-times on patches of a plane given slowness of the rupturing patches and a (continuous) nucleation point in patch coordinates.\n"},
+
+    {"fast_sweep_batch", w_fast_sweep_batch, METH_VARARGS,
+"Fast Sweeping Algorithm for a batch of slowness fields (n_fields x n_patches) starting from initial onset-times (n_fields x n_patches, inf where not seeded).\n"},
 
     {NULL, NULL, 0, NULL}  /* Sentinel */
 };
@@ -7,10 +7,12 @@ import os
 import logging
 import shutil
 import copy
+import json
 from time import time
+from datetime import timedelta
 from collections import OrderedDict
 
-from beat import psgrn, pscmp, utility, qseis2d
+from beat import psgrn, pscmp, utility, qseis2d, paripool
 
 from theano import config as tconfig
 from theano import shared
@@ -18,6 +20,7 @@ import numpy as num
 from scipy import linalg
 
 from pyrocko.guts import Object, String, Float, Int, Tuple, List
+from pyrocko.guts import dump_all, load_all
 from pyrocko.guts_array import Array
 
 from pyrocko import crust2x2, gf, cake, orthodrome, trace, util
@@ -104,17 +107,66 @@ class Covariance(Object):
         dtype=tconfig.floatX,
         help='Model prediction covariance matrix, velocity model',
         optional=True)
+    pred_v_factor = Array.T(
+        shape=(None, None),
+        dtype=tconfig.floatX,
+        help='Low-rank factor U (n x k) of the model prediction covariance'
+             ' matrix due to the velocity model: pred_v = U * U^T.'
+             ' If given, it replaces "pred_v".',
+        optional=True)
 
     def __init__(self, **kwargs):
         self.slnf = shared(0., borrow=True)
+        self._base_chol_inverse = None
+        self._lowrank_weight = None
         Object.__init__(self, **kwargs)
         self.update_slnf()
 
+    def __setattr__(self, name, value):
+        # invalidate cached decompositions of the changed matrixes
+        if name in ('data', 'pred_g'):
+            Object.__setattr__(self, '_base_chol_inverse', None)
+            Object.__setattr__(self, '_lowrank_weight', None)
+        elif name == 'pred_v_factor':
+            Object.__setattr__(self, '_lowrank_weight', None)
+
+        Object.__setattr__(self, name, value)
+
+    def update_pred_v(self, factor, lowrank=False):
+        """
+        Update the velocity model prediction covariance from its factor U
+        (n x k), pred_v = U * U^T.
+
+        Parameters
+        ----------
+        factor : :class:`numpy.ndarray` (n x k)
+        lowrank : boolean
+            if True the factor is kept as low-rank covariance, otherwise the
+            dense covariance is formed and ensured to be positive definite
+        """
+        factor = factor.astype(tconfig.floatX)
+        if lowrank:
+            self.pred_v_factor = factor
+        else:
+            self.pred_v_factor = None
+            self.pred_v = utility.ensure_cov_psd(
+                factor.dot(factor.T)).astype(tconfig.floatX)
+
+    @property
+    def lowrank(self):
+        """
+        True if the velocity model covariance is given as low-rank factor.
+        """
+        return self.pred_v_factor is not None
+
     @property
     def p_total(self):
         if self.pred_g is None:
             self.pred_g = num.zeros_like(self.data, dtype=tconfig.floatX)
 
+        if self.lowrank:
+            return self.pred_g + self.pred_v_factor.dot(self.pred_v_factor.T)
+
         if self.pred_v is None:
             self.pred_v = num.zeros_like(self.data, dtype=tconfig.floatX)
 
@@ -165,17 +217,109 @@ class Covariance(Object):
         """
         Inverse of Cholesky decomposition of ALL uncertainty covariance
         matrices. To be used as weight in the optimization.
+        For a low-rank velocity model covariance it is obtained by a rank-k
+        update of the cached base_chol_inverse in O(n^2 * k), the result is
+        a (not triangular) square root W of the inverse: W^T * W = Cx^-1.
         """
+        if self.lowrank:
+            return self._lowrank_chol_inverse()
+
         return num.linalg.inv(self.chol).astype(tconfig.floatX)
 
+    @property
+    def base_chol_inverse(self):
+        """
+        Inverse of Cholesky decomposition of the full-rank part of the
+        covariance (data + pred_g), i.e. without the low-rank velocity model
+        part. Returned as vector of the diagonal if the covariance is
+        diagonal. Calculated once and cached until data or pred_g are
+        reassigned.
+        """
+        if getattr(self, '_base_chol_inverse', None) is None:
+            Cb = self.data
+            if self.pred_g is not None:
+                Cb = Cb + self.pred_g
+
+            if utility.is_diagonal(Cb):
+                choli = 1. / num.sqrt(num.diagonal(Cb))
+            else:
+                choli = num.linalg.inv(
+                    linalg.cholesky(Cb, lower=True))
+
+            self._base_chol_inverse = choli.astype(tconfig.floatX)
+
+        return self._base_chol_inverse
+
+    def _lowrank_system(self):
+        """
+        Whitened low-rank factor A = Lb^-1 * U and the lower Cholesky
+        factor of the k x k capacitance matrix I + A^T * A.
+        """
+        A = self._whitened_factor()
+        k = A.shape[1]
+        capacitance = num.eye(k) + A.T.dot(A)
+        return A, linalg.cholesky(capacitance, lower=True)
+
+    def _whitened_factor(self):
+        choli = self.base_chol_inverse
+        if choli.ndim == 1:
+            return choli[:, num.newaxis] * self.pred_v_factor
+        else:
+            return choli.dot(self.pred_v_factor)
+
+    def _lowrank_chol_inverse(self):
+        """
+        W = (I + A * A^T)^-1/2 * Lb^-1, with the symmetric square root
+        from the thin SVD of A = Q * S * R^T:
+        (I + A * A^T)^-1/2 = I + Q * ((1 + S^2)^-1/2 - 1) * Q^T
+        """
+        choli = self.base_chol_inverse
+        if choli.ndim == 1:
+            choli = num.diag(choli)
+
+        Q, svals, _ = num.linalg.svd(
+            self._whitened_factor(), full_matrices=False)
+        d = 1. / num.sqrt(1. + svals ** 2) - 1.
+        return (choli + (Q * d).dot(Q.T.dot(choli))).astype(tconfig.floatX)
+
+    @property
+    def lowrank_weight(self):
+        """
+        Low-rank correction V (n x k) to the base weight W (base_chol_inverse)
+        following the Woodbury identity, such that:
+
+            r^T * Cx^-1 * r = |W * r|^2 - |V^T * W * r|^2
+
+        Costs O(n * k^2) instead of O(n^3) for the dense decomposition.
+        Cached until data, pred_g or pred_v_factor are reassigned.
+        """
+        if getattr(self, '_lowrank_weight', None) is None:
+            A, Lc = self._lowrank_system()
+            self._lowrank_weight = linalg.solve_triangular(
+                Lc, A.T, lower=True).T.astype(tconfig.floatX)
+
+        return self._lowrank_weight
+
     @property
     def log_norm_factor(self):
         """
         Calculate the normalisation factor of the posterior pdf.
         Following Duputel et al. 2014
+        For a low-rank velocity model covariance the determinant is calculated
+        with the matrix determinant lemma.
         """
         N = self.data.shape[0]
-        ldet_x = num.log(num.diag(self.chol)).sum() * 2.
+        if self.lowrank:
+            choli = self.base_chol_inverse
+            if choli.ndim == 2:
+                choli = num.diag(choli)
+
+            _, Lc = self._lowrank_system()
+            ldet_x = (num.log(num.diag(Lc)).sum() -
+                      num.log(choli).sum()) * 2.
+        else:
+            ldet_x = num.log(num.diag(self.chol)).sum() * 2.
+
         return utility.scalar2floatX((N * num.log(2 * num.pi)) + ldet_x)
 
     def update_slnf(self):
@@ -624,20 +768,69 @@ class GPSCompoundComponent(GeodeticDataset):
         return s
 
 
+gps_components = 'ENU'
+
+gps_dtype = num.dtype([
+    ('name', object),
+    ('lon', num.float64),
+    ('lat', num.float64),
+    ('v', num.float64, (3,)),
+    ('sigma', num.float64, (3,))])
+
+
 class GPSDataset(object):
     """
     Collecting many GPS stations into one object. Easy managing and assessing
     single stations and also merging all the stations components into compound
     components for fast and easy modeling.
+
+    The stations are stored column-wise in a structured array of
+    :data:`gps_dtype`: name, lon, lat, velocities v and their standard
+    deviations sigma for the components E, N, U. Missing components are NaN.
     """
 
     def __init__(self, name=None, stations=None):
-        self.stations = {}
         self.name = name
+        self.data = num.zeros(0, dtype=gps_dtype)
 
         if stations is not None:
             for station in stations:
-                self.stations[station.name] = station
+                self.add_station(station, force=True)
+
+    @classmethod
+    def from_arrays(cls, names, lons, lats, v, sigma, name=None):
+        """
+        Initialise from station arrays.
+
+        Parameters
+        ----------
+        names : :class:`numpy.ndarray` (n_stations)
+            of str, station names
+        lons, lats : :class:`numpy.ndarray` (n_stations)
+            station locations [deg]
+        v, sigma : :class:`numpy.ndarray` (n_stations, 3)
+            velocities and their standard deviations of components E, N, U
+        """
+        gps_ds = cls(name=name)
+        data = num.zeros(len(names), dtype=gps_dtype)
+        data['name'] = [str(n) for n in names]
+        data['lon'] = lons
+        data['lat'] = lats
+        data['v'] = v
+        data['sigma'] = sigma
+        gps_ds.data = data
+        return gps_ds
+
+    @property
+    def stations(self):
+        return dict(self.iter_stations())
+
+    def _station_index(self, name):
+        idx = num.flatnonzero(self.data['name'] == name)
+        if idx.size == 0:
+            raise KeyError(name)
+
+        return idx[0]
 
     def add_station(self, station, force=False):
         if not isinstance(station, GPSStation):
@@ -645,38 +838,61 @@ class GPSDataset(object):
                 'Input object is not a valid station of'
                 ' class: %s' % GPSStation)
 
-        if station.name not in self.stations.keys() or force:
-            self.stations[station.name] = station
+        row = num.zeros(1, dtype=gps_dtype)
+        row['name'] = station.name
+        row['lon'] = station.lon
+        row['lat'] = station.lat
+        for j, comp in enumerate(gps_components):
+            c = station.get_component(comp)
+            if c is None:
+                row['v'][0, j] = row['sigma'][0, j] = num.nan
+            else:
+                row['v'][0, j] = c.v
+                row['sigma'][0, j] = c.sigma
+
+        if station.name not in self.data['name']:
+            self.data = num.concatenate((self.data, row))
+        elif force:
+            self.data[self._station_index(station.name)] = row[0]
         else:
             raise Exception(
                 'Station %s already exists in dataset!' % station.name)
 
     def get_station(self, name):
-        return self.stations[name]
+        row = self.data[self._station_index(name)]
+        station = GPSStation(
+            name=row['name'], lon=float(row['lon']), lat=float(row['lat']))
+
+        for j, comp in enumerate(gps_components):
+            if not num.isnan(row['v'][j]):
+                station.add_component(GPSComponent(
+                    name=comp,
+                    v=float(row['v'][j]),
+                    sigma=float(row['sigma'][j])))
+
+        return station
 
     def remove_stations(self, stations):
-        for st in stations:
-            self.stations.pop(st)
+        self.data = self.data[
+            ~num.in1d(self.data['name'], list(stations))]
 
     def get_station_names(self):
-        return list(self.stations.keys())
+        return list(self.data['name'])
 
     def get_component_names(self):
-        return self.stations.values()[0].get_component_names()
+        return set(
+            comp for j, comp in enumerate(gps_components)
+            if not num.isnan(self.data['v'][:, j]).all())
 
     def get_compound(self, name):
-        stations = self.stations.values()
-
         comps = self.get_component_names()
 
         if name in comps:
-            stations_comps = [st.get_component(name) for st in stations]
-            lats = num.array([st.lat for st in stations])
-            lons = num.array([st.lon for st in stations])
-
-            vs = num.array([c.v for c in stations_comps])
-            variances = num.power(
-                num.array([c.sigma for c in stations_comps]), 2)
+            j = gps_components.index(name)
+            lats = self.data['lat'].copy()
+            lons = self.data['lon'].copy()
+            vs = self.data['v'][:, j].copy()
+            variances = self.data['sigma'][:, j] ** 2
         else:
             raise Exception(
                 'Requested component %s does not exist in the dataset' % name)
@@ -685,16 +901,17 @@ class GPSDataset(object):
             typ='GPS',
             station_names=self.get_station_names(),
             displacement=vs,
-            covariance=Covariance(data=num.eye(lats.size) * variances),
+            covariance=Covariance(data=num.diag(variances)),
             lats=lats,
             lons=lons,
             east_shifts=num.zeros_like(lats),
             north_shifts=num.zeros_like(lats),
             name=name,
-            odw=num.ones_like(lats.size))
+            odw=num.ones_like(lats))
 
     def iter_stations(self):
-        return self.stations.iteritems()
+        for name in self.data['name']:
+            yield name, self.get_station(name)
 
 
 class Quadtree(GeodeticDataset):
@@ -859,6 +1076,317 @@ class GeodeticResult(Object):
     llk = Float.T(default=0., optional=True)
 
 
+class SeismicDataHeader(Object):
+    """
+    Metadata of one seismic trace in the project data directory, the samples
+    are stored in one contiguous array of all traces.
+    """
+    network = String.T(default='')
+    station = String.T(default='')
+    location = String.T(default='')
+    channel = String.T(default='')
+    tmin = Float.T(default=0.)
+    deltat = Float.T(default=1.)
+    wavename = String.T(optional=True)
+    dtype = String.T(default='float64')
+    offset = Int.T(default=0, help='Index of the first sample')
+    nsamples = Int.T(default=0)
+
+
+project_data_index_name = 'index.yaml'
+project_stations_name = 'stations.yaml'
+project_traces_name = 'traces.npy'
+
+covariance_array_names = ('data', 'pred_g', 'pred_v', 'pred_v_factor')
+
+
+def _dump_covariance(datadir, prefix, covariance):
+    for name in covariance_array_names:
+        arr = getattr(covariance, name)
+        if arr is not None:
+            num.save(
+                os.path.join(datadir, '%s.covariance.%s.npy' % (prefix, name)),
+                arr)
+
+
+def _split_arrays(obj, datadir, prefix):
+    """
+    Shallow copy of a guts object without its arrays, which are stored as
+    (.npy) files. Nested objects are treated recursively, covariances are
+    stored separately.
+    """
+    obj = copy.copy(obj)
+    for name, value in list(obj.T.inamevals(obj)):
+        if isinstance(value, num.ndarray):
+            num.save(
+                os.path.join(datadir, '%s.%s.npy' % (prefix, name)), value)
+            setattr(obj, name, None)
+
+        elif isinstance(value, Covariance):
+            _dump_covariance(datadir, prefix, value)
+            setattr(obj, name, None)
+
+        elif isinstance(value, Object):
+            setattr(obj, name, _split_arrays(
+                value, datadir, '%s.%s' % (prefix, name)))
+
+    return obj
+
+
+def _join_arrays(obj, datadir, prefix, mmap_mode='c'):
+    """
+    Inverse of :func:`_split_arrays`, arrays are memory-mapped.
+    """
+    cov_arrays = {}
+    for fn in os.listdir(datadir):
+        if not fn.startswith(prefix + '.') or not fn.endswith('.npy'):
+            continue
+
+        path = fn[len(prefix) + 1:-4].split('.')
+        arr = num.load(os.path.join(datadir, fn), mmap_mode=mmap_mode)
+
+        if path[-2:-1] == ['covariance']:
+            cov_arrays.setdefault(tuple(path[:-2]), {})[path[-1]] = arr
+            continue
+
+        target = obj
+        for name in path[:-1]:
+            target = getattr(target, name)
+
+        setattr(target, path[-1], arr)
+
+    for path, arrays in cov_arrays.iteritems():
+        target = obj
+        for name in path:
+            target = getattr(target, name)
+
+        target.covariance = Covariance(**arrays)
+
+    return obj
+
+
+def dump_geodetic_data(datadir, datasets):
+    """
+    Store geodetic datasets in the project data directory format: metadata
+    as YAML and arrays, including the covariance matrixes, as separate (.npy)
+    files.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory, an existing directory is
+        replaced
+    datasets : list
+        of :class:`GeodeticDataset`
+    """
+    if os.path.exists(datadir):
+        shutil.rmtree(datadir)
+
+    util.ensuredir(datadir)
+
+    headers = [_split_arrays(dataset, datadir, '%i' % i)
+               for i, dataset in enumerate(datasets)]
+
+    dump_all(headers, filename=os.path.join(datadir, project_data_index_name))
+
+
+def load_geodetic_data(datadir, mmap_mode='c'):
+    """
+    Load geodetic datasets stored with :func:`dump_geodetic_data`.
+    The arrays are memory-mapped, i.e. only read when needed. With the default
+    copy-on-write mode they may be changed in memory without touching the
+    files.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory
+    mmap_mode : str
+        see :func:`numpy.load`, if None the arrays are read to memory
+
+    Returns
+    -------
+    list of :class:`GeodeticDataset`
+    """
+    datasets = load_all(filename=os.path.join(datadir, project_data_index_name))
+
+    return [_join_arrays(dataset, datadir, '%i' % i, mmap_mode=mmap_mode)
+            for i, dataset in enumerate(datasets)]
+
+
+def dump_seismic_data(datadir, stations, data_traces):
+    """
+    Store stations and seismic data traces in the project data directory
+    format: stations and trace headers as YAML, the samples of all traces as
+    one contiguous (.npy) array and the covariances as separate (.npy) files.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory, it is created if needed
+    stations : list
+        of :class:`pyrocko.model.Station`
+    data_traces : list
+        of :class:`pyrocko.trace.Trace` or :class:`SeismicDataset`
+    """
+    if os.path.exists(datadir):
+        shutil.rmtree(datadir)
+
+    util.ensuredir(datadir)
+
+    headers = []
+    offset = 0
+    for i, tr in enumerate(data_traces):
+        headers.append(SeismicDataHeader(
+            network=tr.network,
+            station=tr.station,
+            location=tr.location,
+            channel=tr.channel,
+            tmin=tr.tmin,
+            deltat=tr.deltat,
+            wavename=getattr(tr, 'wavename', None),
+            dtype=tr.ydata.dtype.name,
+            offset=offset,
+            nsamples=tr.ydata.size))
+        offset += tr.ydata.size
+
+        covariance = getattr(tr, 'covariance', None)
+        if covariance is not None:
+            _dump_covariance(datadir, '%i' % i, covariance)
+
+    if data_traces:
+        ydata = num.concatenate([tr.ydata for tr in data_traces])
+    else:
+        ydata = num.zeros(0)
+
+    num.save(os.path.join(datadir, project_traces_name), ydata)
+    dump_all(stations, filename=os.path.join(datadir, project_stations_name))
+    dump_all(headers, filename=os.path.join(datadir, project_data_index_name))
+
+
+def load_seismic_data(datadir, mmap_mode='c'):
+    """
+    Load stations and seismic data traces stored with
+    :func:`dump_seismic_data`. The samples are memory-mapped, see
+    :func:`load_geodetic_data`.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory
+    mmap_mode : str
+        see :func:`numpy.load`, if None the arrays are read to memory
+
+    Returns
+    -------
+    list of :class:`pyrocko.model.Station`,
+    list of :class:`SeismicDataset`
+    """
+    stations = load_all(
+        filename=os.path.join(datadir, project_stations_name))
+    headers = load_all(
+        filename=os.path.join(datadir, project_data_index_name))
+    ydata = num.load(
+        os.path.join(datadir, project_traces_name), mmap_mode=mmap_mode)
+
+    cov_files = set(fn for fn in os.listdir(datadir) if '.covariance.' in fn)
+
+    data_traces = []
+    for i, h in enumerate(headers):
+        tr = SeismicDataset(
+            network=h.network, station=h.station, location=h.location,
+            channel=h.channel, tmin=h.tmin, deltat=h.deltat,
+            ydata=ydata[h.offset:h.offset + h.nsamples].astype(
+                h.dtype, copy=False))
+        tr.wavename = h.wavename
+
+        arrays = {}
+        for name in covariance_array_names:
+            fn = '%i.covariance.%s.npy' % (i, name)
+            if fn in cov_files:
+                arrays[name] = num.load(
+                    os.path.join(datadir, fn), mmap_mode=mmap_mode)
+
+        if arrays:
+            tr.covariance = Covariance(**arrays)
+
+        data_traces.append(tr)
+
+    return stations, data_traces
+
+
+def load_project_data(datadir, datatype, pickle_path=None, mmap_mode='c'):
+    """
+    Load the imported data of a project from the data directory. If it does
+    not exist, data that was pickled by earlier versions is loaded from the
+    pickle_path, see :func:`convert_project_data`.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the project data directory
+    datatype : str
+        'seismic' or 'geodetic'
+    pickle_path : str
+        path to the pickled project data
+    mmap_mode : str
+        see :func:`numpy.load`
+
+    Returns
+    -------
+    for 'seismic' list of stations and list of :class:`SeismicDataset`,
+    for 'geodetic' list of :class:`GeodeticDataset`
+    """
+    if datatype not in ('seismic', 'geodetic'):
+        raise TypeError('Datatype "%s" not supported!' % datatype)
+
+    if not os.path.exists(datadir) and pickle_path is not None and \
+            os.path.exists(pickle_path):
+        logger.warn(
+            'Loading pickled %s data from %s, convert it with'
+            ' "beat import --convert" for faster loading!' % (
+                datatype, pickle_path))
+        return utility.load_objects(pickle_path)
+
+    if datatype == 'seismic':
+        return load_seismic_data(datadir, mmap_mode=mmap_mode)
+    else:
+        return load_geodetic_data(datadir, mmap_mode=mmap_mode)
+
+
+def convert_project_data(pickle_path, datadir, datatype, force=False):
+    """
+    Convert pickled project data to the project data directory format.
+
+    Parameters
+    ----------
+    pickle_path : str
+        path to the pickled project data
+    datadir : str
+        path to the project data directory
+    datatype : str
+        'seismic' or 'geodetic'
+    force : boolean
+        overwrite existing data directory
+    """
+    if datatype not in ('seismic', 'geodetic'):
+        raise TypeError('Datatype "%s" not supported!' % datatype)
+
+    if os.path.exists(datadir):
+        if force:
+            shutil.rmtree(datadir)
+        else:
+            logger.info('%s exists! Use --force to overwrite!' % datadir)
+            return
+
+    logger.info('Converting %s to %s' % (pickle_path, datadir))
+    if datatype == 'seismic':
+        stations, data_traces = utility.load_objects(pickle_path)
+        dump_seismic_data(datadir, stations, data_traces)
+    else:
+        dump_geodetic_data(datadir, utility.load_objects(pickle_path))
+
+
 def init_seismic_targets(
         stations, earth_model_name='ak135-f-average.m', channels=['T', 'Z'],
         sample_rate=1.0, crust_inds=[0], interpolation='multilinear',
@@ -978,6 +1506,39 @@ def init_geodetic_targets(
     return targets
 
 
+def merge_geodetic_targets(targets):
+    """
+    Merge the observation points of geodetic targets that use the same
+    Green's Function store into one target, so that the synthetics of all
+    datasets are calculated in one request. The order of the observation
+    points is kept, the results may be split into the datasets with
+    :meth:`utility.ListToArrayBijection.r3map`.
+
+    Parameters
+    ----------
+    targets : list
+        of :class:`pyrocko.gf.targets.StaticTarget`
+
+    Returns
+    -------
+    list of :class:`pyrocko.gf.targets.StaticTarget` one for each store in
+    order of first appearance
+    """
+    store_ids = utility.unique_list([target.store_id for target in targets])
+
+    merged_targets = []
+    for store_id in store_ids:
+        store_targets = [t for t in targets if t.store_id == store_id]
+        merged_targets.append(gf.StaticTarget(
+            lons=num.hstack([t.lons for t in store_targets]),
+            lats=num.hstack([t.lats for t in store_targets]),
+            interpolation=store_targets[0].interpolation,
+            quantity='displacement',
+            store_id=store_id))
+
+    return merged_targets
+
+
 def vary_model(
         earthmod, error_depth=0.1, error_velocities=0.1,
         depth_limit_variation=600 * km):
@@ -1116,13 +1677,259 @@ def vary_model(
     return new_earthmod, cost
 
 
+# uncertainties in discontinuity depth after Shearer 1991
+discontinuity_depth_uncertainties = {
+    410 * km: 3 * km,
+    520 * km: 4 * km,
+    660 * km: 8 * km}
+
+# uncertainties in velocity for upper and lower mantle from Woodward 1991
+# and Mooney 1989, (depth below which it applies, error)
+mantle_velocity_uncertainties = (
+    (100 * km, 0.05),
+    (200 * km, 0.03),
+    (400 * km, 0.01))
+
+
+def earthmodel_variation_setup(
+        ref_earthmod, error_depth=0.1, error_velocities=0.1,
+        depth_limit_variation=600 * km):
+    """
+    Layer parameters of an earthmodel and their uncertainties as arrays for
+    :func:`draw_earthmodel_variations`.
+
+    Parameters
+    ----------
+    ref_earthmod : :class:`pyrocko.cake.LayeredModel`
+    error_depth : scalar, float
+        3 sigma error in percent of the depth for the respective layers
+    error_velocities : scalar, float
+        3 sigma error in percent of the velocities for the respective layers
+    depth_limit_variation : scalar, float
+        depth threshold [m], layers with depth > than this are not varied
+
+    Returns
+    -------
+    dict of :class:`numpy.ndarray` (n_varied_layers), and the bottom depth and
+    p-wave velocity at the top of the first layer that is not varied (None if
+    all layers are varied)
+    """
+    layers = list(ref_earthmod.layers())
+
+    if depth_limit_variation:
+        n_varied = len(
+            [l for l in layers if l.ztop < depth_limit_variation])
+    else:
+        n_varied = len(layers)
+
+    varied = layers[:n_varied]
+
+    setup = dict(
+        ztop=num.array([l.ztop for l in varied]),
+        zbot=num.array([l.zbot for l in varied]),
+        vp_top=num.array([l.mtop.vp for l in varied]),
+        vp_bot=num.array([l.mbot.vp for l in varied]),
+        is_gradient=num.array([isinstance(l, GradientLayer) for l in varied]),
+        sigma_depth=num.zeros(n_varied),
+        sigma_vp=num.zeros(n_varied))
+
+    # gradient layers without interface to the layer above
+    setup['is_continuous'] = setup['is_gradient'] & num.concatenate(
+        [[False], setup['vp_top'][1:] == setup['vp_bot'][:-1]])
+
+    error_vp = num.ones(n_varied) * error_velocities
+    for depth, error in mantle_velocity_uncertainties:
+        error_vp[setup['ztop'] > depth] = error
+
+    setup['sigma_vp'] = setup['vp_top'] * error_vp / 3.
+    setup['sigma_depth'] = setup['zbot'] * error_depth / 3.
+
+    for depth, error in discontinuity_depth_uncertainties.items():
+        setup['sigma_depth'][
+            num.floor(setup['zbot'] / km) == depth / km] = error / 3.
+
+    if n_varied < len(layers):
+        limit_layer = layers[n_varied]
+        setup['limit_zbot'] = limit_layer.zbot
+        setup['limit_vp_top'] = limit_layer.mtop.vp
+    else:
+        setup['limit_zbot'] = None
+        setup['limit_vp_top'] = None
+
+    return setup
+
+
+def draw_earthmodel_variations(
+        setup, n_models, rstate=None, max_redraws=1000):
+    """
+    Draw layer depth and velocity perturbations for many earthmodels at once.
+
+    The layers are varied from top to bottom, for all models in parallel.
+    Perturbations that violate increasing velocity with depth or produce
+    layers with negative thickness are redrawn for the affected models only.
+    The number of redraws is the cost of a model, as in :func:`vary_model`.
+
+    Parameters
+    ----------
+    setup : dict
+        from :func:`earthmodel_variation_setup`
+    n_models : int
+        number of candidate models
+    rstate : :class:`numpy.random.RandomState`
+        random number generator, default: global numpy state
+    max_redraws : int
+        per layer, models exceeding it get infinite cost
+
+    Returns
+    -------
+    vp_top, vp_bot, zbot : :class:`numpy.ndarray` (n_models, n_varied_layers)
+    cost : :class:`numpy.ndarray` (n_models)
+    """
+    if rstate is None:
+        rstate = num.random
+
+    n_layers = setup['ztop'].size
+    vp_top = num.tile(setup['vp_top'], (n_models, 1))
+    vp_bot = num.tile(setup['vp_bot'], (n_models, 1))
+    zbot = num.tile(setup['zbot'], (n_models, 1))
+    cost = num.zeros(n_models)
+
+    for il in range(n_layers):
+        # velocities
+        pending = num.arange(n_models)
+        for count in range(max_redraws + 1):
+            if pending.size == 0:
+                break
+
+            delta = rstate.normal(0., setup['sigma_vp'][il], pending.size)
+
+            if il == 0:
+                new_top = vp_top[pending, il] + delta
+                new_bot = vp_bot[pending, il] + delta
+                valid = num.ones(pending.size, dtype=num.bool)
+            elif setup['is_continuous'][il]:
+                new_top = vp_bot[pending, il - 1]
+                new_bot = vp_bot[pending, il] + delta
+                valid = new_bot >= new_top
+            else:
+                new_top = vp_top[pending, il] + delta
+                new_bot = vp_bot[pending, il] + delta
+                valid = new_top >= vp_bot[pending, il - 1]
+
+            accept = pending[valid]
+            vp_top[accept, il] = new_top[valid]
+            vp_bot[accept, il] = new_bot[valid]
+
+            pending = pending[~valid]
+            cost[pending] += 1
+        else:
+            cost[pending] = num.inf
+
+        # bottom depths
+        if il == 0:
+            ztop = num.ones(n_models) * setup['ztop'][0]
+        else:
+            ztop = zbot[:, il - 1]
+
+        pending = num.arange(n_models)
+        for count in range(max_redraws + 1):
+            if pending.size == 0:
+                break
+
+            delta = rstate.normal(0., setup['sigma_depth'][il], pending.size)
+            new_bot = zbot[pending, il] + delta
+            valid = new_bot >= ztop[pending]
+
+            zbot[pending[valid], il] = new_bot[valid]
+
+            pending = pending[~valid]
+            cost[pending] += 1
+        else:
+            cost[pending] = num.inf
+
+    # transition to the first layer that is not varied
+    if setup['limit_zbot'] is not None and n_layers > 0:
+        invalid = (zbot[:, -1] > setup['limit_zbot']) | \
+            (vp_bot[:, -1] > setup['limit_vp_top'])
+        cost[invalid] = num.inf
+
+    return vp_top, vp_bot, zbot, cost
+
+
+def _varied_earthmodel(ref_earthmod, setup, vp_top, vp_bot, zbot):
+    """
+    Copy of the reference earthmodel with the varied layer parameters of one
+    model from :func:`draw_earthmodel_variations`. Vp / Vs is kept.
+    """
+    new_earthmod = copy.deepcopy(ref_earthmod)
+    layers = list(new_earthmod.layers())
+
+    for il in range(setup['ztop'].size):
+        layer = layers[il]
+
+        if il > 0:
+            layer.ztop = float(zbot[il - 1])
+        layer.zbot = float(zbot[il])
+
+        for m, vp in ((layer.mtop, vp_top[il]), (layer.mbot, vp_bot[il])):
+            if m.vp != vp:
+                m.vs *= vp / m.vp
+                m.vp = float(vp)
+
+    if setup['limit_zbot'] is not None and setup['ztop'].size > 0:
+        layers[setup['ztop'].size].ztop = float(zbot[-1])
+
+    return new_earthmod
+
+
+def _draw_accepted_variations(
+        setup, num_vary, seed, max_cost, batch_size, max_batches):
+    """
+    Generator of the layer parameters (vp_top, vp_bot, zbot) of the first
+    num_vary accepted models from :func:`draw_earthmodel_variations`.
+    """
+    rstate = num.random.RandomState(seed)
+
+    n_yielded = 0
+    n_drawn = 0
+    n_accepted = 0
+    while n_yielded < num_vary:
+        if n_drawn >= max_batches * batch_size:
+            raise ValueError(
+                'Only %i of %i earthmodels accepted after %i draws! Increase'
+                ' the errors or the "max_cost".' % (
+                    n_yielded, num_vary, n_drawn))
+
+        vp_top, vp_bot, zbot, cost = draw_earthmodel_variations(
+            setup, batch_size, rstate=rstate)
+        n_drawn += batch_size
+        n_accepted += num.sum(cost <= max_cost)
+
+        for im in num.where(cost <= max_cost)[0]:
+            if n_yielded == num_vary:
+                break
+
+            n_yielded += 1
+            yield vp_top[im], vp_bot[im], zbot[im]
+
+    logger.info(
+        'Drew %i earthmodel variations, acceptance rate %f (%i / %i)' % (
+            num_vary, n_accepted / float(n_drawn), n_accepted, n_drawn))
+
+
 def ensemble_earthmodel(ref_earthmod, num_vary=10, error_depth=0.1,
-                        error_velocities=0.1, depth_limit_variation=600 * km):
+                        error_velocities=0.1, depth_limit_variation=600 * km,
+                        seed=None, max_cost=20, batch_size=100,
+                        max_batches=100, only_last=False):
     """
     Create ensemble of earthmodels that vary around a given input earth model
     by a Gaussian of 2 sigma (in Percent 0.1 = 10%) for the depth layers
     and for the p and s wave velocities. Vp / Vs is kept unchanged
 
+    Candidate models are drawn in batches of fixed size, unlikely models with
+    a cost higher than max_cost are rejected. For a given seed the n-th model
+    of the ensemble does not depend on num_vary.
+
     Parameters
     ----------
     ref_earthmod : :class:`pyrocko.cake.LayeredModel`
@@ -1135,28 +1942,46 @@ def ensemble_earthmodel(ref_earthmod, num_vary=10, error_depth=0.1,
         3 sigma error in percent of the velocities for the respective layers
     depth_limit_variation : scalar, float
         depth threshold [m], layers with depth > than this are not varied
+    seed : int
+        of the random number generator, if None the ensemble is not
+        reproducible
+    max_cost : int
+        maximum number of redraws to ensure increasing layer velocities
+    batch_size : int
+        number of candidate models drawn at once
+    max_batches : int
+        maximum number of batches before giving up
+    only_last : boolean
+        if True, the variations are drawn for the whole ensemble, but only
+        the last earthmodel is created
 
     Returns
     -------
     List of Varied Earthmodels :class:`pyrocko.cake.LayeredModel`
     """
 
-    earthmods = []
-    i = 0
-    while i < num_vary:
-        new_model, cost = vary_model(
-            ref_earthmod,
-            error_depth,
-            error_velocities,
-            depth_limit_variation)
-
-        if cost > 20:
-            logger.debug('Skipped unlikely model %f' % cost)
-        else:
-            i += 1
-            earthmods.append(new_model)
+    if num_vary < 1:
+        return []
+
+    setup = earthmodel_variation_setup(
+        ref_earthmod,
+        error_depth=error_depth,
+        error_velocities=error_velocities,
+        depth_limit_variation=depth_limit_variation)
 
-    return earthmods
+    variations = _draw_accepted_variations(
+        setup, num_vary, seed=seed, max_cost=max_cost,
+        batch_size=batch_size, max_batches=max_batches)
+
+    if only_last:
+        for variation in variations:
+            pass
+
+        variations = [variation]
+
+    return [
+        _varied_earthmodel(ref_earthmod, setup, *variation)
+        for variation in variations]
 
 
 def get_velocity_model(
@@ -1248,10 +2073,11 @@ def get_velocity_model(
     if crust_ind > 0:
         source_model = ensemble_earthmodel(
             source_model,
-            num_vary=1,
+            num_vary=crust_ind,
             error_depth=gfc.error_depth,
             error_velocities=gfc.error_velocities,
-            depth_limit_variation=gfc.depth_limit_variation * km)[0]
+            depth_limit_variation=gfc.depth_limit_variation * km,
+            seed=gfc.variation_seed, only_last=True)[0]
 
     return source_model
 
@@ -1528,70 +2354,230 @@ def seis_construct_gf(
         event, earth_model_name=sf.earth_model_name, crust_ind=crust_ind,
         gf_config=sf, custom_velocity_model=sf.custom_velocity_model)
 
+    for station in stations:
+        seis_construct_gf_station(
+            station, event, seismic_config, crust_ind=crust_ind,
+            execute=execute, force=force, source_model=source_model,
+            single_station=len(stations) == 1)
+
+
+def get_seismic_store_dir(station, event, seismic_config, crust_ind=0):
+    """
+    Directory of the seismic GF store for a station and velocity model.
+    """
+    sf = seismic_config.gf_config
+    fomosto_config = get_fomosto_baseconfig(
+        sf, event, station, seismic_config.get_waveform_names(), crust_ind)
+    return os.path.join(sf.store_superdir, fomosto_config.id)
+
+
+def seis_construct_gf_station(
+        station, event, seismic_config, crust_ind=0, execute=False,
+        force=False, nworkers=None, source_model=None, single_station=False):
+    """
+    Create and calculate the seismic GF store for one station and velocity
+    model, see :func:`seis_construct_gf`.
+
+    Parameters
+    ----------
+    station : :class:`pyrocko.model.Station`
+    event : :class:`pyrocko.model.Event`
+    seismic_config : :class:`config.SeismicConfig`
+    crust_ind : int
+        Index to set to the Greens Function store
+    execute : boolean
+        Flag to execute the calculation, if False just setup tested
+    force : boolean
+        Flag to overwrite existing GF stores
+    nworkers : int
+        number of processes for the calculation, default: from config
+    source_model : :class:`pyrocko.cake.LayeredModel`
+        velocity model at the source, if None it is created
+    single_station : boolean
+        if True the custom velocity model is used at the receiver as well
+    """
+
+    sf = seismic_config.gf_config
+
+    if nworkers is None:
+        nworkers = sf.nworkers
+
+    if source_model is None:
+        source_model = get_velocity_model(
+            event, earth_model_name=sf.earth_model_name, crust_ind=crust_ind,
+            gf_config=sf, custom_velocity_model=sf.custom_velocity_model)
+
     waveforms = seismic_config.get_waveform_names()
 
-    for station in stations:
-        logger.info('Station %s' % station.station)
-        logger.info('---------------------')
+    logger.info('Station %s' % station.station)
+    logger.info('---------------------')
+
+    fomosto_config = get_fomosto_baseconfig(
+        sf, event, station, waveforms, crust_ind)
 
-        fomosto_config = get_fomosto_baseconfig(
-            sf, event, station, waveforms, crust_ind)
+    store_dir = os.path.join(sf.store_superdir, fomosto_config.id)
 
-        store_dir = os.path.join(sf.store_superdir, fomosto_config.id)
+    if not os.path.exists(store_dir) or force:
+        logger.info('Creating Store at %s' % store_dir)
 
-        if not os.path.exists(store_dir) or force:
-            logger.info('Creating Store at %s' % store_dir)
+        if single_station:
+            custom_velocity_model = sf.custom_velocity_model
+        else:
+            custom_velocity_model = None
 
-            if len(stations) == 1:
-                custom_velocity_model = sf.custom_velocity_model
-            else:
-                custom_velocity_model = None
+        receiver_model = get_velocity_model(
+            station, earth_model_name=sf.earth_model_name,
+            crust_ind=crust_ind, gf_config=sf,
+            custom_velocity_model=custom_velocity_model)
 
-            receiver_model = get_velocity_model(
-                station, earth_model_name=sf.earth_model_name,
-                crust_ind=crust_ind, gf_config=sf,
-                custom_velocity_model=custom_velocity_model)
+        # shared by all crust variations, qseis2d re-uses QSeisS results
+        # of identical source site models
+        gf_directory = os.path.join(sf.store_superdir, 'base_gfs')
 
-            gf_directory = os.path.join(
-                sf.store_superdir, 'base_gfs_%i' % crust_ind)
+        conf = choose_backend(
+            fomosto_config, sf.code, source_model, receiver_model,
+            gf_directory)
 
-            conf = choose_backend(
-                fomosto_config, sf.code, source_model, receiver_model,
-                gf_directory)
+        fomosto_config.validate()
+        conf.validate()
+
+        gf.Store.create_editables(
+            store_dir,
+            config=fomosto_config,
+            extra={sf.code: conf},
+            force=force)
+    else:
+        logger.info(
+            'Store %s exists! Use force=True to overwrite!' % store_dir)
 
-            fomosto_config.validate()
-            conf.validate()
+    traces_path = os.path.join(store_dir, 'traces')
 
-            gf.Store.create_editables(
-                store_dir,
-                config=fomosto_config,
-                extra={sf.code: conf},
-                force=force)
+    if execute:
+        if not os.path.exists(traces_path) or force:
+            logger.info('Filling store ...')
+            store = gf.Store(store_dir, 'r')
+            store.make_ttt(force=force)
+            store.close()
+            backend_builders[sf.code](
+                store_dir, nworkers=nworkers, force=force)
+
+            if sf.rm_gfs and sf.code == 'qssp':
+                gf_dir = os.path.join(store_dir, 'qssp_green')
+                logger.info('Removing QSSP Greens Functions!')
+                shutil.rmtree(gf_dir)
         else:
+            logger.info('Traces exist use force=True to overwrite!')
+
+
+def _build_store_job(job):
+    """
+    Worker process: builds one GF store, returns the error message if the
+    calculation failed.
+    """
+    store_dir, function, kwargs = job
+    try:
+        function(**kwargs)
+        return store_dir, None
+    except Exception as e:
+        logger.error('Building store %s failed: %s' % (store_dir, e))
+        return store_dir, str(e)
+
+
+def build_gf_stores(jobs, nworkers=1, force=False):
+    """
+    Build GF stores as independent jobs, e.g. for all combinations of
+    stations and velocity model variations. Stores that have been
+    calculated already are skipped. Progress and the estimated time of
+    completion are logged.
+
+    If there are at least as many jobs as workers, the jobs are distributed
+    to a pool of nworkers processes, each building its store serially.
+    Otherwise the jobs are executed one after another, each with nworkers
+    processes.
+
+    Parameters
+    ----------
+    jobs : list
+        of tuples (store_dir, function, kwargs), where function(**kwargs)
+        creates and calculates the store in store_dir and accepts the
+        nworkers and force keyword arguments
+    nworkers : int
+        total number of processes to use
+    force : boolean
+        Flag to overwrite existing GF stores
+    """
+    pending = [
+        job for job in jobs
+        if force or not os.path.exists(os.path.join(job[0], 'traces'))]
+
+    n_jobs = len(pending)
+    logger.info(
+        'Building %i GF stores, skipping %i existing store(s)' % (
+            n_jobs, len(jobs) - n_jobs))
+
+    if n_jobs == 0:
+        return
+
+    if n_jobs >= nworkers > 1:
+        nworkers_job = 1
+    else:
+        nworkers_job = nworkers
+
+    for store_dir, _, kwargs in pending:
+        kwargs.update(nworkers=nworkers_job, force=force)
+
+    if nworkers_job == 1 and nworkers > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(processes=nworkers)
+        results = pool.imap_unordered(_build_store_job, pending)
+    else:
+        pool = None
+        results = (_build_store_job(job) for job in pending)
+
+    failed = []
+    t0 = time()
+    try:
+        for i, (store_dir, error) in enumerate(results):
+            if error is not None:
+                failed.append(store_dir)
+
+            elapsed = time() - t0
+            eta = elapsed / (i + 1) * (n_jobs - i - 1)
             logger.info(
-                'Store %s exists! Use force=True to overwrite!' % store_dir)
-
-        traces_path = os.path.join(store_dir, 'traces')
-
-        if execute:
-            if not os.path.exists(traces_path) or force:
-                logger.info('Filling store ...')
-                store = gf.Store(store_dir, 'r')
-                store.make_ttt(force=force)
-                store.close()
-                backend_builders[sf.code](
-                    store_dir, nworkers=sf.nworkers, force=force)
-
-                if sf.rm_gfs and sf.code == 'qssp':
-                    gf_dir = os.path.join(store_dir, 'qssp_green')
-                    logger.info('Removing QSSP Greens Functions!')
-                    shutil.rmtree(gf_dir)
-            else:
-                logger.info('Traces exist use force=True to overwrite!')
+                'Finished store %i of %i: %s, elapsed %s, ETA %s' % (
+                    i + 1, n_jobs, store_dir,
+                    timedelta(seconds=int(elapsed)),
+                    timedelta(seconds=int(eta))))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if failed:
+        raise Exception(
+            'Building stores failed: %s! Re-run to resume.' %
+            utility.list2string(failed))
+
+
+def get_geodetic_store_dir(event, geodetic_config, crust_ind=0):
+    """
+    Directory of the geodetic GF store for a velocity model.
+    """
+    gfc = geodetic_config.gf_config
+    station = ReferenceLocation(
+        station='statics',
+        lat=event.lat,
+        lon=event.lon)
+
+    fomosto_config = get_fomosto_baseconfig(
+        gfconfig=gfc, event=event, station=station,
+        waveforms=[], crust_ind=crust_ind)
+    return os.path.join(gfc.store_superdir, fomosto_config.id)
 
 
 def geo_construct_gf(
-        event, geodetic_config, crust_ind=0, execute=True, force=False):
+        event, geodetic_config, crust_ind=0, execute=True, force=False,
+        nworkers=None):
     """
     Calculate geodetic Greens Functions (GFs) and create a fomosto 'GF store'
     that is being used repeatetly later on to calculate the synthetic
@@ -1609,6 +2595,8 @@ def geo_construct_gf(
         Flag to execute the calculation, if False just setup tested
     force : boolean
         Flag to overwrite existing GF stores
+    nworkers : int
+        number of processes for the calculation, default: from config
     """
     from pyrocko.fomosto import psgrn_pscmp as ppp
 
@@ -1640,20 +2628,13 @@ def geo_construct_gf(
         gfconfig=gfc, event=event, station=station,
         waveforms=[], crust_ind=crust_ind)
 
-    store_dir = os.path.join(gfc.store_superdir, fomosto_config.id)
+    store_dir = get_geodetic_store_dir(
+        event, geodetic_config, crust_ind=crust_ind)
 
     if not os.path.exists(store_dir) or force:
         logger.info('Create Store at: %s' % store_dir)
         logger.info('---------------------------')
 
-        # potentially vary source model
-        if crust_ind > 0:
-            source_model = ensemble_earthmodel(
-                source_model,
-                num_vary=1,
-                error_depth=gfc.error_depth,
-                error_velocities=gfc.error_velocities)[0]
-
         fomosto_config.earthmodel_1d = source_model
         fomosto_config.modelling_code_id = 'psgrn_pscmp.%s' % version
 
@@ -1677,8 +2658,11 @@ def geo_construct_gf(
         store.close()
 
         # build store
+        if nworkers is None:
+            nworkers = gfc.nworkers
+
         try:
-            ppp.build(store_dir, nworkers=gfc.nworkers, force=force)
+            ppp.build(store_dir, nworkers=nworkers, force=force)
         except ppp.PsCmpError, e:
             if str(e).find('could not start psgrn/pscmp') != -1:
                 logger.warn('psgrn/pscmp not installed')
@@ -1745,14 +2729,6 @@ def geo_construct_gf_psgrn(
         custom_velocity_model=gfc.custom_velocity_model).extract(
             depth_max=gfc.source_depth_max * km)
 
-    # potentially vary source model
-    if crust_ind > 0:
-        source_model = ensemble_earthmodel(
-            source_model,
-            num_vary=1,
-            error_depth=gfc.error_depth,
-            error_velocities=gfc.error_velocities)[0]
-
     c.earthmodel_1d = source_model
     c.psgrn_outdir = os.path.join(
         gfc.store_superdir, 'psgrn_green_%i' % (crust_ind))
@@ -1938,6 +2914,31 @@ class FaultGeometry(gf.seismosizer.Cloneable):
         self._check_index(index)
         return self.ordering.vmap[index].slc
 
+    def get_patch_centers(self, datatype=None, component=None):
+        """
+        Return the center coordinates of all patches of the fault geometry,
+        e.g. for coupling the sub-faults in the rupture onset calculation.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` (n_patches x 3)
+            north, east, depth [km] with respect to the reference point of
+            the first patch
+        """
+        patches = self.get_all_patches(datatype=datatype, component=component)
+
+        lats = num.array([p.lat for p in patches])
+        lons = num.array([p.lon for p in patches])
+        norths, easts = orthodrome.latlon_to_ne_numpy(
+            lats[0], lons[0], lats, lons)
+
+        centers = num.vstack([
+            norths + num.array([p.north_shift for p in patches]),
+            easts + num.array([p.east_shift for p in patches]),
+            num.array([p.depth for p in patches])]).T
+
+        return centers / km
+
     @property
     def nsubfaults(self):
         return len(self.ordering.vmap)
@@ -2017,19 +3018,194 @@ def discretize_sources(
     return fault
 
 
+def _linear_gf_filename(index_path, var, idx):
+    return '%s_%s_%i.npy' % (
+        os.path.splitext(os.path.basename(index_path))[0], var, idx)
+
+
+def init_linear_gfs(
+        index_path, varnames, shapes, dtype=tconfig.floatX, meta=None):
+    """
+    Initialise a library of linear Green's Function matrixes on disk.
+    For every slip component and dataset a preallocated (.npy) matrix is
+    created next to a JSON index file.
+
+    Parameters
+    ----------
+    index_path : str
+        absolute path to the index file
+    varnames : list
+        of str with slip components
+    shapes : list
+        of tuples (n_observations, n_patches) for each dataset
+    dtype : str
+        data type of the matrixes
+    meta : dict
+        optional, JSON serialisable information stored in the index file,
+        see :func:`load_linear_gfs_meta`
+
+    Returns
+    -------
+    dict of slip components with lists of writable
+    :class:`numpy.memmap` for each dataset
+    """
+    dirname = os.path.dirname(index_path)
+
+    index = {
+        'dtype': dtype,
+        'shapes': [list(shape) for shape in shapes],
+        'files': {},
+        'meta': meta}
+
+    gfs = {}
+    for var in varnames:
+        index['files'][var] = []
+        gfs[var] = []
+        for i, shape in enumerate(shapes):
+            filename = _linear_gf_filename(index_path, var, i)
+            index['files'][var].append(filename)
+            gfs[var].append(num.lib.format.open_memmap(
+                os.path.join(dirname, filename), mode='w+',
+                dtype=dtype, shape=tuple(shape)))
+
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+
+    return gfs
+
+
+def dump_linear_gfs(index_path, gfs):
+    """
+    Store linear Green's Function matrixes as library of (.npy) matrixes
+    with a JSON index file.
+
+    Parameters
+    ----------
+    index_path : str
+        absolute path to the index file
+    gfs : dict
+        of slip components with lists of :class:`numpy.ndarray`
+        (n_observations x n_patches) for each dataset
+    """
+    varnames = gfs.keys()
+    shapes = [gf.shape for gf in gfs[varnames[0]]]
+    out_gfs = init_linear_gfs(index_path, varnames, shapes)
+
+    for var in varnames:
+        for out_gf, gf in zip(out_gfs[var], gfs[var]):
+            out_gf[:] = gf
+            out_gf.flush()
+
+
+def load_linear_gfs(index_path, mmap_mode='r'):
+    """
+    Load linear Green's Function matrixes from a library created with
+    :func:`dump_linear_gfs` or :func:`init_linear_gfs`.
+    By default the matrixes are memory-mapped read-only, so that the memory
+    is shared between forked processes and only read when needed.
+
+    Parameters
+    ----------
+    index_path : str
+        absolute path to the index file
+    mmap_mode : str
+        see :func:`numpy.load`, if None the matrixes are read to memory
+
+    Returns
+    -------
+    dict of slip components with lists of :class:`numpy.ndarray`
+    (n_observations x n_patches) for each dataset
+    """
+    dirname = os.path.dirname(index_path)
+
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    gfs = {}
+    for var, filenames in index['files'].iteritems():
+        gfs[str(var)] = [
+            num.load(os.path.join(dirname, filename), mmap_mode=mmap_mode)
+            for filename in filenames]
+
+    return gfs
+
+
+def load_linear_gfs_meta(index_path):
+    """
+    Load the additional information stored with a library of linear
+    Green's Function matrixes, see :func:`init_linear_gfs`.
+
+    Parameters
+    ----------
+    index_path : str
+        absolute path to the index file
+
+    Returns
+    -------
+    dict or None
+    """
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    return index.get('meta', None)
+
+
+def _linear_gf_chunk_marker(index_path, var, ichunk):
+    return '%s_%s_%i.todo' % (os.path.splitext(index_path)[0], var, ichunk)
+
+
+def _process_linear_gf_chunk(
+        store_superdirs, index_path, var, ichunk, patch_slice, sources,
+        targets, los_vectors, odws):
+    """
+    Worker process: calculates the GFs for a chunk of patches in one request
+    and writes them to the memory-mapped output matrixes.
+    """
+    engine = gf.LocalEngine(store_superdirs=store_superdirs)
+    out_gfs = load_linear_gfs(index_path, mmap_mode='r+')[var]
+
+    disp = geo_synthetics(
+        engine=engine,
+        targets=targets,
+        sources=sources,
+        outmode='arrays')
+
+    # line of sight displacements of all datasets (n_patches x n_obs)
+    los_disp = num.vstack(
+        [(d * los_vectors).sum(axis=1) for d in disp]) * odws
+
+    i = 0
+    for out_gf in out_gfs:
+        n = out_gf.shape[0]
+        out_gf[:, patch_slice] = los_disp[:, i:i + n].T
+        out_gf.flush()
+        i += n
+
+    engine.close_cashed_stores()
+
+    # mark chunk as finished for resuming
+    os.remove(_linear_gf_chunk_marker(index_path, var, ichunk))
+    return ichunk
+
+
 def geo_construct_gf_linear(
         engine, outpath, crust_ind=0, datasets=None,
-        targets=None, fault=None, varnames=[''], force=False):
+        targets=None, fault=None, varnames=[''], force=False,
+        nworkers=1, chunksize=100):
     """
     Create geodetic Greens Function matrix for defined source geometry.
+    The patches are calculated in chunks of patches in one request each,
+    in parallel. The results are written directly into preallocated,
+    memory-mapped matrixes. Finished chunks are marked, so that an
+    interrupted calculation is resumed where it stopped.
 
     Parameters
     ----------
     engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
         main path to directory containing the different Greensfunction stores
     outpath : str
-        absolute path to the directory and filename where to store the
-        Green's Functions
+        absolute path to the directory and filename of the index file of the
+        Green's Functions library, see :func:`dump_linear_gfs`
     crust_ind : int
         of index of Greens Function store to use
     datasets : list
@@ -2043,38 +3219,448 @@ def geo_construct_gf_linear(
         of str with variable names that are being optimized for
     force : bool
         Force to overwrite existing files.
+    nworkers : int
+        number of processes to use
+    chunksize : int
+        number of patches to calculate in one request
     """
 
+    n_patches = fault.nsubpatches
+    chunks = [slice(i, min(i + chunksize, n_patches))
+              for i in range(0, n_patches, chunksize)]
+
+    def unfinished(var):
+        return [ichunk for ichunk in range(len(chunks))
+                if os.path.exists(
+                    _linear_gf_chunk_marker(outpath, var, ichunk))]
+
     if os.path.exists(outpath) and not force:
-        logger.info("Green's Functions exist! Use --force to"
-                    " overwrite!")
+        if not any(unfinished(var) for var in varnames):
+            logger.info("Green's Functions exist! Use --force to"
+                        " overwrite!")
+            return
+
+        logger.info("Resuming Green's Functions calculation ...")
     else:
-        out_gfs = {}
         for var in varnames:
-            logger.debug('For slip component: %s' % var)
+            for ichunk in range(len(chunks)):
+                marker = _linear_gf_chunk_marker(outpath, var, ichunk)
+                open(marker, 'w').close()
+
+        logger.info("Initialising Green's Functions in %s" % outpath)
+        init_linear_gfs(
+            outpath, varnames,
+            shapes=[(data.samples, n_patches) for data in datasets])
+
+    # one request for all datasets
+    targets = merge_geodetic_targets(targets)
+    if len(targets) > 1:
+        raise ValueError(
+            "Targets of all datasets have to use the same Green's Function"
+            " store!")
+
+    los_vectors = num.vstack([data.los_vector for data in datasets])
+    odws = num.hstack([data.odw for data in datasets])
+
+    for var in varnames:
+        logger.info('For slip component: %s' % var)
+        patches = fault.get_all_patches('geodetic', var)
+
+        ichunks = unfinished(var)
+        logger.info(
+            'Calculating %i of %i chunks with %i patches each' % (
+                len(ichunks), len(chunks), chunksize))
+
+        workpackage = [(
+            engine.store_superdirs, outpath, var, ichunk, chunks[ichunk],
+            patches[chunks[ichunk]], targets, los_vectors, odws)
+            for ichunk in ichunks]
+
+        t0 = time()
+        for results in paripool.paripool(
+                _process_linear_gf_chunk, workpackage,
+                nprocs=nworkers, chunksize=1, initmessage=False):
+            pass
+
+        t1 = time()
+        logger.info('Calculation time %f' % (t1 - t0))
+
+        missing = unfinished(var)
+        if missing:
+            raise Exception(
+                'Calculation of chunks %s failed! Re-run to resume.' %
+                utility.list2string(missing))
+
+    logger.info("Finished Green's Functions in %s" % outpath)
 
-            gfs = []
-            for source in fault.get_all_patches('geodetic', var):
-                disp = geo_synthetics(
-                    engine=engine,
-                    targets=targets,
-                    sources=[source],
-                    outmode='stacked_arrays')
 
-                gfs_data = []
-                for d, data in zip(disp, datasets):
-                    logger.debug('Target %s' % data.__str__())
-                    gfs_data.append((
-                        d[:, 0] * data.los_vector[:, 0] +
-                        d[:, 1] * data.los_vector[:, 1] +
-                        d[:, 2] * data.los_vector[:, 2]) *
-                        data.odw)
+def _trace_to_window(tr, tmin, n_samples, filterer=None):
+    """
+    Filter trace and return its samples starting at tmin as array of fixed
+    length, zero-padded where the trace does not cover the window.
+    """
+    deltat = tr.deltat
+    tr.extend(
+        tmin - deltat, tmin + (n_samples + 1) * deltat, fillmethod='zeros')
+
+    if filterer is not None:
+        tr.bandpass(
+            corner_hp=filterer.lower_corner,
+            corner_lp=filterer.upper_corner,
+            order=filterer.order)
+
+    i0 = int(round((tmin - tr.tmin) / deltat))
+    ydata = num.zeros(n_samples)
+    window = tr.ydata[i0:i0 + n_samples]
+    ydata[:window.size] = window
+    return ydata
 
-                gfs.append(num.vstack(gfs_data).T)
 
-        out_gfs[var] = gfs
-        logger.info("Dumping Green's Functions to %s" % outpath)
-        utility.dump_objects(outpath, [out_gfs])
+def seis_construct_gf_linear(
+        engine, outpath, fault, targets, reference_taperers, varnames,
+        sample_rate, max_time_shift, filterer=None, force=False,
+        chunksize=100):
+    """
+    Create library of seismic Green's Function traces for unit slip of each
+    patch of the fault geometry at each target for one waveform type.
+
+    The traces are filtered, but not tapered and start max_time_shift
+    before the reference taper, so that they may be shifted by the rupture
+    onset times and convolved with the source time functions of the patches,
+    see :class:`SeismicGFLibrary`. The traces of a chunk of patches are
+    calculated in one request and written into preallocated, memory-mapped
+    (n_targets x n_patches x n_samples) arrays, one for each slip component.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+    outpath : str
+        absolute path to the directory and filename of the index file of the
+        Green's Functions library
+    fault : :class:`FaultGeometry`
+        fault object that may comprise of several sub-faults
+    targets : list
+        of :class:`pyrocko.gf.seismosizer.Target` of the waveform type
+    reference_taperers : list
+        of :class:`pyrocko.trace.CosTaper` for each target, with respect to
+        the reference event
+    varnames : list
+        of str with slip components
+    sample_rate : float
+        of the Green's Functions [Hz]
+    max_time_shift : float
+        [s] maximum of rupture onset time plus source time function duration
+        of the patches
+    filterer : :class:`Filterer`
+    force : bool
+        Force to overwrite existing files.
+    chunksize : int
+        number of patches to calculate in one request
+    """
+
+    if os.path.exists(outpath) and not force:
+        logger.info("Green's Functions exist! Use --force to overwrite!")
+        return
+
+    deltat = 1. / sample_rate
+    n_shift = int(num.ceil(max_time_shift / deltat))
+    n_samples = int(num.ceil(sample_rate * (
+        num.max([tap.d - tap.a for tap in reference_taperers]))))
+
+    # snap to the sampling of the GF stores
+    tmins = [round(tap.a / deltat) * deltat for tap in reference_taperers]
+
+    meta = dict(
+        deltat=deltat,
+        tmins=tmins,
+        n_samples=n_samples,
+        n_shift=n_shift,
+        tapers=[[tap.a, tap.b, tap.c, tap.d] for tap in reference_taperers])
+
+    n_patches = fault.nsubpatches
+    n_gf_samples = n_samples + n_shift
+
+    logger.info("Initialising Green's Functions in %s" % outpath)
+    out_gfs = init_linear_gfs(
+        outpath, varnames,
+        shapes=[(len(targets), n_patches, n_gf_samples)],
+        meta=meta)
+
+    nt = len(targets)
+    for var in varnames:
+        logger.info('For slip component: %s' % var)
+        patches = fault.get_all_patches('seismic', var)
+        out_gf = out_gfs[var][0]
+
+        t0 = time()
+        for start in range(0, n_patches, chunksize):
+            chunk = patches[start:start + chunksize]
+            for patch in chunk:
+                patch.slip = 1.
+                patch.stf = None
+
+            response = engine.process(sources=chunk, targets=targets)
+            for i, (_, _, tr) in enumerate(response.iter_results()):
+                k, l = divmod(i, nt)
+                out_gf[l, start + k, :] = _trace_to_window(
+                    tr, tmins[l] - n_shift * deltat, n_gf_samples,
+                    filterer=filterer)
+
+            out_gf.flush()
+            logger.info('Finished %i of %i patches' % (
+                min(start + chunksize, n_patches), n_patches))
+
+        t1 = time()
+        logger.info('Calculation time %f' % (t1 - t0))
+
+    # spectra for the synthetics
+    SeismicGFLibrary(outpath)
+    logger.info("Finished Green's Functions in %s" % outpath)
+
+
+class SeismicGFLibrary(object):
+    """
+    Library of seismic Green's Function traces for unit slip of each patch
+    at each target, see :func:`seis_construct_gf_linear`.
+
+    Synthetics are assembled by shifting the patch traces by their rupture
+    onset times, convolving them with the source time functions and summing
+    over patches and slip components. This is done in the frequency
+    domain, where shifts and convolutions are products. The spectra of the
+    traces do not depend on the source parameters, they are calculated once
+    and stored memory-mapped next to the traces (see :meth:`load_spectra`).
+    The synthetics are assembled for chunks of targets, so that only the
+    spectra of one chunk are held in memory.
+
+    Parameters
+    ----------
+    index_path : str
+        absolute path to the index file of the library
+    mmap_mode : str
+        see :func:`load_linear_gfs`
+    target_chunksize : int
+        number of targets that are processed at once
+    """
+
+    def __init__(self, index_path, mmap_mode='r', target_chunksize=10):
+        self.index_path = index_path
+        self.mmap_mode = mmap_mode
+        self.target_chunksize = target_chunksize
+        self.gfs = {var: gfs[0] for var, gfs in load_linear_gfs(
+            index_path, mmap_mode=mmap_mode).iteritems()}
+
+        meta = load_linear_gfs_meta(index_path)
+        self.deltat = meta['deltat']
+        self.tmins = num.array(meta['tmins'])
+        self.n_samples = meta['n_samples']
+        self.n_shift = meta['n_shift']
+        self.tapers = [trace.CosTaper(*tap) for tap in meta['tapers']]
+
+        self.n_targets, self.n_patches, n_gf_samples = \
+            self.gfs.values()[0].shape
+
+        # avoid wrap around of shifted traces
+        self.nfft = int(2 ** num.ceil(
+            num.log2(n_gf_samples + self.n_shift)))
+        self.omega = 2. * num.pi * num.fft.rfftfreq(
+            self.nfft, d=self.deltat)
+
+        self._windows = None
+        self._clipping_reported = False
+        self.spectra = self.load_spectra()
+
+    def __getstate__(self):
+        # the memory-mapped traces and spectra are re-opened from the files
+        state = self.__dict__.copy()
+        state['gfs'] = None
+        state['spectra'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.gfs = {var: gfs[0] for var, gfs in load_linear_gfs(
+            self.index_path, mmap_mode=self.mmap_mode).iteritems()}
+        self.spectra = self.load_spectra()
+
+    @property
+    def varnames(self):
+        return self.gfs.keys()
+
+    @property
+    def max_time_shift(self):
+        return self.n_shift * self.deltat
+
+    def get_spectra_path(self, var):
+        return os.path.join(
+            os.path.dirname(self.index_path), '%s_%s_spectra.npy' % (
+                os.path.splitext(os.path.basename(self.index_path))[0], var))
+
+    def _calc_spectra(self, gf, out):
+        for start in range(0, self.n_targets, self.target_chunksize):
+            stop = min(start + self.target_chunksize, self.n_targets)
+            out[start:stop] = num.fft.rfft(gf[start:stop], n=self.nfft, axis=2)
+
+        return out
+
+    def load_spectra(self):
+        """
+        Load the spectra (n_targets x n_patches x n_frequencies) of the
+        traces of each slip component. They are calculated and stored
+        if they do not exist or are older than the traces.
+
+        Returns
+        -------
+        dict of slip components with :class:`numpy.ndarray`
+        """
+        shape = (self.n_targets, self.n_patches, self.omega.size)
+
+        spectra = {}
+        dirname = os.path.dirname(self.index_path)
+        for var, gf in self.gfs.iteritems():
+            path = self.get_spectra_path(var)
+            gf_path = os.path.join(
+                dirname, _linear_gf_filename(self.index_path, var, 0))
+            dtype = num.result_type(gf.dtype, num.complex64)
+
+            if os.path.exists(path) and \
+                    os.path.getmtime(path) >= os.path.getmtime(gf_path):
+                spectrum = num.load(path, mmap_mode=self.mmap_mode)
+                if spectrum.shape == shape:
+                    spectra[var] = spectrum
+                    continue
+
+            logger.info(
+                "Calculating spectra of the Green's Functions for %s" % var)
+
+            # write to temporary file, concurrent processes may race
+            tmp_path = '%s.tmp%i' % (path, os.getpid())
+            try:
+                out = num.lib.format.open_memmap(
+                    tmp_path, mode='w+', dtype=dtype, shape=shape)
+            except (IOError, OSError) as e:
+                logger.warning(
+                    'Cannot store spectra in %s, keeping them in memory: %s' %
+                    (path, e))
+                spectra[var] = self._calc_spectra(
+                    gf, num.empty(shape, dtype=dtype))
+                continue
+
+            self._calc_spectra(gf, out).flush()
+            del out
+            os.rename(tmp_path, path)
+            spectra[var] = num.load(path, mmap_mode=self.mmap_mode)
+
+        return spectra
+
+    def get_taper_windows(self):
+        """
+        Taper values (n_targets x n_samples) of the output samples.
+        """
+        if self._windows is None:
+            windows = []
+            for tmin, taper in zip(self.tmins, self.tapers):
+                tr = trace.Trace(
+                    tmin=tmin, deltat=self.deltat,
+                    ydata=num.ones(self.n_samples))
+                tr.taper(taper, inplace=True)
+                windows.append(tr.ydata)
+
+            self._windows = num.vstack(windows)
+
+        return self._windows
+
+    def get_stf_spectra(self, durations, stf_type='boxcar'):
+        """
+        Spectra (n_patches x n_frequencies) of causal source time functions
+        of unit area, starting at the rupture onset.
+
+        Parameters
+        ----------
+        durations : :class:`numpy.ndarray`
+            (n_patches) of source time function durations [s]
+        stf_type : str
+            'boxcar' or 'triangular'
+        """
+        x = self.omega[num.newaxis, :] * durations[:, num.newaxis] / \
+            (2. * num.pi)
+        if stf_type == 'boxcar':
+            amplitudes = num.sinc(x)
+        elif stf_type == 'triangular':
+            amplitudes = num.sinc(x / 2.) ** 2
+        else:
+            raise TypeError('STF type "%s" not supported!' % stf_type)
+
+        return amplitudes * num.exp(
+            -1.j * self.omega[num.newaxis, :] *
+            durations[:, num.newaxis] / 2.)
+
+    def synthetics(self, slips, rupture_times, durations, stf_type='boxcar'):
+        """
+        Synthetic waveforms for a kinematic rupture.
+
+        Parameters
+        ----------
+        slips : dict
+            of slip components with :class:`numpy.ndarray` (n_patches) [m]
+        rupture_times : :class:`numpy.ndarray`
+            (n_patches) rupture onset times [s] after the reference event
+            time
+        durations : :class:`numpy.ndarray`
+            (n_patches) of source time function durations [s]
+        stf_type : str
+            'boxcar' or 'triangular'
+
+        Returns
+        -------
+        :class:`numpy.ndarray` (n_targets x n_samples)
+            tapered synthetics, starting at tmins
+
+        Notes
+        -----
+        Source time functions that would end after the maximum time shift of
+        the library are moved to end at the maximum time shift, as they would
+        wrap around otherwise. This changes the forward model, a warning is
+        logged the first time it happens.
+        """
+        max_shift = self.max_time_shift
+        durations = num.asarray(durations, dtype=num.float64)
+        rupture_times = num.asarray(rupture_times, dtype=num.float64)
+
+        if num.any(durations > max_shift) or \
+                num.any(rupture_times + durations > max_shift) or \
+                num.any(rupture_times < 0.):
+            if not self._clipping_reported:
+                logger.warning(
+                    'Rupture times and durations exceed the maximum time'
+                    ' shift %f s of the library %s, clipping! Increase the'
+                    ' duration or velocity bounds of the library.' % (
+                        max_shift, self.index_path))
+                self._clipping_reported = True
+
+            durations = num.clip(durations, 0., max_shift)
+            rupture_times = num.clip(rupture_times, 0., max_shift - durations)
+
+        sources = self.get_stf_spectra(durations, stf_type) * num.exp(
+            -1.j * self.omega[num.newaxis, :] *
+            rupture_times[:, num.newaxis])
+
+        # slip components share the source time functions
+        slip_sources = dict(
+            (var, num.asarray(slip)[:, num.newaxis] * sources)
+            for var, slip in slips.iteritems())
+
+        spectra = num.zeros(
+            (self.n_targets, self.omega.size), dtype=num.complex128)
+        for start in range(0, self.n_targets, self.target_chunksize):
+            stop = min(start + self.target_chunksize, self.n_targets)
+            for var, slip_source in slip_sources.iteritems():
+                spectra[start:stop] += num.einsum(
+                    'tpf,pf->tf', self.spectra[var][start:stop], slip_source)
+
+        synths = num.fft.irfft(spectra, n=self.nfft, axis=1)[
+            :, self.n_shift:self.n_shift + self.n_samples]
+
+        return synths * self.get_taper_windows()
 
 
 def get_phase_arrival_time(engine, source, target, wavename):
@@ -2465,8 +4051,9 @@ def seis_synthetics(engine, sources, targets, arrival_taper=None,
     wavename : string
         of the tabulated phase that determines the phase arrival
     filterer : :class:`Filterer`
-    reference_taperer : :class:`ArrivalTaper`
+    reference_taperer : :class:`ArrivalTaper` or list
         if set all the traces are tapered with the specifications of this Taper
+        if list, one taper for each target
     plot : boolean
         flag for looking at traces
     nprocs : int
@@ -2497,9 +4084,11 @@ def seis_synthetics(engine, sources, targets, arrival_taper=None,
 
     taperers = []
     tapp = taperers.append
-    for target in targets:
+    for i, target in enumerate(targets):
         if arrival_taper is not None:
-            if reference_taperer is None:
+            if isinstance(reference_taperer, list):
+                tapp(reference_taperer[i])
+            elif reference_taperer is None:
                 tapp(get_phase_taperer(
                     engine=engine,
                     source=sources[0],
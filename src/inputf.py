@@ -1,12 +1,15 @@
 import scipy.io
 import numpy as num
-import copy
 
 from beat import heart, utility
-from pyrocko import model, io
+from pyrocko import model, io, util
 
 import os
+import shutil
+import hashlib
 import logging
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 logger = logging.getLogger('inputf')
 
@@ -63,7 +66,7 @@ def load_SAR_data(datadir, names):
     Returns Diff_IFG objects.
     """
     diffgs = []
-    tobeloaded_names = set(copy.deepcopy(names))
+    tobeloaded_names = set(names)
 
     for k in names:
         # open matlab.mat files
@@ -105,28 +108,206 @@ def load_SAR_data(datadir, names):
     return diffgs
 
 
-def load_kite_scenes(datadir, names):
+kite_scene_extensions = ('.yml', '.npz')
+
+
+def _kite_scene_basepath(datadir, name):
+    basepath = os.path.join(datadir, name)
+    if os.path.splitext(basepath)[1] in kite_scene_extensions:
+        basepath = os.path.splitext(basepath)[0]
+
+    return basepath
+
+
+def get_kite_cache_key(basepath, n_leaves_max=None):
+    """
+    Hash of the kite scene files, i.e. the displacement data and the scene
+    configuration including the quadtree and covariance parameters, and of
+    the re-tiling parameter.
+
+    Parameters
+    ----------
+    basepath : str
+        path to the kite scene without file extension
+    n_leaves_max : int
+        maximum number of quadtree leaves, see :func:`retile_kite_quadtree`
+
+    Returns
+    -------
+    str, hexadecimal sha1 digest
+    """
+    h = hashlib.sha1()
+    h.update('n_leaves_max=%s' % n_leaves_max)
+
+    for ext in kite_scene_extensions:
+        path = basepath + ext
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    h.update(chunk)
+
+    return h.hexdigest()
+
+
+def retile_kite_quadtree(quadtree, n_leaves_max, max_iter=10):
+    """
+    Coarsen the quadtree of a kite scene by increasing the variance threshold
+    epsilon, until it has at most n_leaves_max leaves. The quadtree is only
+    changed if it has more leaves.
+
+    Parameters
+    ----------
+    quadtree : :class:`kite.Quadtree`
+    n_leaves_max : int
+        maximum number of leaves
+    max_iter : int
+        number of bisection steps for epsilon
+    """
+    n_leaves = quadtree.nleaves
+    if n_leaves <= n_leaves_max:
+        return
+
+    eps_low = eps_high = quadtree.epsilon
+    for i in range(30):
+        eps_high *= 2.
+        quadtree.epsilon = eps_high
+        if quadtree.nleaves <= n_leaves_max:
+            break
+    else:
+        raise ValueError(
+            'Quadtree cannot be coarsened to %i leaves!' % n_leaves_max)
+
+    # smallest epsilon that satisfies the leaf count
+    for i in range(max_iter):
+        eps = num.sqrt(eps_low * eps_high)
+        quadtree.epsilon = eps
+        if quadtree.nleaves <= n_leaves_max:
+            eps_high = eps
+        else:
+            eps_low = eps
+
+    quadtree.epsilon = eps_high
+    logger.info(
+        'Re-tiled quadtree from %i to %i leaves, epsilon: %g' % (
+            n_leaves, quadtree.nleaves, eps_high))
+
+
+def load_kite_scene(datadir, name, cache_dir=None, n_leaves_max=None):
+    """
+    Load SAR data of one scene from the kite format and convert it to a
+    :class:`heart.DiffIFG`. If a cache directory is given, the converted
+    quadtree leaves and the covariance matrix are stored there and re-used
+    as long as the scene files and n_leaves_max are the same. Raises an
+    IOError if none of the scene files exists.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory of the scene
+    name : str
+        name of the scene
+    cache_dir : str
+        path to the cache directory, if None nothing is cached
+    n_leaves_max : int
+        if given, the quadtree is re-tiled to have at most this number of
+        leaves, see :func:`retile_kite_quadtree`
+
+    Returns
+    -------
+    :class:`heart.DiffIFG`
+    """
+    basepath = _kite_scene_basepath(datadir, name)
+
+    if not any(os.path.exists(basepath + ext)
+               for ext in kite_scene_extensions):
+        raise IOError('Kite scene %s does not exist!' % basepath)
+
+    if cache_dir is not None:
+        cache_path = os.path.join(
+            cache_dir, get_kite_cache_key(basepath, n_leaves_max))
+        if os.path.exists(cache_path):
+            logger.info('Loading cached scene %s from %s' % (name, cache_path))
+            return heart.load_geodetic_data(cache_path, mmap_mode=None)[0]
+
+    from kite import Scene
+
+    sc = Scene.load(basepath)
+    if n_leaves_max is not None:
+        retile_kite_quadtree(sc.quadtree, n_leaves_max)
+
+    diffg = heart.DiffIFG.from_kite_scene(sc)
+
+    if cache_dir is not None:
+        # write to temporary directory, concurrent imports may race
+        tmp_path = '%s.tmp%i' % (cache_path, os.getpid())
+        heart.dump_geodetic_data(tmp_path, [diffg])
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            shutil.rmtree(tmp_path)
+
+    return diffg
+
+
+def _load_kite_scene(args):
+    datadir, name, cache_dir, n_leaves_max = args
+    try:
+        return load_kite_scene(
+            datadir, name, cache_dir=cache_dir, n_leaves_max=n_leaves_max)
+    except ImportError:
+        logger.warning('File %s not conform with kite format!' % name)
+        return None
+    except IOError as e:
+        logger.warning(str(e))
+        return None
+
+
+def load_kite_scenes(datadir, names, cache_dir=None, n_leaves_max=None,
+                     nworkers=1):
     """
     Load SAR data from the kite format.
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory of the scenes
+    names : list
+        of str, names of the scenes
+    cache_dir : str
+        path to the cache directory, see :func:`load_kite_scene`
+    n_leaves_max : int
+        maximum number of quadtree leaves, see :func:`retile_kite_quadtree`
+    nworkers : int
+        number of processes loading scenes in parallel
+
+    Returns
+    -------
+    list of :class:`heart.DiffIFG`
     """
     try:
-        from kite import Scene
+        from kite import Scene  # noqa
     except ImportError:
         raise ImportError(
             'kite not installed! please checkout www.pyrocko.org!')
 
-    diffgs = []
-    tobeloaded_names = set(copy.deepcopy(names))
-    for k in names:
+    if cache_dir is not None:
+        util.ensuredir(cache_dir)
+
+    workpackage = [
+        (datadir, name, cache_dir, n_leaves_max) for name in names]
+
+    if nworkers > 1 and len(workpackage) > 1:
+        pool = multiprocessing.Pool(
+            processes=min(nworkers, len(workpackage)))
         try:
-            sc = Scene.load(os.path.join(datadir, k))
-            diffgs.append(heart.DiffIFG.from_kite_scene(sc))
-            tobeloaded_names.discard(k)
-        except ImportError:
-            logger.warning('File %s not conform with kite format!' % k)
+            diffgs = pool.map(_load_kite_scene, workpackage)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        diffgs = [_load_kite_scene(work) for work in workpackage]
 
-    names = list(tobeloaded_names)
-    return diffgs
+    return [diffg for diffg in diffgs if diffg is not None]
 
 
 def load_ascii_gps(filedir, filename):
@@ -140,28 +321,25 @@ def load_ascii_gps(filedir, filename):
     -------
     :class:`heart.GPSDataset`
     """
+    ncolumns = 9
+
     filepath = os.path.join(filedir, filename)
-    names = num.loadtxt(filepath, usecols=[0], dtype='string')
-    d = num.loadtxt(filepath, usecols=range(1, 9), dtype='float')
+    with open(filepath, 'r') as f:
+        tokens = ' '.join(
+            line.split('#', 1)[0] for line in f).split()
 
-    if names.size != d.shape[0]:
+    if len(tokens) % ncolumns != 0:
         raise Exception('Number of stations and available data differs!')
 
-    data = heart.GPSDataset()
-    for i, name in enumerate(names):
+    table = num.array(tokens).reshape((-1, ncolumns))
+    d = table[:, 1:].astype(num.float64)
 
-        gps_station = heart.GPSStation(
-            name=str(name), lon=float(d[i, 0]), lat=float(d[i, 1]))
-        for j, comp in enumerate('ENU'):
-
-            gps_station.add_component(
-                heart.GPSComponent(
-                    name=comp,
-                    v=float(d[i, j + 2] / km),
-                    sigma=float(d[i, j + 5] / km)))
-        data.add_station(gps_station)
-
-    return data
+    return heart.GPSDataset.from_arrays(
+        names=table[:, 0],
+        lons=d[:, 0],
+        lats=d[:, 1],
+        v=d[:, 2:5] / km,
+        sigma=d[:, 5:8] / km)
 
 
 def load_and_blacklist_GPS(datadir, filename, blacklist):
@@ -188,13 +366,93 @@ def load_and_blacklist_stations(datadir, blacklist):
     return utility.apply_station_blacklist(stations, blacklist)
 
 
-def load_data_traces(datadir, stations, channels):
-    '''
+def _load_data_trace(args):
+    """
+    Load, scale and optionally downsample one data trace, returns None if the
+    file is missing or unreadable. Traces sampled coarser than deltat are
+    returned as they are and reported by :func:`check_data_sampling`.
+    """
+    tracepath, station, deltat, data_format = args
+
+    try:
+        with open(tracepath):
+            trs = io.load(tracepath, data_format)
+    except (IOError, io.FileLoadError):
+        logger.warn('Unable to open file: ' + os.path.basename(tracepath))
+        return None
+
+    if not trs:
+        logger.warn('No trace in file: ' + os.path.basename(tracepath))
+        return None
+
+    dt = trs[0]
+
+    # [nm] convert to m
+    dt.set_ydata(dt.ydata * m)
+    dt.station = station.station
+    dt.network = station.network
+    dt.location = '0'
+
+    if deltat is not None and dt.deltat < deltat * (1. - 1e-6):
+        utility.downsample_traces([dt], deltat=deltat)
+
+    # convert to BEAT seismic Dataset
+    return heart.SeismicDataset.from_pyrocko_trace(dt)
+
+
+def check_data_sampling(data_traces, deltat):
+    """
+    Check that none of the loaded traces is sampled coarser than deltat, as
+    they would have to be upsampled.
+
+    Parameters
+    ----------
+    data_traces : list
+        of :class:`heart.SeismicDataset`
+    deltat : float
+        sampling interval [s] the traces have been downsampled to
+    """
+    coarse = []
+    for tr in data_traces:
+        if tr.deltat > deltat * (1. + 1e-6):
+            coarse.append('%s (%g s)' % (
+                '.'.join(tr.nslc_id), tr.deltat))
+
+    if coarse:
+        raise ValueError(
+            'Sampling interval of %s is larger than the requested %g s!'
+            ' Not downsampling.' % (utility.list2string(coarse), deltat))
+
+
+def load_data_traces(datadir, stations, channels, deltat=None, nworkers=1):
+    """
     Load data traces for the given stations and channels.
-    '''
+
+    Parameters
+    ----------
+    datadir : str
+        path to the directory with the 'reference-NET-STA-cha.mseed' files
+    stations : list
+        of :class:`pyrocko.model.Station`
+    channels : list
+        of str, channel names 'Z', 'T', 'R'
+    deltat : float
+        sampling interval [s] the traces are downsampled to while loading,
+        if None the traces are not downsampled. Traces sampled coarser
+        raise a ValueError.
+    nworkers : int
+        number of threads reading the files concurrently
+
+    Returns
+    -------
+    list of :class:`heart.SeismicDataset`
+    """
     trc_name_divider = '-'
     data_format = 'mseed'
 
+    if deltat is not None and deltat <= 0.:
+        raise ValueError('Sampling interval has to be positive!')
+
     ref_channels = []
     for cha in channels:
         if cha == 'Z':
@@ -206,29 +464,29 @@ def load_data_traces(datadir, stations, channels):
         else:
             raise Exception('No data for this channel!')
 
-    # load recorded data
-    data_trcs = []
-
     # (r)ight transverse, (a)way radial, vertical (u)p
+    workpackage = []
     for ref_channel in ref_channels:
         for station in stations:
             trace_name = trc_name_divider.join(
                 ('reference', station.network, station.station, ref_channel))
 
             tracepath = datadir + trace_name + '.' + data_format
+            workpackage.append((tracepath, station, deltat, data_format))
 
-            try:
-                with open(tracepath):
-                    dt = io.load(tracepath, data_format)[0]
-                    # [nm] convert to m
-                    dt.set_ydata(dt.ydata * m)
-                    dt.station = station.station
-                    dt.network = station.network
-                    dt.location = '0'
-                    # convert to BEAT seismic Dataset
-                    data_trcs.append(
-                        heart.SeismicDataset.from_pyrocko_trace(dt))
-            except IOError:
-                logger.warn('Unable to open file: ' + trace_name)
+    # reading is I/O bound, threads are sufficient
+    if nworkers > 1 and len(workpackage) > 1:
+        pool = ThreadPool(min(nworkers, len(workpackage)))
+        try:
+            data_trcs = pool.map(_load_data_trace, workpackage)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        data_trcs = [_load_data_trace(work) for work in workpackage]
+
+    data_trcs = [trc for trc in data_trcs if trc is not None]
+    if deltat is not None:
+        check_data_sampling(data_trcs, deltat)
 
     return data_trcs
@@ -21,12 +21,11 @@ from beat.heart import geo_synthetics
 import numpy as num
 import logging
 import copy
+from collections import OrderedDict
 
 from pyrocko import orthodrome
 from pyrocko.gf import RectangularSource as RS
 
-from matplotlib.path import Path
-
 logger = logging.getLogger('interseismic')
 
 km = 1000.
@@ -35,15 +34,68 @@ r2d = 180. / num.pi
 
 non_source = set(['amplitude', 'azimuth', 'locking_depth'])
 
+# block masks for fault geometries and observation points
+_block_mask_cache = {}
+max_block_mask_cache_size = 20
+
+# unit backslip responses for quantized fault geometries
+_backslip_response_cache = {}
+max_backslip_response_cache_size = 1000
+
+backslip_geometry_quanta = OrderedDict([
+    ('lat', 1e-6),          # [deg]
+    ('lon', 1e-6),          # [deg]
+    ('north_shift', 1.),    # [m]
+    ('east_shift', 1.),     # [m]
+    ('depth', 1.),          # [m]
+    ('strike', 0.01),       # [deg]
+    ('dip', 0.01),          # [deg]
+    ('length', 1.),         # [m]
+    ('width', 1.)])         # [m]
+
 
 __all__ = ['geo_backslip_synthetics']
 
 
+def get_block_mask_key(coordinates, sources, reference):
+    """
+    Key of a block mask: the identities and shapes of the observation
+    coordinate arrays, the reference and the geometries of the sources.
+    The coordinate arrays must not be changed in place.
+    """
+    return (
+        tuple((id(c), c.shape) for c in coordinates),
+        tuple(float(r) for r in reference),
+        tuple(tuple(float(getattr(source, attr))
+                    for attr in backslip_geometry_quanta)
+              for source in sources))
+
+
+def _get_cached_block_mask(key):
+    cached = _block_mask_cache.get(key, None)
+    if cached is not None:
+        return cached[1]
+
+
+def _cache_block_mask(key, coordinates, mask):
+    if len(_block_mask_cache) >= max_block_mask_cache_size:
+        _block_mask_cache.clear()
+
+    mask.flags.writeable = False
+    # keep coordinates alive, so that their ids remain unique
+    _block_mask_cache[key] = (coordinates, mask)
+    return mask
+
+
 def block_mask(easts, norths, sources, east_ref, north_ref):
     """
     Determine stable and moving observation points dependend on the input
     fault orientation.
 
+    The mask only depends on the geometry, it is cached for the fault
+    geometries, the reference and the observation point arrays, which must
+    not be changed in place.
+
     Parameters
     ----------
     easts : :class:`numpy.ndarray`
@@ -65,9 +117,13 @@ def block_mask(easts, norths, sources, east_ref, north_ref):
     def get_vertex(outlines, i, j):
         f1 = outlines[i]
         f2 = outlines[j]
-        print f1, f2
         return utility.line_intersect(f1[0, :], f1[1, :], f2[0, :], f2[1, :])
 
+    key = get_block_mask_key((easts, norths), sources, (east_ref, north_ref))
+    mask = _get_cached_block_mask(key)
+    if mask is not None:
+        return mask
+
     tol = 2. * km
 
     Eline = RS(
@@ -95,19 +151,17 @@ def block_mask(easts, norths, sources, east_ref, north_ref):
     else:
         poly_vertices.append(get_vertex(outlines, 0, -1))
 
-    print poly_vertices, outlines
-    polygon = Path(num.vstack(poly_vertices), closed=True)
+    vertices = num.vstack(poly_vertices)
 
     ens = num.vstack([easts.flatten(), norths.flatten()]).T
-    ref_en = num.array([east_ref, north_ref]).flatten()
-    print ens
-    mask = polygon.contains_points(ens)
+    ref_en = num.array([[east_ref, north_ref]], dtype=num.float64)
 
-    if not polygon.contains_point(ref_en):
-        return mask
+    mask = utility.points_in_polygon(ens, vertices)
 
-    else:
-        return num.logical_not(mask)
+    if utility.points_in_polygon(ref_en, vertices)[0]:
+        mask = num.logical_not(mask)
+
+    return _cache_block_mask(key, (easts, norths), mask)
 
 
 def block_geometry(lons, lats, sources, reference):
@@ -132,10 +186,18 @@ def block_geometry(lons, lats, sources, reference):
         mask with zeros/ones for stable/moving observation points, respectively
     """
 
+    key = get_block_mask_key(
+        (lons, lats), sources, (reference.lat, reference.lon))
+    mask = _get_cached_block_mask(key)
+    if mask is not None:
+        return mask
+
     norths, easts = orthodrome.latlon_to_ne_numpy(
         reference.lat, reference.lon, lats, lons)
 
-    return block_mask(easts, norths, sources, east_ref=0., north_ref=0.)
+    return _cache_block_mask(
+        key, (lons, lats),
+        block_mask(easts, norths, sources, east_ref=0., north_ref=0.))
 
 
 def block_movement(bmask, amplitude, azimuth):
@@ -158,10 +220,8 @@ def block_movement(bmask, amplitude, azimuth):
          (n x 3) [North, East, Down] displacements [m]
     """
 
-    tmp = num.repeat(
-        bmask * 2. * float(amplitude), 3).reshape((bmask.shape[0], 3))
     sv = utility.strike_vector(float(azimuth), order='NEZ')
-    return tmp * sv
+    return num.outer(bmask * 2. * float(amplitude), sv)
 
 
 def geo_block_synthetics(lons, lats, sources, amplitude, azimuth, reference):
@@ -246,6 +306,100 @@ def backslip_params(azimuth, strike, dip, amplitude, locking_depth):
         depth=0., rake=float(rake))
 
 
+def backslip_coefficients(source_params):
+    """
+    Coefficients of the unit strike-slip (rake 0) and unit opening
+    responses of a back-slipping fault.
+
+    Parameters
+    ----------
+    source_params : dict
+        of parameters for the back-slipping RectangularSource, see
+        :func:`backslip_params`
+
+    Returns
+    -------
+    tuple of floats (strike-slip, opening)
+    """
+    if source_params['rake'] == 0.:
+        slip = source_params['slip']
+    else:
+        slip = -source_params['slip']
+
+    return slip, source_params['opening']
+
+
+def get_backslip_geometry_key(source):
+    """
+    Quantized geometry of a back-slipping fault, see
+    backslip_geometry_quanta.
+    """
+    return tuple(
+        int(round(float(getattr(source, attr)) / quantum))
+        for attr, quantum in backslip_geometry_quanta.iteritems())
+
+
+def get_backslip_responses(engine, sources, targets):
+    """
+    Get the displacements for unit strike-slip and unit opening of each
+    back-slipping fault. The displacements are linear in slip and opening,
+    so they are calculated once for each quantized fault geometry and
+    cached. Missing responses of all sources are calculated in one request.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+    sources : list
+        of :class:`pyrocko.gf.seismosizer.RectangularSource` with the
+        back-slipping geometry
+    targets : list
+        of :class:`pyrocko.gf.targets.StaticTarget`
+
+    Returns
+    -------
+    list of tuples of :class:`numpy.ndarray` (n x 3) (strike-slip, opening)
+    for each source
+    """
+    targets_key = tuple(id(target) for target in targets)
+
+    keys = [(targets_key, get_backslip_geometry_key(source))
+            for source in sources]
+
+    missing = utility.unique_list(
+        [key for key in keys if key not in _backslip_response_cache])
+
+    if missing:
+        if len(_backslip_response_cache) + len(missing) > \
+                max_backslip_response_cache_size:
+            _backslip_response_cache.clear()
+
+        unit_sources = []
+        for key in missing:
+            # snap to the quantized geometry
+            source = copy.deepcopy(sources[keys.index(key)])
+            source.update(**{
+                attr: value * quantum for (attr, quantum), value in zip(
+                    backslip_geometry_quanta.iteritems(), key[1])})
+
+            for unit in [dict(slip=1., opening=0.), dict(slip=0., opening=1.)]:
+                unit_source = copy.deepcopy(source)
+                unit_source.update(rake=0., **unit)
+                unit_sources.append(unit_source)
+
+        disp_arrays = geo_synthetics(
+            engine=engine, targets=targets, sources=unit_sources,
+            outmode='arrays')
+
+        nt = len(targets)
+        for i, key in enumerate(missing):
+            # keep targets alive, so that their ids remain unique
+            _backslip_response_cache[key] = (targets, tuple(
+                num.vstack(disp_arrays[k * nt:(k + 1) * nt])
+                for k in (2 * i, 2 * i + 1)))
+
+    return [_backslip_response_cache[key][1] for key in keys]
+
+
 def geo_backslip_synthetics(
     engine, sources, targets, lons, lats, reference,
     amplitude, azimuth, locking_depth):
@@ -258,6 +412,9 @@ def geo_backslip_synthetics(
     Based on this block-movement the upper part of the crust that is not locked
     is assumed to slip back. Thus the final synthetics are the superposition
     of the block-movement and the backslip.
+    The backslip is the superposition of cached unit responses, see
+    :func:`get_backslip_responses`, engine requests are only made for new
+    fault geometries.
 
     Parameters
     ----------
@@ -289,15 +446,19 @@ def geo_backslip_synthetics(
     disp_block = geo_block_synthetics(
         lons, lats, sources, amplitude, azimuth, reference)
 
+    coefficients = []
     for source, ld in zip(sources, locking_depth):
         source_params = backslip_params(
             azimuth=azimuth, amplitude=amplitude, locking_depth=ld,
             strike=source.strike, dip=source.dip)
         source.update(**source_params)
+        coefficients.append(backslip_coefficients(source_params))
+
+    responses = get_backslip_responses(engine, sources, targets)
 
-    disp_block += geo_synthetics(
-        engine=engine, targets=targets, sources=sources,
-        outmode='stacked_array')
+    for (slip, opening), (slip_disp, opening_disp) in zip(
+            coefficients, responses):
+        disp_block += slip * slip_disp + opening * opening_disp
 
     return disp_block
 
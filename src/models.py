@@ -1,7 +1,10 @@
 import os
+import sys
 import time
 import copy
 import shutil
+import hashlib
+from glob import glob
 
 import pymc3 as pm
 from pymc3 import Metropolis
@@ -11,12 +14,15 @@ from pyrocko.guts import Object
 
 import numpy as num
 
+import theano
 import theano.tensor as tt
+from theano.tensor import slinalg
 from theano import config as tconfig
 from theano import shared
 from theano.printing import Print
 
 from beat import theanof, heart, utility, smc, backend, metropolis
+from beat.fast_sweeping import fast_sweep
 from beat import covariance as cov
 from beat import config as bconfig
 from beat.interseismic import geo_backslip_synthetics, seperate_point
@@ -116,6 +122,133 @@ def multivariate_normal_chol(datasets, weights, hyperparams, residuals):
     return logpts
 
 
+def multivariate_normal_lowrank(
+        datasets, weights, lowrank_weights, hyperparams, residuals):
+    """
+    Calculate posterior Likelihood of a Multivariate Normal distribution.
+    Assumes the covariance matrix to be the sum of a full-rank part and
+    a low-rank part. The quadratic form is evaluated with the Woodbury
+    identity, the normalisation factor (data.covariance.slnf) with the
+    matrix determinant lemma.
+    Can only be executed in a `with model context`.
+
+    Parameters
+    ----------
+    datasets : list
+        of :class:`heart.GeodeticDataset`
+    weights : list
+        of :class:`theano.shared`
+        Inverse of the lower triangular matrix of the cholesky decomposed
+        full-rank part of the covariance matrix, or its diagonal (vector) if
+        the full-rank part is diagonal
+    lowrank_weights : list
+        of :class:`theano.shared`
+        n x k low-rank correction to the weights
+        (see :attr:`heart.Covariance.lowrank_weight`)
+    hyperparams : dict
+        of :class:`theano.`
+    residual : list or array of model residuals
+
+    Returns
+    -------
+    array_like
+    """
+    n_t = len(datasets)
+    logpts = tt.zeros((n_t), tconfig.floatX)
+
+    for l, data in enumerate(datasets):
+        M = tt.cast(shared(data.samples, borrow=True), 'int16')
+        hp_name = '_'.join(('h', data.typ))
+
+        if weights[l].ndim == 1:
+            tmp = weights[l] * residuals[l]
+        else:
+            tmp = weights[l].dot(residuals[l])
+
+        tmp_lr = lowrank_weights[l].T.dot(tmp)
+
+        logpts = tt.set_subtensor(logpts[l:l + 1],
+            (-0.5) * (data.covariance.slnf + \
+            (M * 2 * hyperparams[hp_name]) + \
+            (1 / tt.exp(hyperparams[hp_name] * 2)) * \
+            (tt.dot(tmp, tmp) - tt.dot(tmp_lr, tmp_lr))
+                     )
+                                 )
+
+    return logpts
+
+
+def multivariate_normal_whitened(
+        datasets, hyperparams, wresiduals, lowrank_weights=None):
+    """
+    Calculate posterior Likelihood of a Multivariate Normal distribution.
+    Assumes the residuals to be whitened already, i.e. multiplied with
+    the inverse cholesky decomposed lower triangle of the covariance matrix.
+    Can only be executed in a `with model context`.
+
+    Parameters
+    ----------
+    datasets : list
+        of :class:`heart.SeismicDataset` or :class:`heart.GeodeticDataset`
+    hyperparams : dict
+        of :class:`theano.`
+    wresiduals : list or array of whitened model residuals
+    lowrank_weights : list
+        of :class:`theano.shared` (optional)
+        n x k low-rank corrections of the whitening
+        (see :func:`multivariate_normal_lowrank`)
+
+    Returns
+    -------
+    array_like
+    """
+    n_t = len(datasets)
+    logpts = tt.zeros((n_t), tconfig.floatX)
+
+    for l, data in enumerate(datasets):
+        M = tt.cast(shared(data.samples, borrow=True), 'int16')
+        hp_name = '_'.join(('h', data.typ))
+        tmp = wresiduals[l]
+
+        norm = tt.dot(tmp, tmp)
+        if lowrank_weights is not None:
+            tmp_lr = lowrank_weights[l].T.dot(tmp)
+            norm -= tt.dot(tmp_lr, tmp_lr)
+
+        logpts = tt.set_subtensor(logpts[l:l + 1],
+            (-0.5) * (data.covariance.slnf + \
+            (M * 2 * hyperparams[hp_name]) + \
+            (1 / tt.exp(hyperparams[hp_name] * 2)) * norm
+                     )
+                                 )
+
+    return logpts
+
+
+def whiten(weight, a):
+    """
+    Multiply array with weight matrix or with diagonal weight vector.
+
+    Parameters
+    ----------
+    weight : :class:`numpy.ndarray`
+        n x n weight matrix or vector of its n diagonal elements
+    a : :class:`numpy.ndarray`
+        vector (n) or matrix (n x m)
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+    """
+    if weight.ndim == 1:
+        if a.ndim == 1:
+            return weight * a
+        else:
+            return weight[:, num.newaxis] * a
+    else:
+        return weight.dot(a)
+
+
 def hyper_normal(datasets, hyperparams, llks):
     """
     Calculate posterior Likelihood only dependent on hyperparameters.
@@ -168,6 +301,27 @@ def get_ramp_displacement(slocx, slocy, ramp):
     return slocy * ramp[0] + slocx * ramp[1]
 
 
+def get_prior_kwargs(sampler_name):
+    """
+    Keyword arguments for the uniform priors depending on the sampler.
+    NUTS samples in the unbounded space of the default pymc3 interval
+    transform, the other samplers sample the bounded priors directly.
+
+    Parameters
+    ----------
+    sampler_name : str
+        name of the sampler
+
+    Returns
+    -------
+    dict
+    """
+    if sampler_name == 'NUTS':
+        return {}
+    else:
+        return {'transform': None}
+
+
 class Composite(Object):
     """
     Class that comprises the rules to formulate the problem. Has to be
@@ -181,6 +335,7 @@ class Composite(Object):
         self.name = None
         self._like_name = None
         self.config = None
+        self.prior_kwargs = get_prior_kwargs(None)
 
     def get_hyper_formula(self, hyperparams):
         """
@@ -206,6 +361,10 @@ class Composite(Object):
             A = weight.get_value()
             self.weights[i].set_value(A)
 
+        if getattr(composite, 'lowrank_weights', None) is not None:
+            for i, weight in enumerate(composite.lowrank_weights):
+                self.lowrank_weights[i].set_value(weight.get_value())
+
 
 class GeodeticComposite(Composite):
     """
@@ -234,10 +393,10 @@ class GeodeticComposite(Composite):
         self.name = 'geodetic'
         self._like_name = 'geo_like'
 
-        geodetic_data_path = os.path.join(
-            project_dir, bconfig.geodetic_data_name)
-
-        self.datasets = utility.load_objects(geodetic_data_path)
+        self.datasets = heart.load_project_data(
+            os.path.join(project_dir, bconfig.geodetic_data_dir_name),
+            'geodetic',
+            pickle_path=os.path.join(project_dir, bconfig.geodetic_data_name))
 
         logger.info('Number of geodetic datasets: %i ' % self.n_t)
 
@@ -249,12 +408,30 @@ class GeodeticComposite(Composite):
                         ' covariances \n')
 
         self.weights = []
+        if gc.lowrank_covariance:
+            logger.info('Using low-rank velocity model covariances!')
+            n_var = len(range(*gc.gf_config.n_variations))
+            self.lowrank_weights = []
+        else:
+            self.lowrank_weights = None
+
         for data in self.datasets:
             if int(data.covariance.data.sum()) == data.ncoords:
                 logger.warn('Data covariance is identity matrix!'
                             ' Please double check!!!')
 
-            choli = data.covariance.chol_inverse
+            if gc.lowrank_covariance:
+                if not data.covariance.lowrank:
+                    data.covariance.pred_v_factor = num.zeros(
+                        (data.ncoords, n_var), dtype=tconfig.floatX)
+                    data.covariance.update_slnf()
+
+                choli = data.covariance.base_chol_inverse
+                self.lowrank_weights.append(shared(
+                    data.covariance.lowrank_weight, borrow=True))
+            else:
+                choli = data.covariance.chol_inverse
+
             self.weights.append(shared(choli, borrow=True))
 
         if gc.fit_plane:
@@ -300,7 +477,7 @@ class GeodeticComposite(Composite):
 
         logger.debug('Assembling geodetic data ...')
 
-        processed_synts = self.get_synthetics(point, outmode='stacked_arrays')
+        processed_synts = self.get_synthetics(point)
 
         results = []
         for i, data in enumerate(self.datasets):
@@ -313,13 +490,14 @@ class GeodeticComposite(Composite):
 
         return results
 
-    def remove_ramps(self, residuals):
+    def init_ramp_params(self):
         """
-        Remove an orbital ramp from the residual displacements
+        Initialise orbital ramp parameters for each SAR dataset.
+        Has to be executed in a "with model context"!
         """
         self.ramp_params = {}
 
-        for i, data in enumerate(self.datasets):
+        for data in self.datasets:
             if isinstance(data, heart.DiffIFG):
                 self.ramp_params[data.name] = pm.Uniform(
                     data.name + '_ramp',
@@ -327,11 +505,28 @@ class GeodeticComposite(Composite):
                     lower=bconfig.default_bounds['ramp'][0],
                     upper=bconfig.default_bounds['ramp'][1],
                     testval=0.,
-                    transform=None,
-                    dtype=tconfig.floatX)
+                    dtype=tconfig.floatX,
+                    **getattr(self, 'prior_kwargs', get_prior_kwargs(None)))
+
+        return self.ramp_params
+
+    def remove_ramps(self, residuals, slocx=None, slocy=None):
+        """
+        Remove an orbital ramp from the residual displacements.
+        Optionally with custom (e.g. whitened) local coordinates.
+        """
+        if slocx is None:
+            slocx = self._slocx
 
+        if slocy is None:
+            slocy = self._slocy
+
+        self.init_ramp_params()
+
+        for i, data in enumerate(self.datasets):
+            if isinstance(data, heart.DiffIFG):
                 residuals[i] -= get_ramp_displacement(
-                    self._slocx[i], self._slocy[i],
+                    slocx[i], slocy[i],
                     self.ramp_params[data.name])
 
         return residuals
@@ -348,11 +543,47 @@ class GeodeticComposite(Composite):
         """
         results = self.assemble_results(point)
         for l, result in enumerate(results):
-            choli = self.datasets[l].covariance.chol_inverse
-            tmp = choli.dot(result.processed_res)
-            _llk = num.asarray([num.dot(tmp, tmp)])
+            covariance = self.datasets[l].covariance
+            if covariance.lowrank:
+                choli = covariance.base_chol_inverse
+                if choli.ndim == 1:
+                    tmp = choli * result.processed_res
+                else:
+                    tmp = choli.dot(result.processed_res)
+
+                tmp_lr = covariance.lowrank_weight.T.dot(tmp)
+                _llk = num.asarray(
+                    [num.dot(tmp, tmp) - num.dot(tmp_lr, tmp_lr)])
+            else:
+                tmp = covariance.chol_inverse.dot(result.processed_res)
+                _llk = num.asarray([num.dot(tmp, tmp)])
+
             self._llks[l].set_value(_llk)
 
+    def get_logpts(self, hyperparams, residuals):
+        """
+        Get the likelihoods of the geodetic datasets for the given residuals,
+        depending on the structure of the covariance matrixes.
+
+        Parameters
+        ----------
+        hyperparams : dict
+            of :class:`pymc3.distribution.Distribution`
+        residuals : list
+            of :class:`theano.tensor.Tensor` residuals for each dataset
+
+        Returns
+        -------
+        logpts : :class:`theano.tensor.Tensor`
+        """
+        if self.lowrank_weights is not None:
+            return multivariate_normal_lowrank(
+                self.datasets, self.weights, self.lowrank_weights,
+                hyperparams, residuals)
+        else:
+            return multivariate_normal_chol(
+                self.datasets, self.weights, hyperparams, residuals)
+
 
 class GeodeticSourceComposite(GeodeticComposite):
     """
@@ -381,12 +612,14 @@ class GeodeticSourceComposite(GeodeticComposite):
         self.engine = gf.LocalEngine(
             store_superdirs=[gc.gf_config.store_superdir])
 
-        self.targets = heart.init_geodetic_targets(
-            datasets=self.datasets,
-            earth_model_name=gc.gf_config.earth_model_name,
-            interpolation='multilinear',
-            crust_inds=[gc.gf_config.reference_model_idx],
-            sample_rate=gc.gf_config.sample_rate)
+        # one target for all datasets, the results are split with Bij
+        self.targets = heart.merge_geodetic_targets(
+            heart.init_geodetic_targets(
+                datasets=self.datasets,
+                earth_model_name=gc.gf_config.earth_model_name,
+                interpolation='multilinear',
+                crust_inds=[gc.gf_config.reference_model_idx],
+                sample_rate=gc.gf_config.sample_rate))
 
         self.sources = sources
 
@@ -479,8 +712,7 @@ class GeodeticSourceComposite(GeodeticComposite):
         if self.config.fit_plane:
             residuals = self.remove_ramps(residuals)
 
-        logpts = multivariate_normal_chol(
-            self.datasets, self.weights, hyperparams, residuals)
+        logpts = self.get_logpts(hyperparams, residuals)
 
         llk = pm.Deterministic(self._like_name, logpts)
         return llk.sum()
@@ -500,6 +732,8 @@ class GeodeticGeometryComposite(GeodeticSourceComposite):
             sources=self.sources,
             targets=self.targets)
 
+        self._crust_targets = None
+
     def get_synthetics(self, point, **kwargs):
         """
         Get synthetics for given point in solution space.
@@ -508,19 +742,21 @@ class GeodeticGeometryComposite(GeodeticSourceComposite):
         ----------
         point : :func:`pymc3.Point`
             Dictionary with model parameters
-        kwargs especially to change output of the forward model
+        kwargs to :func:`heart.geo_synthetics`, except for outmode, the
+            synthetics are always mapped to the datasets
 
         Returns
         -------
-        list with :class:`numpy.ndarray` synthetics for each target
+        list with :class:`numpy.ndarray` synthetics for each dataset
         """
         self.point2sources(point)
 
-        displacements = heart.geo_synthetics(
+        kwargs['outmode'] = 'stacked_array'
+        displacements = self.Bij.r3map(heart.geo_synthetics(
             engine=self.engine,
             targets=self.targets,
             sources=self.sources,
-            **kwargs)
+            **kwargs))
 
         synths = []
         for disp, data in zip(displacements, self.datasets):
@@ -545,31 +781,53 @@ class GeodeticGeometryComposite(GeodeticSourceComposite):
 
         self.point2sources(point)
 
-        for i, data in enumerate(self.datasets):
-            crust_targets = heart.init_geodetic_targets(
-                datasets=[data],
-                earth_model_name=gc.gf_config.earth_model_name,
-                interpolation='nearest_neighbor',
-                crust_inds=range(*gc.gf_config.n_variations),
-                sample_rate=gc.gf_config.sample_rate)
+        if self._crust_targets is None:
+            self._crust_targets = heart.merge_geodetic_targets(
+                heart.init_geodetic_targets(
+                    datasets=self.datasets,
+                    earth_model_name=gc.gf_config.earth_model_name,
+                    interpolation='nearest_neighbor',
+                    crust_inds=range(*gc.gf_config.n_variations),
+                    sample_rate=gc.gf_config.sample_rate))
 
+        if plot:
+            for data in self.datasets:
+                cov.geodetic_cov_velocity_models(
+                    engine=self.engine,
+                    sources=self.sources,
+                    targets=heart.init_geodetic_targets(
+                        datasets=[data],
+                        earth_model_name=gc.gf_config.earth_model_name,
+                        interpolation='nearest_neighbor',
+                        crust_inds=range(*gc.gf_config.n_variations),
+                        sample_rate=gc.gf_config.sample_rate),
+                    dataset=data,
+                    plot=plot,
+                    event=self.event)
+
+        t0 = time.time()
+        factors = cov.geodetic_velocity_model_factors(
+            engine=self.engine,
+            sources=self.sources,
+            targets=self._crust_targets,
+            datasets=self.datasets)
+
+        for i, data in enumerate(self.datasets):
             logger.debug('Track %s' % data.name)
-            cov_pv = cov.geodetic_cov_velocity_models(
-                engine=self.engine,
-                sources=self.sources,
-                targets=crust_targets,
-                dataset=data,
-                plot=plot,
-                event=self.event,
-                n_jobs=1)
+            data.covariance.update_pred_v(
+                factors[i], lowrank=gc.lowrank_covariance)
 
-            cov_pv = utility.ensure_cov_psd(cov_pv)
+            if gc.lowrank_covariance:
+                self.lowrank_weights[i].set_value(
+                    data.covariance.lowrank_weight)
+            else:
+                self.weights[i].set_value(data.covariance.chol_inverse)
 
-            data.covariance.pred_v = cov_pv
-            choli = data.covariance.chol_inverse
-            self.weights[i].set_value(choli)
             data.covariance.update_slnf()
 
+        t1 = time.time()
+        logger.debug('Update weights time %f' % (t1 - t0))
+
 
 class GeodeticInterseismicComposite(GeodeticSourceComposite):
 
@@ -613,16 +871,17 @@ class GeodeticInterseismicComposite(GeodeticSourceComposite):
 
         self.point2sources(spoint)
 
+        displacements = self.Bij.r3map(geo_backslip_synthetics(
+            engine=self.engine,
+            sources=self.sources,
+            targets=self.targets,
+            lons=self._lons,
+            lats=self._lats,
+            reference=self.event,
+            **bpoint))
+
         synths = []
-        for target, data in zip(self.targets, self.datasets):
-            disp = geo_backslip_synthetics(
-                engine=self.engine,
-                sources=self.sources,
-                targets=[target],
-                lons=target.lons,
-                lats=target.lats,
-                reference=self.event,
-                **bpoint)
+        for disp, data in zip(displacements, self.datasets):
             synths.append((
                 disp[:, 0] * data.los_vector[:, 0] + \
                 disp[:, 1] * data.los_vector[:, 1] + \
@@ -665,10 +924,10 @@ class SeismicComposite(Composite):
         self.engine = gf.LocalEngine(
             store_superdirs=[sc.gf_config.store_superdir])
 
-        seismic_data_path = os.path.join(
-            project_dir, bconfig.seismic_data_name)
-        stations, data_traces = utility.load_objects(
-            seismic_data_path)
+        stations, data_traces = heart.load_project_data(
+            os.path.join(project_dir, bconfig.seismic_data_dir_name),
+            'seismic',
+            pickle_path=os.path.join(project_dir, bconfig.seismic_data_name))
 
         wavenames = sc.get_waveform_names()
 
@@ -918,6 +1177,7 @@ class SeismicGeometryComposite(SeismicComposite):
                filterer=wc.filterer)
 
         self.config = sc
+        self._crust_targets = {}
 
     def point2sources(self, point):
         """
@@ -1056,40 +1316,71 @@ class SeismicGeometryComposite(SeismicComposite):
                 datasets = wmap.get_datasets([channel])
                 weights = wmap.get_weights([channel])
 
-                for station, dataset, weight in zip(
-                    wmap.stations, datasets, weights):
-
-                    logger.debug('Channel %s of Station %s ' % (
-                        channel, station.station))
+                crust_targets = self.get_crust_targets(wmap, channel)
 
-                    crust_targets = heart.init_seismic_targets(
-                        stations=[station],
-                        earth_model_name=sc.gf_config.earth_model_name,
-                        channels=channel,
-                        sample_rate=sc.gf_config.sample_rate,
-                        crust_inds=range(*sc.gf_config.n_variations),
-                        reference_location=sc.gf_config.reference_location)
+                logger.debug('Channel %s of %i stations' % (
+                    channel, len(crust_targets)))
 
-                    cov_pv = cov.seismic_cov_velocity_models(
+                if plot:
+                    factors = cov.seismic_velocity_model_factors(
+                        engine=self.engine,
+                        sources=self.sources,
+                        targets=crust_targets,
+                        wavename=wmap.name,
+                        arrival_taper=wc.arrival_taper,
+                        filterer=wc.filterer,
+                        plot=plot)
+                else:
+                    factors = cov.parallel_seismic_velocity_model_factors(
                         engine=self.engine,
                         sources=self.sources,
                         targets=crust_targets,
                         wavename=wmap.name,
                         arrival_taper=wc.arrival_taper,
                         filterer=wc.filterer,
-                        plot=plot, n_jobs=n_jobs)
-                    cov_pv = utility.ensure_cov_psd(cov_pv)
+                        n_jobs=n_jobs)
 
-                    self.engine.close_cashed_stores()
+                t0 = time.time()
+                for factor, dataset, weight in zip(
+                        factors, datasets, weights):
+                    dataset.covariance.update_pred_v(factor)
+                    weight.set_value(dataset.covariance.chol_inverse)
+                    dataset.covariance.update_slnf()
 
-                    dataset.covariance.pred_v = cov_pv
+                t1 = time.time()
+                logger.debug('Calculate weights time %f' % (t1 - t0))
 
-                    t0 = time.time()
-                    choli = dataset.covariance.chol_inverse
-                    t1 = time.time()
-                    logger.debug('Calculate weight time %f' % (t1 - t0))
-                    weight.set_value(choli)
-                    dataset.covariance.update_slnf()
+        self.engine.close_cashed_stores()
+
+    def get_crust_targets(self, wmap, channel):
+        """
+        Get the targets of all velocity model variations for the stations
+        of a wavemap and channel. Initialised once and cached.
+
+        Parameters
+        ----------
+        wmap : :class:`heart.WaveformMapping`
+        channel : str
+
+        Returns
+        -------
+        list of lists of :class:`heart.DynamicTarget` for each station
+        """
+        sc = self.config
+
+        key = (wmap.name, channel)
+        if key not in self._crust_targets:
+            self._crust_targets[key] = [
+                heart.init_seismic_targets(
+                    stations=[station],
+                    earth_model_name=sc.gf_config.earth_model_name,
+                    channels=channel,
+                    sample_rate=sc.gf_config.sample_rate,
+                    crust_inds=range(*sc.gf_config.n_variations),
+                    reference_location=sc.gf_config.reference_location)
+                for station in wmap.stations]
+
+        return self._crust_targets[key]
 
 
 class GeodeticDistributerComposite(GeodeticComposite):
@@ -1104,21 +1395,27 @@ class GeodeticDistributerComposite(GeodeticComposite):
             gc, project_dir, event, hypers=hypers)
 
         self.gfs = {}
-        self.sgfs = {}
         self.gf_names = {}
 
         self._mode = 'static'
         self.gfpath = os.path.join(project_dir, self._mode,
                          bconfig.linear_gf_dir_name)
 
-        self.shared_data = [
-            shared(data.displacement.astype(tconfig.floatX), borrow=True) \
-            for data in self.datasets]
-        self.shared_odws = [
-            shared(data.odw.astype(tconfig.floatX), borrow=True) \
-            for data in self.datasets]
+        self.marginal_priors = None
+
+    def __getstate__(self):
+        # the memory-mapped Green's Functions are re-opened from the files
+        state = self.__dict__.copy()
+        state['gfs'] = sorted(self.gfs.keys())
+        return state
 
-    def load_gfs(self, crust_inds=None, make_shared=True):
+    def __setstate__(self, state):
+        crust_inds = state.pop('gfs')
+        self.__dict__.update(state)
+        self.gfs = {}
+        self.load_gfs(crust_inds=crust_inds, make_shared=False)
+
+    def load_gfs(self, crust_inds=None, make_shared=False):
         """
         Load Greens Function matrixes for each variable to be inverted for.
         Updates gfs and gf_names attributes.
@@ -1128,7 +1425,14 @@ class GeodeticDistributerComposite(GeodeticComposite):
         crust_inds : list
             of int to indexes of Green's Functions
         make_shared : bool
-            if True transforms gfs to :class:`theano.shared` variables
+            not used, the matrixes are always memory-mapped
+
+        Notes
+        -----
+        The matrixes are memory-mapped read-only. The likelihood does not
+        use them directly, but the fused operator of
+        :meth:`init_fused_operator`, which is a dense, whitened copy in
+        memory.
         """
 
         if crust_inds is None:
@@ -1139,15 +1443,7 @@ class GeodeticDistributerComposite(GeodeticComposite):
                 str(crust_ind) + '_' + bconfig.geodetic_linear_gf_name)
 
             self.gf_names[crust_ind] = gfpath
-            gfs = utility.load_objects(gfpath)[0]
-
-            if make_shared:
-                self.sgfs[crust_ind] = {param: [
-                    shared(gf.astype(tconfig.floatX), borrow=True) \
-                        for gf in gfs[param]] \
-                            for param in gfs.keys()}
-            else:
-                self.gfs[crust_ind] = gfs
+            self.gfs[crust_ind] = heart.load_linear_gfs(gfpath, mmap_mode='r')
 
     def load_fault_geometry(self):
         """
@@ -1160,10 +1456,80 @@ class GeodeticDistributerComposite(GeodeticComposite):
         return utility.load_objects(
             os.path.join(self.gfpath, bconfig.fault_geometry_name))[0]
 
+    def init_fused_operator(self, varnames, crust_ind=None):
+        """
+        Precompute the whitened linear forward operator. The weights
+        (inverse cholesky decomposed covariances), the overlapping data
+        weights (odws) and the Green's Functions of all slip components are
+        premultiplied and stacked to one matrix for all datasets:
+
+            wgfs = W * odw * [G_var1, G_var2, ...]
+            wdata = W * odw * d
+
+        so that the whitened residuals of all datasets are obtained with one
+        matrix-vector product: wdata - wgfs * [slip_var1, slip_var2, ...]
+
+        Parameters
+        ----------
+        varnames : list
+            of str with slip components in the order of the stacked slip
+            vector
+        crust_ind : int
+            index of Green's Functions to use, default: reference model
+
+        Notes
+        -----
+        Needs to be re-initialised if the weights are updated.
+        """
+        if crust_ind is None:
+            crust_ind = self.config.gf_config.reference_model_idx
+
+        if crust_ind not in self.gfs:
+            self.load_gfs(crust_inds=[crust_ind], make_shared=False)
+
+        gfs = self.gfs[crust_ind]
+
+        wgfs = []
+        wdata = []
+        self._fused_slices = []
+        self._wslocx = []
+        self._wslocy = []
+        i = 0
+        for t, data in enumerate(self.datasets):
+            weight = self.weights[t].get_value()
+            odws = data.odw[:, num.newaxis]
+
+            wgfs.append(num.hstack(
+                [whiten(weight, odws * gfs[var][t]) for var in varnames]))
+            wdata.append(whiten(weight, data.odw * data.displacement))
+
+            self._fused_slices.append(slice(i, i + data.samples))
+            i += data.samples
+
+            if self.config.fit_plane and self._slocx[t] is not None:
+                self._wslocx.append(shared(whiten(
+                    weight, self._slocx[t].get_value()).astype(
+                        tconfig.floatX), borrow=True))
+                self._wslocy.append(shared(whiten(
+                    weight, self._slocy[t].get_value()).astype(
+                        tconfig.floatX), borrow=True))
+            else:
+                self._wslocx.append(None)
+                self._wslocy.append(None)
+
+        self._fused_varnames = list(varnames)
+        self._wgfs = shared(
+            num.vstack(wgfs).astype(tconfig.floatX), borrow=True)
+        self._wdata = shared(
+            num.hstack(wdata).astype(tconfig.floatX), borrow=True)
+
     def get_formula(self, input_rvs, fixed_rvs, hyperparams):
         """
         Formulation of the distribution problem for the model built. Has to be
         called within a with-model-context.
+        The whitened residuals of all datasets are calculated with one
+        matrix-vector product with the fused forward operator
+        (see :meth:`init_fused_operator`).
 
         Parameters
         ----------
@@ -1180,25 +1546,246 @@ class GeodeticDistributerComposite(GeodeticComposite):
         self.input_rvs = input_rvs
         self.fixed_rvs = fixed_rvs
 
-        residuals = [None for i in range(self.n_t)]
-        for t in range(self.n_t):
+        if self.marginal_priors is not None:
+            return self.get_marginal_formula(hyperparams)
+
+        varnames = input_rvs.keys()
+        logger.info('Initialising fused forward operator ...')
+        self.init_fused_operator(varnames)
 
-            mu = tt.zeros_like(self.data[t], tconfig.floatX)
-            for var, rv in input_rvs.iteritems():
-                mu += tt.dot(self.sgfs[0][var][t], rv)
+        slips = tt.concatenate([input_rvs[var] for var in varnames])
+        tmp = self._wdata - self._wgfs.dot(slips)
 
-            residuals[t] = self.shared_odws[t] * (self.shared_data[t] - mu)
+        wresiduals = [tmp[slc] for slc in self._fused_slices]
 
         if self.config.fit_plane:
-            residuals = self.remove_ramps(residuals)
+            wresiduals = self.remove_ramps(
+                wresiduals, slocx=self._wslocx, slocy=self._wslocy)
 
-        logpts = multivariate_normal_chol(
-            self.datasets, self.weights, hyperparams, residuals)
+        logpts = multivariate_normal_whitened(
+            self.datasets, hyperparams, wresiduals,
+            lowrank_weights=self.lowrank_weights)
 
         llk = pm.Deterministic(self._like_name, logpts)
 
         return llk.sum()
 
+    def set_marginal_priors(self, priors):
+        """
+        Set the slip components to be marginalised analytically, instead of
+        being sampled.
+
+        Parameters
+        ----------
+        priors : list
+            of :class:`heart.Parameter` of the slip components. The uniform
+            priors are approximated by Gaussians of same mean and variance.
+        """
+        self.marginal_priors = priors
+
+    def init_marginal_system(self):
+        """
+        Precompute the normal equations of the whitened linear problem for
+        each dataset, i.e. for G the fused forward operator,
+        d the whitened data and R the whitened ramp coordinates:
+
+            G^T * G, G^T * d, d^T * d, G^T * R, R^T * R, R^T * d
+
+        After that the costs of the marginalisation only depend on the number
+        of slip parameters and not on the number of observations.
+        """
+        varnames = [param.name for param in self.marginal_priors]
+        self.init_fused_operator(varnames)
+
+        wgfs = self._wgfs.get_value().astype('float64')
+        wdata = self._wdata.get_value().astype('float64')
+
+        mu = num.hstack([
+            (param.upper + param.lower) / 2. for param in self.marginal_priors])
+        sigma = num.hstack([
+            (param.upper - param.lower) / num.sqrt(12.)
+            for param in self.marginal_priors])
+
+        self._prior_mean = mu
+        self._prior_precision = 1. / sigma ** 2
+
+        self._normal_eqs = []
+        for t, slc in enumerate(self._fused_slices):
+            if self.lowrank_weights is not None:
+                V = self.lowrank_weights[t].get_value()
+            else:
+                V = None
+
+            def inner(a, b):
+                out = a.T.dot(b)
+                if V is not None:
+                    out -= V.T.dot(a).T.dot(V.T.dot(b))
+                return out
+
+            G = wgfs[slc, :]
+            d = wdata[slc]
+            eqs = {
+                'GG': inner(G, G),
+                'Gd': inner(G, d),
+                'dd': inner(d, d)}
+
+            if self.config.fit_plane and self._wslocx[t] is not None:
+                R = num.vstack([
+                    self._wslocy[t].get_value(),
+                    self._wslocx[t].get_value()]).T.astype('float64')
+                eqs.update({
+                    'GR': inner(G, R),
+                    'RR': inner(R, R),
+                    'Rd': inner(R, d)})
+
+            self._normal_eqs.append(eqs)
+
+        hp_names = set(['_'.join(('h', data.typ)) for data in self.datasets])
+        if len(hp_names) == 1:
+            # common scaling of all datasets; (s * GG + P) is diagonalised
+            # once: P^-1/2 * GG * P^-1/2 = U * diag(k) * U^T
+            isqp = 1. / num.sqrt(self._prior_precision)
+            GG = num.sum([eqs['GG'] for eqs in self._normal_eqs], axis=0)
+            kappa, U = num.linalg.eigh(isqp[:, num.newaxis] * GG * isqp)
+            self._eig_system = (kappa, isqp[:, num.newaxis] * U)
+        else:
+            self._eig_system = None
+
+    def get_marginal_formula(self, hyperparams):
+        """
+        Get the likelihood of the model built with the slip being
+        marginalised analytically. Has to be called within a with model
+        context.
+        For the given hyperparameters (and ramps) the slip posterior is
+        Gaussian with precision A = sum(s_t * G_t^T * G_t) + P,
+        where s_t = exp(-2 * h_t) and P the prior precision.
+        The marginal likelihood follows from the maximum posterior slip
+        and the log-determinant of A.
+
+        Parameters
+        ----------
+        hyperparams : dict
+            of :class:`pymc3.distribution.Distribution`
+
+        Returns
+        -------
+        llk : :class:`theano.tensor.Tensor`
+        """
+        logger.info(
+            'Marginalising slip components: %s' % utility.list2string(
+                [param.name for param in self.marginal_priors]))
+
+        self.init_marginal_system()
+
+        if self.config.fit_plane:
+            self.init_ramp_params()
+
+        mu = self._prior_mean
+        prec = self._prior_precision
+
+        scalings = []
+        rhs = []
+        consts = []
+        for data, eqs in zip(self.datasets, self._normal_eqs):
+            hp_name = '_'.join(('h', data.typ))
+            scaling = tt.exp(-2. * tt.sum(hyperparams[hp_name]))
+
+            b = tt.as_tensor_variable(eqs['Gd'])
+            c = tt.as_tensor_variable(eqs['dd'])
+            if 'GR' in eqs:
+                ramp = self.ramp_params[data.name]
+                b -= tt.dot(eqs['GR'], ramp)
+                c += -2. * tt.dot(ramp, eqs['Rd']) + \
+                    tt.dot(ramp, tt.dot(eqs['RR'], ramp))
+
+            scalings.append(scaling)
+            rhs.append(b)
+            consts.append(c)
+
+        b_total = tt.as_tensor_variable(prec * mu)
+        for scaling, b in zip(scalings, rhs):
+            b_total = b_total + scaling * b
+
+        if self._eig_system is not None:
+            kappa, T = self._eig_system
+            s = scalings[0]
+            ev = s * kappa + 1.
+            slip = tt.dot(T, tt.dot(T.T, b_total) / ev)
+            ldet_A = num.log(prec).sum() + tt.log(ev).sum()
+        else:
+            A = tt.as_tensor_variable(num.diag(prec))
+            for scaling, eqs in zip(scalings, self._normal_eqs):
+                A = A + scaling * eqs['GG']
+
+            L = slinalg.cholesky(A)
+            slip = slinalg.solve_upper_triangular(
+                L.T, slinalg.solve_lower_triangular(L, b_total))
+            ldet_A = 2. * tt.log(tt.diag(L)).sum()
+
+        n_t = len(self.datasets)
+        logpts = tt.zeros((n_t), tconfig.floatX)
+        for l, data in enumerate(self.datasets):
+            hp_name = '_'.join(('h', data.typ))
+            M = tt.cast(shared(data.samples, borrow=True), 'int16')
+            eqs = self._normal_eqs[l]
+
+            norm = consts[l] - 2. * tt.dot(slip, rhs[l]) + \
+                tt.dot(slip, tt.dot(eqs['GG'], slip))
+
+            logpts = tt.set_subtensor(logpts[l:l + 1],
+                (-0.5) * (data.covariance.slnf + \
+                (M * 2 * hyperparams[hp_name]) + \
+                scalings[l] * norm
+                         )
+                                     )
+
+        dslip = slip - mu
+        marginal = -0.5 * (tt.dot(dslip, prec * dslip) + ldet_A -
+                           num.log(prec).sum())
+
+        llk = pm.Deterministic(self._like_name, logpts)
+        return llk.sum() + tt.cast(marginal, tconfig.floatX)
+
+    def solve_linear(self, point):
+        """
+        Get the maximum posterior slip for given hyperparameters (and ramps)
+        of a marginalised problem.
+
+        Parameters
+        ----------
+        point : :func:`pymc3.Point`
+            Dictionary with model parameters
+
+        Returns
+        -------
+        dict of slip components with :class:`numpy.ndarray`
+        """
+        if not hasattr(self, '_normal_eqs'):
+            self.init_marginal_system()
+
+        A = num.diag(self._prior_precision)
+        b = self._prior_precision * self._prior_mean
+        for data, eqs in zip(self.datasets, self._normal_eqs):
+            hp_name = '_'.join(('h', data.typ))
+            scaling = num.exp(-2. * num.sum(point[hp_name]))
+
+            Gd = eqs['Gd']
+            if 'GR' in eqs:
+                Gd = Gd - eqs['GR'].dot(point[data.name + '_ramp'])
+
+            A += scaling * eqs['GG']
+            b += scaling * Gd
+
+        slip = num.linalg.solve(A, b)
+
+        slips = {}
+        i = 0
+        for param in self.marginal_priors:
+            slips[param.name] = slip[i:i + param.dimension]
+            i += param.dimension
+
+        return slips
+
     def get_synthetics(self, point, outmode='data'):
         """
         Get synthetics for given point in solution space.
@@ -1220,13 +1807,17 @@ class GeodeticDistributerComposite(GeodeticComposite):
 
         tpoint = copy.deepcopy(point)
 
+        if self.marginal_priors is not None:
+            tpoint.update(self.solve_linear(tpoint))
+
         hps = self.config.get_hypernames()
 
         for hyper in hps:
             if hyper in tpoint:
                 tpoint.pop(hyper)
 
-        gf_params = self.gfs[0].keys()
+        gfs = self.gfs[self.config.gf_config.reference_model_idx]
+        gf_params = gfs.keys()
 
         for param in tpoint.keys():
             if param not in gf_params:
@@ -1237,12 +1828,273 @@ class GeodeticDistributerComposite(GeodeticComposite):
 
             mu = num.zeros_like(data.displacement)
             for var, rv in tpoint.iteritems():
-                mu += num.dot(self.gfs[0][var][i], rv)
-                synthetics.append(mu)
+                mu += num.dot(gfs[var][i], rv)
+
+            synthetics.append(mu)
 
         return synthetics
 
 
+class SeismicKinematicComposite(SeismicComposite):
+    """
+    Comprises how to solve the seismic kinematic finite-fault forward model.
+    Distributed slip, rupture velocity, source time function duration and
+    nucleation point.
+
+    The synthetics are assembled from libraries of Green's Function traces
+    of the fault patches (see :class:`heart.SeismicGFLibrary`), which are
+    shifted by the rupture onset times from the fast sweeping algorithm and
+    convolved with the source time functions of the patches.
+
+    Parameters
+    ----------
+    sc : :class:`config.SeismicConfig`
+        configuration object containing seismic setup parameters
+    project_dir : str
+        directory of the model project, where to find the data
+    event : :class:`pyrocko.model.Event`
+        reference event, the rupture onset times are with respect to its time
+    hypers : boolean
+        if true initialise object for hyper parameter optimization
+    """
+
+    def __init__(self, sc, project_dir, event, hypers=False):
+
+        super(SeismicKinematicComposite, self).__init__(
+            sc, event, project_dir, hypers=hypers)
+
+        self._mode = 'kinematic'
+        self.gfpath = os.path.join(
+            project_dir, self._mode, bconfig.linear_gf_dir_name)
+
+        self.gflibs = {}
+        self.data_arrays = {}
+        self.synthesizers = {}
+        self.config = sc
+
+        self.fault = self.load_fault_geometry()
+
+        if self.fault.nsubfaults > 1:
+            raise TypeError(
+                'Kinematic mode is so far only supported for one sub-fault!')
+
+        npw, npl = self.fault.ordering.vmap[0].shp
+        ext_source = self.fault.get_subfault(
+            0, datatype=self.name, component=self.fault.components[0])
+
+        self.n_patch_strike = npl
+        self.n_patch_dip = npw
+        self.patch_size = ext_source.length / npl / km
+
+        self.sweeper = theanof.Sweeper(
+            self.patch_size, self.n_patch_strike, self.n_patch_dip)
+
+    def get_gf_path(self, crust_ind, wavename):
+        """
+        Path to the index file of the Green's Function library.
+        """
+        return os.path.join(self.gfpath, '%i_%s_%s' % (
+            crust_ind, wavename, bconfig.seismic_kinematic_linear_gf_name))
+
+    def load_gfs(self, crust_inds=None, make_shared=False):
+        """
+        Load the Green's Function libraries of all waveforms and chop the
+        data traces at the times of the libraries.
+
+        Parameters
+        ----------
+        crust_inds : list
+            of int to indexes of Green's Functions
+        make_shared : bool
+            not used, the libraries are always memory-mapped
+        """
+        if crust_inds is None:
+            crust_inds = range(*self.config.gf_config.n_variations)
+
+        for crust_ind in crust_inds:
+            self.gflibs[crust_ind] = {}
+            for wmap in self.wavemaps:
+                wc = wmap.config
+                gflib = heart.SeismicGFLibrary(
+                    self.get_gf_path(crust_ind, wmap.name))
+
+                if gflib.n_targets != wmap.n_t:
+                    raise ValueError(
+                        "Number of targets %i of the Green's Functions for"
+                        " %s does not agree with the data %i!" % (
+                            gflib.n_targets, wmap.name, wmap.n_t))
+
+                self.gflibs[crust_ind][wmap.name] = gflib
+
+                if crust_ind == self.config.gf_config.reference_model_idx:
+                    self.data_arrays[wmap.name] = shared(
+                        heart.taper_filter_traces(
+                            wmap.datasets,
+                            arrival_taper=wc.arrival_taper,
+                            filterer=wc.filterer,
+                            tmins=gflib.tmins).astype(tconfig.floatX),
+                        borrow=True)
+
+                    self.synthesizers[wmap.name] = \
+                        theanof.KinematicSynthesizer(
+                            gflib=gflib,
+                            varnames=bconfig.static_dist_vars,
+                            stf_type=self.config.gf_config.stf_type)
+
+    def load_fault_geometry(self):
+        """
+        Load fault-geometry, i.e. discretized patches.
+
+        Returns
+        -------
+        :class:`heart.FaultGeometry`
+        """
+        return utility.load_objects(
+            os.path.join(self.gfpath, bconfig.fault_geometry_name))[0]
+
+    def point2sources(self, point):
+        """
+        The patches are fixed, nothing to update.
+        """
+        pass
+
+    def get_nucleation_patch_coordinates(self, nucleation_x, nucleation_y):
+        """
+        Transform the nucleation point [km] along strike and down-dip from
+        the upper left corner of the fault to patch coordinates.
+        """
+        return (nucleation_x / self.patch_size - 0.5,
+                nucleation_y / self.patch_size - 0.5)
+
+    def get_formula(self, input_rvs, fixed_rvs, hyperparams):
+        """
+        Get seismic likelihood formula for the model built. Has to be called
+        within a with model context.
+
+        Parameters
+        ----------
+        input_rvs : list
+            of :class:`pymc3.distribution.Distribution`
+        fixed_rvs : dict
+            of :class:`numpy.array`
+        hyperparams : dict
+            of :class:`pymc3.distribution.Distribution`
+
+        Returns
+        -------
+        posterior_llk : :class:`theano.tensor.Tensor`
+        """
+        self.input_rvs = input_rvs
+        self.fixed_rvs = fixed_rvs
+
+        logger.info(
+            'Seismic kinematic optimization on: \n '
+            ' %s' % ', '.join(self.input_rvs.keys()))
+
+        params = dict(fixed_rvs)
+        params.update(input_rvs)
+
+        nuc_x, nuc_y = self.get_nucleation_patch_coordinates(
+            params['nucleation_x'], params['nucleation_y'])
+
+        # patches are ordered row-wise from the top, the sweeper expects
+        # the patches of each column down-dip
+        slownesses = (1. / params['velocity']).reshape(
+            (self.n_patch_dip, self.n_patch_strike)).T.flatten()
+
+        rupture_times = self.sweeper(slownesses, nuc_x, nuc_y).reshape(
+            (self.n_patch_strike, self.n_patch_dip)).T.flatten()
+
+        wlogpts = []
+        for wmap in self.wavemaps:
+            synths = self.synthesizers[wmap.name](*(
+                [params[var] for var in bconfig.static_dist_vars] +
+                [rupture_times, params['duration']]))
+
+            residuals = self.data_arrays[wmap.name] - synths
+
+            logpts = multivariate_normal_chol(
+                wmap.datasets, wmap.weights, hyperparams, residuals)
+
+            wlogpts.append(logpts)
+
+        llk = pm.Deterministic(self._like_name, tt.concatenate((wlogpts)))
+        return llk.sum()
+
+    def get_rupture_times(self, point):
+        """
+        Rupture onset times of the patches for given point in solution space.
+
+        Returns
+        -------
+        :class:`numpy.ndarray` (n_patches)
+        """
+        nuc_x, nuc_y = self.get_nucleation_patch_coordinates(
+            float(point['nucleation_x']), float(point['nucleation_y']))
+
+        slownesses = (1. / point['velocity']).reshape(
+            (self.n_patch_dip, self.n_patch_strike)).T.flatten()
+
+        rupture_times = fast_sweep.get_rupture_times_c(
+            slownesses, self.patch_size,
+            self.n_patch_strike, self.n_patch_dip, nuc_x, nuc_y)
+
+        return rupture_times.reshape(
+            (self.n_patch_strike, self.n_patch_dip)).T.flatten()
+
+    def get_synthetics(self, point, outmode='array', **kwargs):
+        """
+        Get synthetics for given point in solution space.
+
+        Parameters
+        ----------
+        point : :func:`pymc3.Point`
+            Dictionary with model parameters
+        outmode : str
+            'array' or 'stacked_traces'
+
+        Returns
+        -------
+        synthetics and chopped data for all targets
+        """
+        crust_ind = self.config.gf_config.reference_model_idx
+        if crust_ind not in self.gflibs:
+            self.load_gfs(crust_inds=[crust_ind])
+
+        rupture_times = self.get_rupture_times(point)
+        slips = {var: point[var] for var in bconfig.static_dist_vars}
+
+        synths = []
+        obs = []
+        for wmap in self.wavemaps:
+            wc = wmap.config
+            gflib = self.gflibs[crust_ind][wmap.name]
+
+            synthetics = gflib.synthetics(
+                slips, rupture_times, point['duration'],
+                stf_type=self.config.gf_config.stf_type)
+
+            if outmode == 'stacked_traces':
+                for i, target in enumerate(wmap.targets):
+                    synths.append(trace.Trace(
+                        *target.codes,
+                        tmin=gflib.tmins[i],
+                        deltat=gflib.deltat,
+                        ydata=synthetics[i, :]))
+            else:
+                synths.extend(synthetics)
+
+            obs.extend(heart.taper_filter_traces(
+                wmap.datasets,
+                arrival_taper=wc.arrival_taper,
+                filterer=wc.filterer,
+                tmins=gflib.tmins,
+                outmode=outmode,
+                **kwargs))
+
+        return synths, obs
+
+
 geometry_composite_catalog = {
     'seismic': SeismicGeometryComposite,
     'geodetic': GeodeticGeometryComposite}
@@ -1256,6 +2108,10 @@ interseismic_composite_catalog = {
     'geodetic': GeodeticInterseismicComposite,
     }
 
+kinematic_composite_catalog = {
+    'seismic': SeismicKinematicComposite,
+    }
+
 
 class Problem(object):
     """
@@ -1277,6 +2133,10 @@ class Problem(object):
         self.composites = {}
         self.hyperparams = {}
 
+        self.model_cache_path = None
+        self._cached_step = None
+        self._cached_step_key = None
+
         logger.info('Analysing problem ...')
         logger.info('---------------------\n')
 
@@ -1306,6 +2166,12 @@ class Problem(object):
             raise Exception(
                 'Model has to be built before initialising the sampler.')
 
+        step_key = get_step_cache_key(sc, hypers)
+        if self._cached_step is not None and \
+                self._cached_step_key == step_key:
+            logger.info('Using compiled sampler from model cache.')
+            return self._cached_step
+
         with self.model:
             if sc.name == 'Metropolis':
                 logger.info(
@@ -1347,8 +2213,64 @@ class Problem(object):
                 t2 = time.time()
                 logger.info('Compilation time: %f' % (t2 - t1))
 
+            elif sc.name == 'NUTS':
+                ops = theanof.get_ops_without_gradient([self.model.logpt])
+                if ops:
+                    raise TypeError(
+                        'NUTS needs model gradients, which are not available'
+                        ' for the forward model(s): %s!' %
+                        utility.list2string(ops))
+
+                logger.info(
+                    '... Initiate No-U-Turn Sampler ... \n'
+                    ' target_accept=%f, n_jobs=%i \n' % (
+                        sc.parameters.target_accept, sc.parameters.n_jobs))
+
+                t1 = time.time()
+                step = pm.NUTS(target_accept=sc.parameters.target_accept)
+                t2 = time.time()
+                logger.info('Compilation time: %f' % (t2 - t1))
+
+        if self.model_cache_path is not None:
+            self.dump_model_cache(step, step_key)
+
         return step
 
+    def dump_model_cache(self, step, step_key):
+        """
+        Save the problem including the built model together with the compiled
+        sampler step to the model cache. Outdated cache files of the same
+        kind are removed.
+
+        Parameters
+        ----------
+        step : sampler step from :meth:`init_sampler`
+        step_key : str
+            from :func:`get_step_cache_key`
+        """
+        self._cached_step = step
+        self._cached_step_key = step_key
+
+        cache_dir, cache_fn = os.path.split(self.model_cache_path)
+        util.ensuredir(cache_dir)
+
+        prefix = cache_fn.split('_')[0]
+        for fn in glob(os.path.join(cache_dir, prefix + '_*.pkl')):
+            if fn != self.model_cache_path:
+                logger.info('Removing outdated model cache %s' % fn)
+                os.remove(fn)
+
+        logger.info('Writing model cache %s' % self.model_cache_path)
+        try:
+            # memory-mapped data and Green's Functions are not copied
+            utility.dump_objects(
+                self.model_cache_path, [self, step, step_key],
+                memmap_references=True)
+        except Exception as e:
+            logger.warn('Could not cache model: %s' % e)
+            if os.path.exists(self.model_cache_path):
+                os.remove(self.model_cache_path)
+
     def built_model(self):
         """
         Initialise :class:`pymc3.Model` depending on problem composites,
@@ -1369,6 +2291,8 @@ class Problem(object):
             total_llk = tt.zeros((1), tconfig.floatX)
 
             for datatype, composite in self.composites.iteritems():
+                composite.prior_kwargs = get_prior_kwargs(
+                    self.config.sampler_config.name)
                 input_rvs = utility.weed_input_rvs(
                     self.rvs, mode, datatype=datatype)
                 fixed_rvs = utility.weed_input_rvs(
@@ -1403,7 +2327,7 @@ class Problem(object):
 
         with pm.Model() as self.model:
 
-            self.hyperparams = self.get_hyperparams()
+            self.hyperparams = self.get_hyperparams(hypers=True)
 
             total_llk = tt.zeros((1), tconfig.floatX)
 
@@ -1429,10 +2353,15 @@ class Problem(object):
 
         return point
 
-    def get_random_variables(self):
+    def get_random_variables(self, exclude=()):
         """
         Evaluate problem setup and return random variables dictionary.
         Has to be executed in a "with model context"!
+
+        Parameters
+        ----------
+        exclude : list
+            of str, names of parameters that are not sampled
         """
         pc = self.config.problem_config
 
@@ -1441,6 +2370,9 @@ class Problem(object):
         rvs = dict()
         fixed_params = dict()
         for param in pc.priors.itervalues():
+            if param.name in exclude:
+                continue
+
             if not num.array_equal(param.lower, param.upper):
                 rvs[param.name] = pm.Uniform(
                     param.name,
@@ -1448,8 +2380,8 @@ class Problem(object):
                     lower=param.lower,
                     upper=param.upper,
                     testval=param.testvalue,
-                    transform=None,
-                    dtype=tconfig.floatX)
+                    dtype=tconfig.floatX,
+                    **get_prior_kwargs(self.config.sampler_config.name))
             else:
                 logger.info(
                     'not solving for %s, got fixed at %s' % (
@@ -1458,13 +2390,24 @@ class Problem(object):
 
         return rvs, fixed_params
 
-    def get_hyperparams(self):
+    def get_hyperparams(self, hypers=False):
         """
         Evaluate problem setup and return hyperparameter dictionary.
         Has to be executed in a "with model context"!
+
+        Parameters
+        ----------
+        hypers : boolean
+            flag for the hyper parameter estimation model, determines the
+            sampler the priors are set up for
         """
         pc = self.config.problem_config
 
+        if hypers:
+            sampler_name = self.config.hyper_sampler_config.name
+        else:
+            sampler_name = self.config.sampler_config.name
+
         hyperparams = {}
         n_hyp = len(pc.hyperparameters.keys())
 
@@ -1479,7 +2422,7 @@ class Problem(object):
                     upper=hyperpar.upper,
                     testval=hyperpar.testvalue,
                     dtype=tconfig.floatX,
-                    transform=None)
+                    **get_prior_kwargs(sampler_name))
             else:
                 logger.info(
                     'not solving for %s, got fixed at %s' % (
@@ -1707,9 +2650,24 @@ class DistributionOptimizer(Problem):
 
         super(DistributionOptimizer, self).__init__(config, hypers)
 
+        self.event = config.event
+
+        if config.problem_config.mode == 'kinematic':
+            composite_catalog = kinematic_composite_catalog
+        else:
+            composite_catalog = distributer_composite_catalog
+
         for datatype in config.problem_config.datatypes:
+            if config.problem_config.marginalize_linear and not hasattr(
+                    composite_catalog[datatype], 'set_marginal_priors'):
+                raise ValueError(
+                    'Marginalising the linear parameters is not supported'
+                    ' for %s data in %s mode! Disable "marginalize_linear"'
+                    ' in the problem_config.' % (
+                        datatype, config.problem_config.mode))
+
             data_config = config[datatype + '_config']
-            composite = distributer_composite_catalog[datatype](
+            composite = composite_catalog[datatype](
                 data_config,
                 config.project_dir,
                 self.event,
@@ -1717,15 +2675,51 @@ class DistributionOptimizer(Problem):
 
             # do the optimization only on the reference velocity model
             logger.info("Loading %s Green's Functions" % datatype)
-            composite.load_gfs(crust_inds=[data_config.gf_config.reference_model_idx])
+            composite.load_gfs(
+                crust_inds=[data_config.gf_config.reference_model_idx],
+                make_shared=False)
+
+            if config.problem_config.marginalize_linear:
+                composite.set_marginal_priors(self.get_marginal_priors())
+
             self.composites[datatype] = composite
 
         self.config = config
 
+    def get_marginal_priors(self):
+        """
+        Get the priors of the slip components that are marginalised
+        analytically, if marginalize_linear is set in the problem config.
+        """
+        pc = self.config.problem_config
+        return [param for param in pc.priors.itervalues()
+                if param.name in bconfig.static_dist_vars and
+                not num.array_equal(param.lower, param.upper)]
+
+    def get_random_variables(self):
+        """
+        Evaluate problem setup and return random variables dictionary.
+        Marginalised slip components are excluded.
+        Has to be executed in a "with model context"!
+        """
+        pc = self.config.problem_config
+
+        if not pc.marginalize_linear:
+            return super(DistributionOptimizer, self).get_random_variables()
+
+        marginals = [param.name for param in self.get_marginal_priors()]
+        logger.info(
+            'Not sampling marginalised slip components: %s' %
+            utility.list2string(marginals))
+
+        return super(DistributionOptimizer, self).get_random_variables(
+            exclude=marginals)
+
 
 problem_catalog = {
     bconfig.modes_catalog.keys()[0]: GeometryOptimizer,
     bconfig.modes_catalog.keys()[1]: DistributionOptimizer,
+    bconfig.modes_catalog.keys()[2]: DistributionOptimizer,
     bconfig.modes_catalog.keys()[3]: InterseismicOptimizer}
 
 
@@ -1736,7 +2730,8 @@ def sample(step, problem):
     Parameters
     ----------
 
-    step : :class:`SMC` or :class:`pymc3.metropolis.Metropolis`
+    step : :class:`SMC`, :class:`pymc3.metropolis.Metropolis` or
+        :class:`pymc3.step_methods.hmc.nuts.NUTS`
         from problem.init_sampler()
     problem : :class:`Problem` with characteristics of problem to solve
     """
@@ -1783,6 +2778,33 @@ def sample(step, problem):
             homepath=problem.outfolder,
             rm_flag=pa.rm_flag)
 
+    elif sc.name == 'NUTS':
+        logger.info('... Starting NUTS ...\n')
+
+        if update is not None:
+            logger.warning(
+                'Covariance updates are not supported for NUTS! Ignoring ...')
+
+        outname = os.path.join(problem.outfolder, 'stage_final')
+        if os.path.exists(outname) and pa.rm_flag:
+            logger.info('Removing existing previous final stage!')
+            shutil.rmtree(outname)
+
+        util.ensuredir(outname)
+
+        trace = pm.backends.Text(outname, model=problem.model)
+        pm.sample(
+            draws=pa.n_samples,
+            step=step,
+            trace=trace,
+            njobs=pa.n_jobs,
+            tune=pa.tune,
+            progressbar=sc.progressbar,
+            model=problem.model)
+
+        outpath = os.path.join(outname, bconfig.sample_p_outname)
+        utility.dump_objects(outpath, [step, None])
+
 
 def estimate_hypers(step, problem):
     """
@@ -1869,10 +2891,129 @@ def estimate_hypers(step, problem):
     bconfig.dump(problem.config, filename=conf_out)
 
 
-def load_model(project_dir, mode, hypers=False, nobuild=False):
+def get_model_cache_key(config, hypers=False):
+    """
+    Hash of everything the built model depends on: the configuration without
+    the sampler configurations, the data files, the linear Green's Functions
+    and the versions of beat and the libraries.
+
+    Parameters
+    ----------
+    config : :class:`config.BEATconfig`
+    hypers : boolean
+        flag for the hyper parameter estimation model
+
+    Returns
+    -------
+    str, hexadecimal sha1 digest
+    """
+    h = hashlib.sha1()
+    h.update('hypers=%s' % hypers)
+
+    # the prior transforms depend on the sampler
+    if hypers:
+        sampler_name = config.hyper_sampler_config.name
+    else:
+        sampler_name = config.sampler_config.name
+
+    h.update('prior_kwargs=%r' % sorted(
+        get_prior_kwargs(sampler_name).items()))
+
+    for name, value in config.T.inamevals(config):
+        if name in ('sampler_config', 'hyper_sampler_config'):
+            continue
+
+        if isinstance(value, Object):
+            h.update(bconfig.dump(value))
+        else:
+            h.update('%s=%r' % (name, value))
+
+    for data_name in (bconfig.seismic_data_name, bconfig.geodetic_data_name):
+        data_path = os.path.join(config.project_dir, data_name)
+        if os.path.exists(data_path):
+            with open(data_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    h.update(chunk)
+
+    # data directories: metadata by content, arrays by size and date
+    for data_dir_name in (
+            bconfig.seismic_data_dir_name, bconfig.geodetic_data_dir_name):
+        data_dir = os.path.join(config.project_dir, data_dir_name)
+        if os.path.exists(data_dir):
+            for fn in sorted(os.listdir(data_dir)):
+                path = os.path.join(data_dir, fn)
+                if fn.endswith('.yaml'):
+                    with open(path, 'rb') as f:
+                        h.update(f.read())
+                else:
+                    stat = os.stat(path)
+                    h.update('%s %i %f' % (fn, stat.st_size, stat.st_mtime))
+
+    # Green's Function libraries are large, check only size and date
+    gf_dir = os.path.join(
+        config.project_dir, config.problem_config.mode,
+        bconfig.linear_gf_dir_name)
+    if os.path.exists(gf_dir):
+        for fn in sorted(os.listdir(gf_dir)):
+            # derived from the traces, see heart.SeismicGFLibrary
+            if '_spectra.npy' in fn:
+                continue
+
+            stat = os.stat(os.path.join(gf_dir, fn))
+            h.update('%s %i %f' % (fn, stat.st_size, stat.st_mtime))
+
+    beat_dir = os.path.dirname(os.path.abspath(__file__))
+    for fn in sorted(os.listdir(beat_dir)):
+        if os.path.splitext(fn)[1] in ('.py', '.so'):
+            stat = os.stat(os.path.join(beat_dir, fn))
+            h.update('%s %i %f' % (fn, stat.st_size, stat.st_mtime))
+
+    h.update(' '.join((
+        sys.version, num.__version__, theano.__version__, pm.__version__)))
+
+    return h.hexdigest()
+
+
+def get_model_cache_path(config, hypers=False):
+    """
+    Path to the model cache file of the current config, data and library
+    versions, see :func:`get_model_cache_key`.
+    """
+    if hypers:
+        prefix = 'hypers'
+    else:
+        prefix = 'model'
+
+    return os.path.join(
+        config.project_dir, config.problem_config.mode,
+        bconfig.model_cache_dir_name, '%s_%s.pkl' % (
+            prefix, get_model_cache_key(config, hypers)))
+
+
+def get_step_cache_key(sampler_config, hypers=False):
+    """
+    Key of the sampler step, from the sampler parameters that are fixed when
+    the step is initialised.
+    """
+    sc = sampler_config
+    params = [
+        (name, getattr(sc.parameters, name, None)) for name in (
+            'n_jobs', 'n_chains', 'tune_interval', 'proposal_dist',
+            'coef_variation', 'target_accept')]
+
+    return '%s %s %r' % (sc.name, hypers, params)
+
+
+def load_model(project_dir, mode, hypers=False, nobuild=False,
+               use_cache=True):
     """
     Load config from project directory and return BEAT problem including model.
 
+    If use_cache, the built model and the compiled sampler are loaded from
+    the model cache in the project directory. The cache is invalidated by
+    changes to the config (except the sampler parameters), the data, the
+    linear Green's Functions or the library versions.
+
     Parameters
     ----------
     project_dir : string
@@ -1883,6 +3024,8 @@ def load_model(project_dir, mode, hypers=False, nobuild=False):
         flag to return hyper parameter estimation model instead of main model.
     built : boolean
         flag to do not build models
+    use_cache : boolean
+        flag to load and store the model from and to the model cache
 
     Returns
     -------
@@ -1897,6 +3040,23 @@ def load_model(project_dir, mode, hypers=False, nobuild=False):
         raise Exception('No hyperparameters specified!'
         ' option --hypers not applicable')
 
+    cache_path = None
+    if use_cache and not nobuild:
+        cache_path = get_model_cache_path(config, hypers)
+
+        if os.path.exists(cache_path):
+            logger.info('Loading model from cache %s' % cache_path)
+            try:
+                problem, step, step_key = utility.load_objects(cache_path)
+            except Exception as e:
+                logger.warn('Could not load model cache: %s' % e)
+            else:
+                problem.config = config
+                problem.model_cache_path = cache_path
+                problem._cached_step = step
+                problem._cached_step_key = step_key
+                return problem
+
     if pc.mode in problem_catalog.keys():
         problem = problem_catalog[pc.mode](config, hypers)
     else:
@@ -1909,6 +3069,8 @@ def load_model(project_dir, mode, hypers=False, nobuild=False):
         else:
             problem.built_model()
 
+    problem.model_cache_path = cache_path
+
     return problem
 
 
@@ -7,13 +7,13 @@ library and may be removed from the beat repository in the future.
 import numpy as num
 import logging
 import os
-import shutil
 import signal
 import copy
 
-from beat.utility import adjust_fault_reference
+from beat.utility import adjust_fault_reference, load_ascii_table, \
+    get_scratch_dir, release_scratch_dir, keep_scratch_dir
 
-from tempfile import mkdtemp, TemporaryFile
+from tempfile import TemporaryFile
 from subprocess import Popen, PIPE
 from os.path import join as pjoin
 
@@ -609,9 +609,17 @@ class Interrupted(gf.store.StoreError):
 
 
 class PsCmpRunner:
+    '''
+    Takes PsCmpConfigFull objects, runs the program and reads the output.
+
+    The run directory is a warm scratch directory of the process (on tmpfs
+    if available), it is emptied and re-used by the next runner.
+    '''
+    scratch_prefix = 'pscmprun-'
 
     def __init__(self, tmp=None, keep_tmp=False):
-        self.tempdir = mkdtemp(prefix='pscmprun-', dir=tmp)
+        self.tmp = tmp
+        self.tempdir = get_scratch_dir(self.scratch_prefix, tmp)
         self.keep_tmp = keep_tmp
         self.config = None
         self.stdout = TemporaryFile(prefix='pscmprun-out-', dir=self.tempdir)
@@ -718,7 +726,7 @@ in the directory %s'''.lstrip() % (
             if not os.path.exists(fn):
                 continue
 
-            data = num.loadtxt(fn, skiprows=1, dtype=num.float)
+            data = load_ascii_table(fn, skiprows=1)
             nsamples, n_comp = data.shape
 
             if component == 'displ':
@@ -742,8 +750,10 @@ in the directory %s'''.lstrip() % (
     def __del__(self):
         if self.tempdir:
             if not self.keep_tmp:
-                shutil.rmtree(self.tempdir)
+                self.stdout.close()
+                self.stderr.close()
+                release_scratch_dir(
+                    self.tempdir, self.scratch_prefix, self.tmp)
                 self.tempdir = None
             else:
-                logger.warn(
-                    'not removing temporary directory: %s' % self.tempdir)
+                self.tempdir = keep_scratch_dir(self.tempdir)
@@ -1,12 +1,11 @@
 import numpy as num
 import logging
 import os
-import shutil
 import math
 import copy
 import signal
+import hashlib
 
-from tempfile import mkdtemp
 from subprocess import Popen, PIPE
 import os.path as op
 from scipy.integrate import cumtrapz
@@ -15,6 +14,9 @@ from pyrocko.guts import Float, Int, Tuple, List, Bool, Object, String
 from pyrocko import trace, util, cake
 from pyrocko import gf
 
+from beat.utility import load_ascii_table, get_scratch_dir, \
+    release_scratch_dir, keep_scratch_dir
+
 km = 1000.
 
 guts_prefix = 'pf'
@@ -318,6 +320,32 @@ thickness.
         return template % d
 
 
+def qseiss_cache_key(config):
+    """
+    Content hash of a QSeisS run.
+
+    The key is built from the QSeisS input, i.e. the source-site earth model,
+    the source depth and all numerical parameters, without the output paths.
+    Runs with the same key produce identical f-k spectra.
+
+    Parameters
+    ----------
+    config : :class:`QSeisSConfigFull`
+
+    Returns
+    -------
+    str, hexadecimal sha1 digest
+    """
+    conf = copy.deepcopy(config)
+    conf.fk_path = ''
+    conf.info_path = ''
+
+    h = hashlib.sha1()
+    h.update(conf.qseiss_version)
+    h.update(conf.string_for_config())
+    return h.hexdigest()
+
+
 class QSeisRReceiver(Object):
     lat = Float.T(default=10.0)
     lon = Float.T(default=0.0)
@@ -512,7 +540,10 @@ class QSeis2dConfig(Object):
     fade = Tuple.T(4, Timing.T(), optional=True)
     relevel_with_fade_in = Bool.T(default=False)
 
-    gf_directory = String.T('qseis2d_green')
+    gf_directory = String.T(
+        'qseis2d_green',
+        help='Directory of the QSeisS f-k spectra, content addressed, may be'
+             ' shared between stores.')
 
 
 class QSeis2dError(gf.store.StoreError):
@@ -527,9 +558,15 @@ class Interrupted(gf.store.StoreError):
 class QSeisSRunner:
     '''
     Takes QSeis2dConfigFull or QSeisSConfigFull objects, runs the program.
+
+    The run directory is a warm scratch directory of the process (on tmpfs
+    if available), it is emptied and re-used by the next runner.
     '''
+    scratch_prefix = 'qseisSrun-'
+
     def __init__(self, tmp, keep_tmp=False):
-        self.tempdir = mkdtemp(prefix='qseisSrun-', dir=tmp)
+        self.tmp = tmp
+        self.tempdir = get_scratch_dir(self.scratch_prefix, tmp)
         self.keep_tmp = keep_tmp
         self.config = None
 
@@ -617,20 +654,26 @@ in the directory %s'''.lstrip() % (
     def __del__(self):
         if self.tempdir:
             if not self.keep_tmp:
-                shutil.rmtree(self.tempdir)
+                release_scratch_dir(
+                    self.tempdir, self.scratch_prefix, self.tmp)
                 self.tempdir = None
             else:
-                logger.warn(
-                    'not removing temporary directory: %s' % self.tempdir)
+                self.tempdir = keep_scratch_dir(self.tempdir)
 
 
 class QSeisRRunner:
     '''
     Takes QSeis2dConfig or QSeisRConfigFull objects, runs the program and
     reads the output.
+
+    The run directory is a warm scratch directory of the process (on tmpfs
+    if available), it is emptied and re-used by the next runner.
     '''
+    scratch_prefix = 'qseisRrun-'
+
     def __init__(self, tmp=None, keep_tmp=False):
-        self.tempdir = mkdtemp(prefix='qseisRrun-', dir=tmp)
+        self.tmp = tmp
+        self.tempdir = get_scratch_dir(self.scratch_prefix, tmp)
         self.keep_tmp = keep_tmp
         self.config = None
 
@@ -717,7 +760,7 @@ in the directory %s'''.lstrip() % (
     def get_traces(self):
 
         fn = self.config.get_output_filename(self.tempdir)
-        data = num.loadtxt(fn, skiprows=1, dtype=num.float)
+        data = load_ascii_table(fn, skiprows=1)
         nsamples, ntraces = data.shape
         deltat = (data[-1, 0] - data[0, 0]) / (nsamples - 1)
         toffset = data[0, 0]
@@ -746,11 +789,11 @@ in the directory %s'''.lstrip() % (
     def __del__(self):
         if self.tempdir:
             if not self.keep_tmp:
-                shutil.rmtree(self.tempdir)
+                release_scratch_dir(
+                    self.tempdir, self.scratch_prefix, self.tmp)
                 self.tempdir = None
             else:
-                logger.warn(
-                    'not removing temporary directory: %s' % self.tempdir)
+                self.tempdir = keep_scratch_dir(self.tempdir)
 
 
 class QSeis2dGFBuilder(gf.builder.Builder):
@@ -808,43 +851,44 @@ class QSeis2dGFBuilder(gf.builder.Builder):
         conf_s.time_window = (conf_s.nsamples - 1) * deltat
         conf_r.time_reduction = shared['time_reduction']
 
-        if step == 0:
-            if 'slowness_window' not in shared:
-                if conf_s.calc_slowness_window:
-                    phases = [
-                        storeconf.tabulated_phases[i].phases
-                        for i in range(len(
-                            storeconf.tabulated_phases))]
-
-                    all_phases = []
-                    map(all_phases.extend, phases)
-
-                    mean_source_depth = num.mean((
-                        storeconf.source_depth_min,
-                        storeconf.source_depth_max))
-
-                    arrivals = conf_s.earthmodel_1d.arrivals(
-                        phases=all_phases,
-                        distances=num.linspace(
-                            conf_s.receiver_min_distance,
-                            conf_s.receiver_max_distance,
-                            100) * cake.m2d,
-                        zstart=mean_source_depth)
-
-                    ps = num.array(
-                        [arrivals[i].p for i in range(len(arrivals))])
-
-                    slownesses = ps / (cake.r2d * cake.d2m / km)
-
-                    shared['slowness_window'] = (0.,
-                                                 0.,
-                                                 1.1 * float(slownesses.max()),
-                                                 1.3 * float(slownesses.max()))
+        # needed in both steps, the slowness window is part of the
+        # content key of the QSeisS output
+        if 'slowness_window' not in shared:
+            if conf_s.calc_slowness_window:
+                phases = [
+                    storeconf.tabulated_phases[i].phases
+                    for i in range(len(
+                        storeconf.tabulated_phases))]
 
-                else:
-                    shared['slowness_window'] = conf_s.slowness_window
+                all_phases = []
+                map(all_phases.extend, phases)
+
+                mean_source_depth = num.mean((
+                    storeconf.source_depth_min,
+                    storeconf.source_depth_max))
+
+                arrivals = conf_s.earthmodel_1d.arrivals(
+                    phases=all_phases,
+                    distances=num.linspace(
+                        conf_s.receiver_min_distance,
+                        conf_s.receiver_max_distance,
+                        100) * cake.m2d,
+                    zstart=mean_source_depth)
+
+                ps = num.array(
+                    [arrivals[i].p for i in range(len(arrivals))])
 
-            conf_s.slowness_window = shared['slowness_window']
+                slownesses = ps / (cake.r2d * cake.d2m / km)
+
+                shared['slowness_window'] = (0.,
+                                             0.,
+                                             1.1 * float(slownesses.max()),
+                                             1.3 * float(slownesses.max()))
+
+            else:
+                shared['slowness_window'] = conf_s.slowness_window
+
+        conf_s.slowness_window = shared['slowness_window']
 
         self.qseis_s_config = conf_s
         self.qseis_r_config = conf_r
@@ -872,19 +916,24 @@ class QSeis2dGFBuilder(gf.builder.Builder):
 
         gf_directory = op.abspath(self.qseis_baseconf.gf_directory)
 
-        fk_path = op.join(gf_directory, 'green_%.3fkm.fk' % source_depth)
-        info_path = op.join(gf_directory, 'green_%.3fkm.info' % source_depth)
+        # QSeisS outputs are content addressed, stores with the same source
+        # site model and numerics share them (e.g. crust variations that
+        # only differ in the receiver site crust)
+        conf_s.source_depth = source_depth
+        key = qseiss_cache_key(conf_s)
+        basename = '%s_%s' % (default_fk_basefilename, key)
 
-        conf_s.fk_path = fk_path
-        conf_s.info_path = info_path
+        fk_path = op.join(gf_directory, basename + '.fk')
+        info_path = op.join(gf_directory, basename + '.info')
 
         conf_r.fk_path = fk_path
         conf_r.info_path = info_path
 
         if self.step == 0 and os.path.isfile(fk_path):
             logger.info('Skipping step %i / %i, block %i / %i'
-                        '(GF already exists)' %
-                        (self.step + 1, self.nsteps, iblock + 1, self.nblocks))
+                        ' (GF already exists in cache: %s)' %
+                        (self.step + 1, self.nsteps, iblock + 1, self.nblocks,
+                         key))
             return
 
         logger.info(
@@ -895,10 +944,19 @@ class QSeis2dGFBuilder(gf.builder.Builder):
         conf_r.wavelet_duration = 0.001 * self.gf_config.sample_rate
 
         if self.step == 0:
-            conf_s.source_depth = source_depth
+            # write to temporary files first, the final fk file marks a
+            # complete cache entry for concurrent builds
+            tmp_basename = op.join(
+                gf_directory, '%s.tmp-%i' % (basename, os.getpid()))
+            conf_s.fk_path = tmp_basename + '.fk'
+            conf_s.info_path = tmp_basename + '.info'
+
             runner = QSeisSRunner(tmp=self.tmp)
             runner.run(conf_s)
 
+            os.rename(conf_s.info_path, info_path)
+            os.rename(conf_s.fk_path, fk_path)
+
         else:
             conf_r.receiver = QSeisRReceiver(lat=90 - firstx * cake.m2d,
                                            lon=180.,
@@ -2,10 +2,13 @@
 Package for wrapping various functions into Theano-Ops to be able to include
 them into theano graphs as is needed by the pymc3 models.
 
-Far future:
-    include a 'def grad:' -method to each Op in order to enable the use of
-    gradient based optimization algorithms
+Ops that provide a 'grad' -method enable the use of gradient based
+sampling algorithms (e.g. NUTS). For the :class:`GeoSynthesizer` the gradient
+is approximated by finite differences that are calculated in a single
+engine request.
 """
+import copy
+
 from beat import heart, utility, interseismic
 from beat.fast_sweeping import fast_sweep
 
@@ -19,6 +22,29 @@ import numpy as num
 km = 1000.
 
 
+def get_ops_without_gradient(outputs):
+    """
+    Get the names of the Ops of this module in the graph of outputs, that
+    do not provide a gradient.
+
+    Parameters
+    ----------
+    outputs : list
+        of :class:`theano.tensor.Tensor`
+
+    Returns
+    -------
+    list of str
+    """
+    nodes = theano.gof.graph.io_toposort(
+        theano.gof.graph.inputs(outputs), outputs)
+
+    return sorted(set(
+        type(node.op).__name__ for node in nodes
+        if type(node.op).__module__ == __name__ and
+        not hasattr(node.op, 'grad')))
+
+
 class GeoSynthesizer(theano.Op):
     """
     Theano wrapper for a geodetic forward model with synthetic displacements.
@@ -108,6 +134,116 @@ class GeoSynthesizer(theano.Op):
     def infer_shape(self, node, input_shapes):
         return [(self.nobs, 3)]
 
+    def grad(self, inputs, output_gradients):
+        grad_op = GeoSynthesizerGrad(
+            self.engine, self.sources, self.targets, self.varnames)
+        out = grad_op(*(list(inputs) + list(output_gradients)))
+        # single input returns a variable, theano needs a list
+        return out if isinstance(out, list) else [out]
+
+
+class GeoSynthesizerGrad(theano.Op):
+    """
+    Theano Op for the gradient of the :class:`GeoSynthesizer`.
+    Returns the vector-Jacobian products of the output gradient with the
+    synthetic displacements with respect to each source parameter.
+
+    The Jacobian is approximated by forward finite differences. As every
+    source parameter only affects its own source, all perturbed sources
+    and the reference sources are processed in a single engine request.
+
+    Parameters
+    ----------
+    engine : :class:`pyrocko.gf.seismosizer.LocalEngine`
+    sources : List
+        containing :class:`pyrocko.gf.seismosizer.Source` Objects
+    targets : List
+        containing :class:`pyrocko.gf.targets.StaticTarget` Objects
+    varnames : List
+        of str, input order of the source parameters
+    fd_step : float
+        relative step size of the finite differences
+    """
+
+    __props__ = ('engine', 'sources', 'targets', 'varnames', 'fd_step')
+
+    def __init__(self, engine, sources, targets, varnames, fd_step=1e-4):
+        self.engine = engine
+        self.sources = tuple(sources)
+        self.targets = tuple(targets)
+        self.varnames = tuple(varnames)
+        self.fd_step = fd_step
+
+    def __getstate__(self):
+        self.engine.close_cashed_stores()
+        return self.__dict__
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+    def make_node(self, *inputs):
+        inlist = [tt.as_tensor_variable(i) for i in inputs]
+        outlist = [i.type() for i in inlist[:-1]]
+        return theano.Apply(self, inlist, outlist)
+
+    def _get_source(self, point, j):
+        mpoint = utility.adjust_point_units(point)
+        source = self.sources[j].clone()
+        utility.update_source(source, **utility.split_point(mpoint)[j])
+        source.time = 0.
+        return source
+
+    def perform(self, node, inputs, output):
+        point = {vname: num.atleast_1d(i).astype('float64')
+                 for vname, i in zip(self.varnames, inputs[:-1])}
+        gz = inputs[-1]
+
+        ns = len(self.sources)
+        nt = len(self.targets)
+
+        mpoint = utility.adjust_point_units(point)
+        source_points = utility.split_point(mpoint)
+
+        sources = []
+        for j, source in enumerate(self.sources):
+            s = source.clone()
+            utility.update_source(s, **source_points[j])
+            s.time = 0.
+            sources.append(s)
+
+        perturbations = []
+        for vname in self.varnames:
+            for j in range(ns):
+                ppoint = copy.deepcopy(point)
+                h = self.fd_step * max(1., num.abs(point[vname][j]))
+                ppoint[vname][j] += h
+                sources.append(self._get_source(ppoint, j))
+                perturbations.append((vname, j, h))
+
+        disp_arrays = heart.geo_synthetics(
+            engine=self.engine,
+            targets=self.targets,
+            sources=sources,
+            outmode='arrays')
+
+        def source_displacements(k):
+            return num.vstack(
+                [disp_arrays[l + (k * nt)] for l in range(nt)])
+
+        ref_disps = [source_displacements(k) for k in range(ns)]
+
+        grads = {vname: num.zeros(ns) for vname in self.varnames}
+        for p, (vname, j, h) in enumerate(perturbations):
+            jac = (source_displacements(ns + p) - ref_disps[j]) / h
+            grads[vname][j] = num.sum(jac * gz)
+
+        for i, vname in enumerate(self.varnames):
+            output[i][0] = grads[vname].reshape(
+                inputs[i].shape).astype(node.outputs[i].dtype)
+
+    def infer_shape(self, node, input_shapes):
+        return input_shapes[:-1]
+
 
 class GeoLayerSynthesizerPsCmp(theano.Op):
     """
@@ -283,8 +419,8 @@ class GeoInterseismicSynthesizer(theano.Op):
             reference=self.reference,
             **bpoint)
 
-        def infer_shape(self, node, input_shapes):
-            return [(len(self.lats), 3)]
+    def infer_shape(self, node, input_shapes):
+        return [(len(self.lats), 3)]
 
 
 class SeisSynthesizer(theano.Op):
@@ -428,6 +564,71 @@ class SeisDataChopper(theano.Op):
         return [(nrow, ncol)]
 
 
+class KinematicSynthesizer(theano.Op):
+    """
+    Theano wrapper for a kinematic finite-fault forward model with synthetic
+    waveforms assembled from a library of patch Green's Function traces.
+
+    Parameters
+    ----------
+    gflib : :class:`heart.SeismicGFLibrary`
+    varnames : list
+        of str with slip components, order of the slip inputs
+    stf_type : str
+        'boxcar' or 'triangular'
+    """
+
+    __props__ = ('gflib', 'varnames', 'stf_type')
+
+    def __init__(self, gflib, varnames, stf_type='boxcar'):
+        self.gflib = gflib
+        self.varnames = tuple(varnames)
+        self.stf_type = stf_type
+
+    def make_node(self, *inputs):
+        """
+        Transforms theano tensors to node and allocates variables accordingly.
+
+        Parameters
+        ----------
+        inputs : list
+            of :class:`theano.tensor.Tensor` with the patch slips for each
+            slip component in the order of varnames, followed by the
+            rupture onset times and the source time function durations
+        """
+        inlist = []
+        for i in inputs:
+            inlist.append(tt.as_tensor_variable(i))
+
+        outm = tt.as_tensor_variable(num.zeros((2, 2)))
+        outlist = [outm.type()]
+        return theano.Apply(self, inlist, outlist)
+
+    def perform(self, node, inputs, output):
+        """
+        Perform method of the Operator to calculate synthetic waveforms.
+
+        Parameters
+        ----------
+        inputs : list
+            of :class:`numpy.ndarray`
+        output : list
+            of synthetic waveforms of :class:`numpy.ndarray`
+            (n x nsamples)
+        """
+        z = output[0]
+
+        nvars = len(self.varnames)
+        slips = dict(zip(self.varnames, inputs[:nvars]))
+        rupture_times, durations = inputs[nvars:]
+
+        z[0] = self.gflib.synthetics(
+            slips, rupture_times, durations, stf_type=self.stf_type)
+
+    def infer_shape(self, node, input_shapes):
+        return [(self.gflib.n_targets, self.gflib.n_samples)]
+
+
 class Sweeper(theano.Op):
     """
     Theano Op for C implementation of the fast sweep algorithm.
@@ -465,7 +666,7 @@ class Sweeper(theano.Op):
 
         z[0] = fast_sweep.fast_sweep_ext.fast_sweep(
             slownesses, self.patch_size,
-            int(nuc_strike), int(nuc_dip),
+            float(nuc_strike), float(nuc_dip),
             self.n_patch_strike, self.n_patch_dip)
 
     def infer_shape(self, node, input_shapes):
@@ -11,10 +11,16 @@ import logging
 
 import os
 import re
+import mmap
 import collections
 import copy
+import atexit
+import shutil
 import cPickle as pickle
 
+from tempfile import mkdtemp, gettempdir
+from multiprocessing import util as mp_util
+
 from pyrocko import util, orthodrome, catalog
 from pyrocko.cake import m2d, LayeredModel, read_nd_model_str
 
@@ -247,6 +253,29 @@ class ListToArrayBijection(object):
 
         return a_list
 
+    def r3map(self, array):
+        """
+        Maps values from array space with 3 columns to List space.
+        Inverse operation of f3map.
+
+        Parameters
+        ----------
+        array : :class:`numpy.ndarray`
+            with size: n x 3
+
+        Returns
+        -------
+        a_list : list
+            of :class:`numpy.ndarray` with size: n_i x 3
+        """
+
+        a_list = copy.copy(self.list_arrays)
+
+        for list_ind, slc, _, _, _ in self.ordering.vmap:
+            a_list[list_ind] = array[slc, :]
+
+        return a_list
+
 
 def weed_input_rvs(input_rvs, mode, datatype):
     """
@@ -870,7 +899,47 @@ def adjust_fault_reference(source, input_depth='top'):
     source.depth = float(center[2])
 
 
-def dump_objects(outpath, outlist):
+class MemmapReference(object):
+    """
+    Reference to a memory-mapped array, that is pickled instead of the
+    array, see :func:`dump_objects`.
+    """
+
+    def __init__(self, memmap):
+        self.filename = memmap.filename
+        self.offset = memmap.offset
+        self.shape = memmap.shape
+        self.dtype = memmap.dtype
+        self.order = 'F' if memmap.flags.f_contiguous and \
+            not memmap.flags.c_contiguous else 'C'
+
+        # never truncate the file when re-opening
+        self.mode = 'r+' if memmap.mode == 'w+' else memmap.mode
+
+    def load(self, mode=None):
+        return num.memmap(
+            self.filename, dtype=self.dtype, mode=mode or self.mode,
+            offset=self.offset, shape=self.shape, order=self.order)
+
+
+def get_memmap_reference(obj):
+    """
+    Reference to obj, if it is a complete memory-mapped array, that is
+    not a view and has no changes in memory only (copy-on-write mode).
+    Otherwise None.
+    """
+    if not isinstance(obj, num.memmap) or obj.filename is None or \
+            not isinstance(obj.base, mmap.mmap):
+        return None
+
+    reference = MemmapReference(obj)
+    if obj.mode == 'c' and not num.array_equal(obj, reference.load('r')):
+        return None
+
+    return reference
+
+
+def dump_objects(outpath, outlist, memmap_references=False):
     """
     Dump objects in outlist into pickle file.
 
@@ -880,10 +949,17 @@ def dump_objects(outpath, outlist):
         absolute path and file name for the file to be stored
     outlist : list
         of objects to save pickle
+    memmap_references : bool
+        if True, memory-mapped arrays are stored as references to their
+        files, which are re-opened when loading, instead of their data
     """
 
     with open(outpath, 'wb') as f:
-        pickle.dump(outlist, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+        if memmap_references:
+            pickler.persistent_id = get_memmap_reference
+
+        pickler.dump(outlist)
 
 
 def load_objects(loadpath):
@@ -901,13 +977,203 @@ def load_objects(loadpath):
     """
 
     try:
-        objects = pickle.load(open(loadpath, 'rb'))
+        f = open(loadpath, 'rb')
     except IOError:
         raise Exception(
             'File %s does not exist!' % loadpath)
+
+    with f:
+        unpickler = pickle.Unpickler(f)
+        # memory-mapped arrays stored as references, see dump_objects
+        unpickler.persistent_load = MemmapReference.load
+        objects = unpickler.load()
+
     return objects
 
 
+def load_ascii_table(filename, skiprows=1, dtype=num.float64):
+    """
+    Load a whitespace separated table of numbers, e.g. output of the
+    Fortran programs. Much faster than :func:`numpy.loadtxt`, which is
+    used as a fallback if the table is not regular or not fully parseable.
+
+    Parameters
+    ----------
+    filename : str
+        path to the ascii file
+    skiprows : int
+        number of header lines
+    dtype : :class:`numpy.dtype`
+        of the output array
+
+    Returns
+    -------
+    :class:`numpy.ndarray` (n_rows, n_columns)
+    """
+    with open(filename, 'r') as f:
+        for i in range(skiprows):
+            f.readline()
+
+        text = f.read()
+
+    lines = text.splitlines()
+    nrows = sum(1 for line in lines if line.strip())
+    ncolumns = len(lines[0].split()) if lines else 0
+
+    # fromstring stops silently at the first token it cannot parse
+    try:
+        data = num.fromstring(text, dtype=dtype, sep=' ')
+    except ValueError:
+        data = None
+
+    if ncolumns == 0 or data is None or data.size != nrows * ncolumns:
+        logger.debug(
+            'Irregular table in %s, falling back to loadtxt' % filename)
+        return num.loadtxt(filename, skiprows=skiprows, dtype=dtype, ndmin=2)
+
+    return data.reshape((-1, ncolumns))
+
+
+_scratch_dirs = {}
+_tmpfs_root = '/dev/shm'
+
+
+def default_scratch_root():
+    """
+    Root of the scratch directories, tmpfs (/dev/shm) if available,
+    otherwise the default temporary directory. The environment variable
+    BEAT_SCRATCH_ROOT overrides it, if it is set but empty the default
+    temporary directory is used.
+    """
+    root = os.environ.get('BEAT_SCRATCH_ROOT', None)
+    if root is not None:
+        return root or None
+
+    if os.path.isdir(_tmpfs_root) and os.access(_tmpfs_root, os.W_OK):
+        return _tmpfs_root
+    else:
+        return None
+
+
+def _remove_scratch_dirs(pid):
+    if pid != os.getpid():
+        return
+
+    for key in list(_scratch_dirs.keys()):
+        if key[0] == pid:
+            for dirname in _scratch_dirs.pop(key):
+                shutil.rmtree(dirname, ignore_errors=True)
+
+
+def get_scratch_dir(prefix, tmp=None):
+    """
+    Check out a scratch directory of the current process. Directories
+    released with :func:`release_scratch_dir` are re-used, they are removed
+    when the process exits.
+
+    Parameters
+    ----------
+    prefix : str
+        of the directory name, separates the pools of different programs
+    tmp : str
+        root directory, if None :func:`default_scratch_root`
+
+    Returns
+    -------
+    str, path to the empty directory
+    """
+    if tmp is None:
+        tmp = default_scratch_root()
+
+    pid = os.getpid()
+    if not any(key[0] == pid for key in _scratch_dirs):
+        # forked (pool) workers do not run atexit functions
+        atexit.register(_remove_scratch_dirs, pid)
+        mp_util.Finalize(None, _remove_scratch_dirs, args=(pid,),
+                         exitpriority=0)
+
+    free = _scratch_dirs.setdefault((pid, prefix, tmp), [])
+    if free:
+        return free.pop()
+    else:
+        return mkdtemp(prefix=prefix, dir=tmp)
+
+
+def release_scratch_dir(dirname, prefix, tmp=None):
+    """
+    Empty a scratch directory from :func:`get_scratch_dir` and return it to
+    the pool of the current process.
+    """
+    if tmp is None:
+        tmp = default_scratch_root()
+
+    for fn in os.listdir(dirname):
+        path = os.path.join(dirname, fn)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    _scratch_dirs.setdefault((os.getpid(), prefix, tmp), []).append(dirname)
+
+
+def keep_scratch_dir(dirname):
+    """
+    Keep a scratch directory from :func:`get_scratch_dir` for inspection
+    instead of releasing it. Directories on tmpfs occupy memory until they
+    are removed manually, they are moved to the default temporary directory.
+
+    Parameters
+    ----------
+    dirname : str
+        path to the scratch directory
+
+    Returns
+    -------
+    str, path to the kept directory
+    """
+    if os.path.realpath(dirname).startswith(_tmpfs_root + os.sep):
+        dest = os.path.join(gettempdir(), os.path.basename(dirname))
+        try:
+            shutil.move(dirname, dest)
+            dirname = dest
+        except (IOError, OSError) as e:
+            logger.warn(
+                'Could not move %s out of tmpfs: %s' % (dirname, str(e)))
+
+    size = 0
+    for root, _, fns in os.walk(dirname):
+        size += sum(
+            os.path.getsize(os.path.join(root, fn)) for fn in fns)
+
+    logger.warn(
+        'not removing temporary directory: %s (%.1f MB)' % (
+            dirname, size / 1024. ** 2))
+    return dirname
+
+
+def is_diagonal(A):
+    """
+    Check if a square matrix has only zeros off the main diagonal,
+    without creating a copy of the matrix.
+
+    Parameters
+    ----------
+    A : :class:`numpy.ndarray`
+        square matrix
+
+    Returns
+    -------
+    bool
+    """
+    n = A.shape[0]
+    if n < 2:
+        return True
+
+    off_diag = num.ascontiguousarray(A).ravel()[1:].reshape(n - 1, n + 1)
+    return not off_diag[:, :-1].any()
+
+
 def ensure_cov_psd(cov):
     """
     Ensure that the input covariance matrix is positive definite.
@@ -1281,6 +1547,40 @@ def line_intersect(e1, e2, n1, n2):
     return num.atleast_2d(tmp / denom).T * dn + n1
 
 
+def points_in_polygon(points, vertices):
+    """
+    Test which points are inside of a polygon (even-odd rule).
+    Vectorized ray casting over all points and polygon edges.
+
+    Parameters
+    ----------
+    points : :class:`numpy.ndarray` (n x 2)
+        coordinates of the points to test
+    vertices : :class:`numpy.ndarray` (m x 2)
+        coordinates of the polygon vertices, the polygon is closed
+        implicitly
+
+    Returns
+    -------
+    :class:`numpy.ndarray` (n) of bool, True for points inside the polygon
+    """
+    x = points[:, 0][:, num.newaxis]
+    y = points[:, 1][:, num.newaxis]
+
+    x1 = vertices[:, 0]
+    y1 = vertices[:, 1]
+    x2 = num.roll(x1, -1)
+    y2 = num.roll(y1, -1)
+
+    # edges that are crossed by a horizontal ray through the point
+    crosses = (y1 > y) != (y2 > y)
+
+    with num.errstate(divide='ignore', invalid='ignore'):
+        x_intersect = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+
+    return num.logical_xor.reduce(crosses & (x < x_intersect), axis=1)
+
+
 def get_rotation_matrix(axis):
     """
     Return a function for 3-d rotation matrix for a specified axis.
@@ -0,0 +1,219 @@
+"""
+Benchmark and accuracy suite for the fast sweeping implementations.
+
+Times the C, numpy and theano implementations of the rupture onset time
+calculation for a range of grid sizes with random slowness fields and
+nucleation points. The accuracy is checked against the analytic solution
+for a constant rupture velocity and the implementations are compared
+against each other. Results are written to a JSON file, so that changes to
+the solver can be tracked.
+
+Usage: python bench_fastsweep.py [options]
+"""
+import json
+import logging
+import platform
+from time import time
+from optparse import OptionParser
+
+import numpy as num
+
+from beat.fast_sweeping import fast_sweep
+from pyrocko import util
+
+import theano.tensor as tt
+from theano import function
+
+
+logger = logging.getLogger('bench_fastsweep')
+
+grid_sizes = [(10, 10), (50, 20), (100, 50), (200, 100), (500, 200)]
+
+patch_size = 1.     # [km]
+
+
+def analytic_rupture_times(
+        slowness, patch_size, n_patch_strike, n_patch_dip, nuc_x, nuc_y):
+    """
+    Rupture onset times for constant slowness (n_patch_dip x n_patch_strike).
+    """
+    dip, strike = num.meshgrid(
+        num.arange(n_patch_dip), num.arange(n_patch_strike), indexing='ij')
+    distances = num.sqrt((strike - nuc_x) ** 2 + (dip - nuc_y) ** 2) * \
+        patch_size
+    return distances * slowness
+
+
+def random_setup(n_patch_strike, n_patch_dip):
+    slownesses = 1. / (num.random.rand(n_patch_dip, n_patch_strike) * 2.5 + 1.)
+    nuc_x = num.random.randint(0, n_patch_strike)
+    nuc_y = num.random.randint(0, n_patch_dip)
+    return slownesses, nuc_x, nuc_y
+
+
+class TheanoSweep(object):
+    """
+    Compiled theano implementation, compilation is timed separately.
+    """
+
+    def __init__(self):
+        slownesses = tt.dmatrix('slownesses')
+        nuc_x = tt.lscalar('nuc_x')
+        nuc_y = tt.lscalar('nuc_y')
+
+        start_times = fast_sweep.get_rupture_times_theano(
+            slownesses, tt.cast(patch_size, 'float64'), nuc_x, nuc_y)
+
+        t0 = time()
+        self.f = function([slownesses, nuc_x, nuc_y], start_times)
+        self.compile_time = time() - t0
+
+    def __call__(self, slownesses, patch_size, n_patch_strike, n_patch_dip,
+                 nuc_x, nuc_y):
+        return self.f(slownesses, nuc_x, nuc_y)
+
+
+def c_sweep(slownesses, patch_size, n_patch_strike, n_patch_dip,
+            nuc_x, nuc_y):
+    return fast_sweep.get_rupture_times_c(
+        slownesses.flatten('F'), patch_size,
+        n_patch_strike, n_patch_dip, nuc_x, nuc_y).reshape(
+        n_patch_dip, n_patch_strike, order='F')
+
+
+def time_implementation(func, setups, n_patch_strike, n_patch_dip):
+    times = []
+    results = []
+    for slownesses, nuc_x, nuc_y in setups:
+        t0 = time()
+        results.append(func(
+            slownesses, patch_size, n_patch_strike, n_patch_dip,
+            nuc_x, nuc_y))
+        times.append(time() - t0)
+
+    return num.array(times), results
+
+
+def run_benchmark(n_repeat, max_patches_numpy, max_patches_theano,
+                  sizes=grid_sizes):
+
+    implementations = [
+        ('c', c_sweep, None),
+        ('numpy', fast_sweep.get_rupture_times_numpy, max_patches_numpy),
+        ('theano', None, max_patches_theano)]
+
+    records = []
+    for n_patch_strike, n_patch_dip in sizes:
+        n_patches = n_patch_strike * n_patch_dip
+        logger.info(
+            'Grid %i x %i (strike x dip)' % (n_patch_strike, n_patch_dip))
+
+        setups = [random_setup(n_patch_strike, n_patch_dip)
+                  for i in range(n_repeat)]
+
+        # constant velocity for comparison with the analytic solution
+        const_slowness = 1. / 2.8
+        nuc_x, nuc_y = n_patch_strike // 3, n_patch_dip // 2
+        const_setup = [(num.ones((n_patch_dip, n_patch_strike)) *
+                        const_slowness, nuc_x, nuc_y)]
+        analytic = analytic_rupture_times(
+            const_slowness, patch_size, n_patch_strike, n_patch_dip,
+            nuc_x, nuc_y)
+
+        c_results = None
+        for name, func, max_patches in implementations:
+            if max_patches is not None and n_patches > max_patches:
+                logger.info('  skipping %s, too many patches' % name)
+                continue
+
+            record = dict(
+                implementation=name,
+                n_patch_strike=n_patch_strike,
+                n_patch_dip=n_patch_dip,
+                n_repeat=n_repeat)
+
+            if name == 'theano':
+                func = TheanoSweep()
+                record['compile_time'] = func.compile_time
+
+            times, results = time_implementation(
+                func, setups, n_patch_strike, n_patch_dip)
+            _, const_results = time_implementation(
+                func, const_setup, n_patch_strike, n_patch_dip)
+
+            if name == 'c':
+                c_results = results
+            else:
+                record['max_abs_diff_c'] = float(max(
+                    num.abs(r - c).max()
+                    for r, c in zip(results, c_results)))
+
+            err = num.abs(const_results[0] - analytic)
+            nonzero = analytic > 0.
+            record.update(dict(
+                time_mean=float(times.mean()),
+                time_min=float(times.min()),
+                max_abs_err_analytic=float(err.max()),
+                max_rel_err_analytic=float(
+                    (err[nonzero] / analytic[nonzero]).max())))
+
+            logger.info(
+                '  %s: %f s (min %f s), rel. error to analytic %f' % (
+                    name, record['time_mean'], record['time_min'],
+                    record['max_rel_err_analytic']))
+            records.append(record)
+
+    return records
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option(
+        '--outpath', dest='outpath', type='string',
+        default='bench_fastsweep.json',
+        help='Path to the JSON file to write the results to.')
+    parser.add_option(
+        '--n_repeat', dest='n_repeat', type='int', default=5,
+        help='Number of random slowness fields per grid size. Default: 5')
+    parser.add_option(
+        '--max_patches_numpy', dest='max_patches_numpy', type='int',
+        default=5000,
+        help='Maximum number of patches for the numpy implementation.'
+             ' Default: 5000')
+    parser.add_option(
+        '--max_patches_theano', dest='max_patches_theano', type='int',
+        default=1000,
+        help='Maximum number of patches for the theano implementation.'
+             ' Default: 1000')
+    parser.add_option(
+        '--seed', dest='seed', type='int', default=None,
+        help='Seed of the random number generator.')
+
+    options, args = parser.parse_args()
+
+    if options.seed is not None:
+        num.random.seed(options.seed)
+
+    records = run_benchmark(
+        options.n_repeat,
+        options.max_patches_numpy,
+        options.max_patches_theano)
+
+    results = dict(
+        date=util.time_to_str(time()),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        numpy=num.__version__,
+        seed=options.seed,
+        patch_size=patch_size,
+        results=records)
+
+    with open(options.outpath, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    logger.info('Wrote results to %s' % options.outpath)
+
+
+if __name__ == '__main__':
+    util.setup_logging('bench_fastsweep', 'info')
+    main()
@@ -0,0 +1,129 @@
+"""
+Benchmark of the startup time of the beat command line tool.
+
+Times the import of the beat modules and the startup of the beat
+subcommands (until the help is printed), each in a fresh python process.
+Results are written to a JSON file, so that the effect of changes to the
+imports can be tracked.
+
+Usage: python bench_startup.py [options]
+"""
+import json
+import logging
+import os
+import platform
+import sys
+from time import time
+from subprocess import Popen, PIPE
+from optparse import OptionParser
+
+import numpy as num
+
+from pyrocko import util
+
+
+logger = logging.getLogger('bench_startup')
+
+modules = [
+    'numpy', 'pyrocko.gf', 'theano', 'pymc3', 'matplotlib.pyplot',
+    'beat.heart', 'beat.config', 'beat.inputf', 'beat.backend',
+    'beat.models', 'beat.plotting']
+
+subcommands = [
+    'init', 'import', 'build_gfs', 'sample', 'summarize', 'plot', 'check']
+
+
+def find_beat_app():
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        fn = os.path.join(path, 'beat')
+        if os.path.isfile(fn):
+            return fn
+
+    return os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'apps', 'beat')
+
+
+def time_call(cmd, n_repeat):
+    times = []
+    for i in range(n_repeat):
+        t0 = time()
+        proc = Popen(cmd, stdout=PIPE, stderr=PIPE)
+        _, error_str = proc.communicate()
+        times.append(time() - t0)
+
+        if proc.returncode != 0:
+            logger.warn('"%s" failed: %s' % (' '.join(cmd), error_str))
+            return None
+
+    return num.array(times)
+
+
+def run_benchmark(n_repeat, beat_app):
+    records = []
+
+    t_base = time_call([sys.executable, '-c', 'pass'], n_repeat)
+    for name in modules:
+        times = time_call(
+            [sys.executable, '-c', 'import %s' % name], n_repeat)
+        if times is None:
+            continue
+
+        records.append(dict(
+            kind='import',
+            name=name,
+            time_mean=float(times.mean() - t_base.mean()),
+            time_min=float(times.min() - t_base.min())))
+        logger.info('import %s: %f s' % (name, records[-1]['time_mean']))
+
+    for subcommand in subcommands:
+        times = time_call(
+            [sys.executable, beat_app, subcommand, '--help'], n_repeat)
+        if times is None:
+            continue
+
+        records.append(dict(
+            kind='subcommand',
+            name=subcommand,
+            time_mean=float(times.mean()),
+            time_min=float(times.min())))
+        logger.info('beat %s --help: %f s' % (
+            subcommand, records[-1]['time_mean']))
+
+    return records
+
+
+def main():
+    parser = OptionParser(usage=__doc__.strip().splitlines()[-1])
+    parser.add_option(
+        '--outpath', dest='outpath', type='string',
+        default='bench_startup.json',
+        help='Path to the JSON file to write the results to.')
+    parser.add_option(
+        '--n_repeat', dest='n_repeat', type='int', default=5,
+        help='Number of repetitions of each call. Default: 5')
+    parser.add_option(
+        '--beat', dest='beat_app', type='string', default=None,
+        help='Path to the beat executable. Default: from PATH or apps/beat')
+
+    options, args = parser.parse_args()
+
+    beat_app = options.beat_app or find_beat_app()
+
+    records = run_benchmark(options.n_repeat, beat_app)
+
+    results = dict(
+        date=util.time_to_str(time()),
+        platform=platform.platform(),
+        python=platform.python_version(),
+        beat=beat_app,
+        results=records)
+
+    with open(options.outpath, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    logger.info('Wrote results to %s' % options.outpath)
+
+
+if __name__ == '__main__':
+    util.setup_logging('bench_startup', 'info')
+    main()
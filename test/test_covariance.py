@@ -0,0 +1,101 @@
+import numpy as num
+from beat import heart
+import unittest
+from pyrocko import util
+
+
+class TestLowRankCovariance(unittest.TestCase):
+
+    def __init__(self, *args, **kwargs):
+        unittest.TestCase.__init__(self, *args, **kwargs)
+
+        n = 60
+        n_var = 5
+        self.residual = num.random.randn(n)
+
+        synths = num.random.randn(n_var, n)
+        self.factor = (synths - synths.mean(axis=0)).T / num.sqrt(n_var - 1.)
+        self.pred_v = num.cov(synths, rowvar=0)
+
+        B = num.random.randn(n, n)
+        self.data_covs = [
+            num.diag(num.random.rand(n) + 0.5),
+            B.dot(B.T) + n * num.eye(n)]
+
+    def _check(self, data_cov):
+        dense = heart.Covariance(data=data_cov, pred_v=self.pred_v)
+        lowrank = heart.Covariance(
+            data=data_cov, pred_v_factor=self.factor)
+
+        tmp = dense.chol_inverse.dot(self.residual)
+        dense_llk = num.dot(tmp, tmp)
+
+        choli = lowrank.base_chol_inverse
+        if choli.ndim == 1:
+            tmp = choli * self.residual
+        else:
+            tmp = choli.dot(self.residual)
+
+        tmp_lr = lowrank.lowrank_weight.T.dot(tmp)
+        lowrank_llk = num.dot(tmp, tmp) - num.dot(tmp_lr, tmp_lr)
+
+        num.testing.assert_allclose(lowrank_llk, dense_llk, rtol=1e-5)
+        num.testing.assert_allclose(
+            lowrank.log_norm_factor, dense.log_norm_factor, rtol=1e-5)
+
+        # rank-k updated weight
+        tmp = lowrank.chol_inverse.dot(self.residual)
+        num.testing.assert_allclose(num.dot(tmp, tmp), dense_llk, rtol=1e-5)
+
+    def test_diagonal_data(self):
+        cov = heart.Covariance(data=self.data_covs[0])
+        self.assertEqual(cov.base_chol_inverse.ndim, 1)
+        self._check(self.data_covs[0])
+
+    def test_dense_data(self):
+        self._check(self.data_covs[1])
+
+    def test_weight_inverse(self):
+        data_cov = self.data_covs[1]
+
+        for lowrank in (False, True):
+            cov = heart.Covariance(data=data_cov)
+            cov.update_pred_v(self.factor, lowrank=lowrank)
+            self.assertEqual(cov.lowrank, lowrank)
+
+            W = cov.chol_inverse
+            if lowrank:
+                C = data_cov + self.factor.dot(self.factor.T)
+            else:
+                # dense inverse Cholesky factor is lower triangular
+                num.testing.assert_allclose(W, num.tril(W), atol=1e-12)
+                C = data_cov + cov.pred_v
+
+            num.testing.assert_allclose(
+                W.T.dot(W), num.linalg.inv(C), rtol=1e-5, atol=1e-10)
+
+    def test_cache_invalidation(self):
+        cov = heart.Covariance(
+            data=self.data_covs[1], pred_v_factor=self.factor)
+        choli = cov.base_chol_inverse
+        weight = cov.lowrank_weight
+        assert cov.lowrank_weight is weight
+
+        cov.data = self.data_covs[1] * 2.
+        assert cov.base_chol_inverse is not choli
+        num.testing.assert_allclose(
+            cov.base_chol_inverse, choli / num.sqrt(2.), rtol=1e-5)
+
+        weight = cov.lowrank_weight
+        cov.pred_v_factor = self.factor * 2.
+        assert cov.lowrank_weight is not weight
+
+        fresh = heart.Covariance(
+            data=self.data_covs[1] * 2., pred_v_factor=self.factor * 2.)
+        num.testing.assert_allclose(
+            cov.lowrank_weight, fresh.lowrank_weight, rtol=1e-5)
+
+
+if __name__ == '__main__':
+    util.setup_logging('test_covariance', 'warning')
+    unittest.main()
@@ -4,7 +4,7 @@ from time import time
 
 import numpy as num
 
-from beat import theanof
+from beat import theanof, utility
 from beat.fast_sweeping import fast_sweep
 from pyrocko import util
 
@@ -128,6 +128,156 @@ class FastSweepingTestCase(unittest.TestCase):
         num.testing.assert_allclose(np_i, c_i, rtol=0., atol=1e-6)
         num.testing.assert_allclose(np_i, tc_i, rtol=0., atol=1e-6)
 
+    def test_batch(self):
+        n_fields = 5
+        slownesses = []
+        nuc_xs = num.random.randint(0, self.n_patch_strike, n_fields)
+        nuc_ys = num.random.randint(0, self.n_patch_dip, n_fields)
+
+        np_is = []
+        for nuc_x, nuc_y in zip(nuc_xs, nuc_ys):
+            s = 1. / (num.random.rand(
+                self.n_patch_dip, self.n_patch_strike) * 3. + 1.)
+            slownesses.append(s.flatten('F'))
+            np_is.append(fast_sweep.get_rupture_times_numpy(
+                s, self.patch_size / km,
+                self.n_patch_strike, self.n_patch_dip, nuc_x, nuc_y))
+
+        t0 = time()
+        c_is = fast_sweep.get_rupture_times_c_batch(
+            num.vstack(slownesses), self.patch_size / km,
+            self.n_patch_strike, self.n_patch_dip, nuc_xs, nuc_ys)
+        t1 = time()
+        logger.info('done batch c fast_sweeping in %f' % (t1 - t0))
+
+        for np_i, c_i in zip(np_is, c_is):
+            num.testing.assert_allclose(
+                np_i, c_i.reshape(
+                    self.n_patch_dip, self.n_patch_strike, order='F'),
+                rtol=0., atol=1e-6)
+
+        ordering = utility.FaultOrdering(
+            [self.n_patch_strike], [self.n_patch_dip])
+        sub_is = fast_sweep.get_rupture_times_subfaults(
+            num.vstack([s.reshape(
+                self.n_patch_dip, self.n_patch_strike, order='F').ravel()
+                for s in slownesses]),
+            [self.patch_size / km], ordering, 0, nuc_xs, nuc_ys)
+
+        for np_i, sub_i in zip(np_is, sub_is):
+            num.testing.assert_allclose(
+                np_i.ravel(), sub_i, rtol=0., atol=1e-6)
+
+    def _coupled_subfaults_numpy(
+            self, slownesses, centers, patch_size, nuc_x, nuc_y,
+            n_iter_max=50):
+        """
+        Reference: sweep each sub-fault in turn, seeded by the nucleation
+        point and the direct arrivals from the other sub-faults.
+        """
+        starts = [num.ones_like(slowness) * 1e8 for slowness in slownesses]
+        starts[0][nuc_y, nuc_x] = 0.
+        tzeros = [start.copy() for start in starts]
+
+        for i in range(n_iter_max):
+            change = 0.
+            for k, (slowness, start) in enumerate(zip(slownesses, starts)):
+                seeds = start.copy()
+                for l in range(len(slownesses)):
+                    if l == k:
+                        continue
+
+                    distances = num.sqrt(num.sum((
+                        centers[k][:, num.newaxis, :] -
+                        centers[l][num.newaxis, :, :]) ** 2, axis=2))
+                    arrivals = num.min(
+                        tzeros[l].ravel()[num.newaxis, :] +
+                        distances * slowness.ravel()[:, num.newaxis], axis=1)
+                    seeds = num.minimum(seeds, arrivals.reshape(seeds.shape))
+
+                npw, npl = slowness.shape
+                tzero = fast_sweep._get_rupture_times_numpy(
+                    slowness, patch_size, npl, npw, None, None,
+                    start_times=seeds)
+                change = max(change, num.abs(tzero - tzeros[k]).max())
+                tzeros[k] = tzero
+
+            if change < 1e-9:
+                return tzeros
+
+        raise ValueError('Reference did not converge!')
+
+    def test_coupled_subfaults(self):
+        patch_size = self.patch_size / km
+        npls = [4, 3]
+        npw = 3
+        ordering = utility.FaultOrdering(npls, [npw, npw])
+
+        # coplanar sub-faults, the second continues the first along strike
+        centers = []
+        offset = 0
+        for npl in npls:
+            xs, zs = num.meshgrid(
+                num.arange(npl) + offset + 0.5, num.arange(npw) + 0.5)
+            centers.append(num.vstack(
+                [xs.ravel(), num.zeros(xs.size), zs.ravel()]).T * patch_size)
+            offset += npl
+
+        slowness = 1. / (num.random.rand(npw, sum(npls)) * 2. + 1.)
+        slownesses = [slowness[:, :npls[0]], slowness[:, npls[0]:]]
+        Slownesses = num.hstack([s.ravel() for s in slownesses])
+
+        nuc_x, nuc_y = 1, 2
+        n_iter_max = 5
+        tzero = fast_sweep.get_rupture_times_subfaults(
+            Slownesses, [patch_size, patch_size], ordering, 0, nuc_x, nuc_y,
+            patch_centers=num.vstack(centers), n_iter_max=n_iter_max)[0]
+
+        # converged within n_iter_max
+        tzero_converged = fast_sweep.get_rupture_times_subfaults(
+            Slownesses, [patch_size, patch_size], ordering, 0, nuc_x, nuc_y,
+            patch_centers=num.vstack(centers), n_iter_max=50)[0]
+        num.testing.assert_allclose(
+            tzero, tzero_converged, rtol=0., atol=1e-6)
+
+        tzeros = [tzero[pmap.slc].reshape(pmap.shp) for pmap in ordering.vmap]
+        refs = self._coupled_subfaults_numpy(
+            slownesses, centers, patch_size, nuc_x, nuc_y)
+        for t, ref in zip(tzeros, refs):
+            num.testing.assert_allclose(t, ref, rtol=0., atol=1e-6)
+
+        # continuous across the shared edge
+        edge_slowness = slowness[:, npls[0] - 1:npls[0] + 1].max(axis=1)
+        assert (num.abs(tzeros[1][:, 0] - tzeros[0][:, -1]) <=
+                edge_slowness * patch_size + 1e-6).all()
+
+    def test_continuous_nucleation(self):
+        slownesses = self.get_slownesses()
+        nuc_x, nuc_y = 1.3, 2.6
+
+        np_i = fast_sweep.get_rupture_times_numpy(
+            slownesses, self.patch_size / km,
+            self.n_patch_strike, self.n_patch_dip, nuc_x, nuc_y)
+        c_i = fast_sweep.get_rupture_times_c(
+            slownesses.flatten('F'), self.patch_size / km,
+            self.n_patch_strike, self.n_patch_dip, nuc_x, nuc_y).reshape(
+            self.n_patch_dip, self.n_patch_strike, order='F')
+
+        num.testing.assert_allclose(np_i, c_i, rtol=0., atol=1e-6)
+
+        # onset times vary continuously with the nucleation point
+        step = 1e-4
+        nuc_xs = num.arange(0., self.n_patch_strike - 1., step)
+        c_is = fast_sweep.get_rupture_times_c_batch(
+            num.tile(slownesses.flatten('F'), (nuc_xs.size, 1)),
+            self.patch_size / km, self.n_patch_strike, self.n_patch_dip,
+            nuc_xs, num.ones_like(nuc_xs) * nuc_y)
+
+        max_slope = slownesses.max() * self.patch_size / km
+        assert num.abs(num.diff(c_is, axis=0)).max() <= \
+            max_slope * step * (1. + 1e-6)
+
+
 if __name__ == '__main__':
     util.setup_logging('test_fast_sweeping', 'info')
     unittest.main()
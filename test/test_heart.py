@@ -1,8 +1,10 @@
 import unittest
-from beat import heart, models
+from beat import heart, models, inputf, utility
+import theano
 import theano.tensor as tt
 from theano import function, shared
 from copy import deepcopy
+import pymc3 as pm
 import numpy as num
 from numpy.testing import assert_allclose
 from tempfile import mkdtemp
@@ -10,7 +12,7 @@ import os
 import logging
 import shutil
 
-from pyrocko import util, trace
+from pyrocko import util, trace, cake, model
 from pyrocko import plot, orthodrome
 
 
@@ -146,6 +148,522 @@ class TestGeoComposite(unittest.TestCase):
                 w.get_value(), d.covariance.chol_inverse,
                 rtol=1e-08, atol=0)
 
+    def test_gradient(self):
+        logger.info('Test gradient')
+        point = self.problem.model.test_point
+        varnames = sorted(self.problem.rvs.keys())
+
+        for names in (varnames, varnames[:1]):
+            def synths(*inputs):
+                return self.sc.get_synths(dict(zip(names, inputs)))
+
+            theano.gradient.verify_grad(
+                synths, [point[name].astype('float64') for name in names],
+                eps=1e-4, abs_tol=1e-6, rel_tol=1e-2,
+                rng=num.random.RandomState(0))
+
+
+class TestSeismicGFLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='beat_test_gflib')
+        self.index_path = os.path.join(self.tmpdir, 'test_gfs.json')
+
+        self.deltat = 0.5
+        self.n_samples = 40
+        self.n_shift = 10
+        self.n_targets = 3
+        self.n_patches = 5
+        self.varnames = ['strike_slip', 'dip_slip']
+
+        tmins = [10., 20., 30.]
+        meta = dict(
+            deltat=self.deltat,
+            tmins=tmins,
+            n_samples=self.n_samples,
+            n_shift=self.n_shift,
+            tapers=[[tmin - 10., tmin - 5., tmin + 30., tmin + 35.]
+                    for tmin in tmins])
+
+        gfs = heart.init_linear_gfs(
+            self.index_path, self.varnames,
+            shapes=[(self.n_targets, self.n_patches,
+                     self.n_samples + self.n_shift)],
+            dtype='float64', meta=meta)
+
+        self.gfs = {}
+        for var in self.varnames:
+            gfs[var][0][:] = num.random.randn(
+                self.n_targets, self.n_patches,
+                self.n_samples + self.n_shift)
+            gfs[var][0].flush()
+            self.gfs[var] = num.array(gfs[var][0])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_synthetics(self):
+        gflib = heart.SeismicGFLibrary(self.index_path)
+
+        slips = {var: num.random.rand(self.n_patches)
+                 for var in self.varnames}
+        shifts = num.random.randint(0, self.n_shift, self.n_patches)
+        durations = num.zeros(self.n_patches)
+
+        synths = gflib.synthetics(
+            slips, shifts * self.deltat, durations)
+
+        ref = num.zeros((self.n_targets, self.n_samples))
+        for var in self.varnames:
+            for p, shift in enumerate(shifts):
+                start = self.n_shift - shift
+                ref += slips[var][p] * \
+                    self.gfs[var][:, p, start:start + self.n_samples]
+
+        assert_allclose(synths, ref, rtol=0., atol=1e-10)
+
+    def test_target_chunks(self):
+        slips = {var: num.random.rand(self.n_patches)
+                 for var in self.varnames}
+        rupture_times = num.random.rand(self.n_patches) * 2.
+        durations = num.random.rand(self.n_patches)
+
+        synths = [
+            heart.SeismicGFLibrary(
+                self.index_path, target_chunksize=chunksize).synthetics(
+                    slips, rupture_times, durations)
+            for chunksize in (1, 2, self.n_targets)]
+
+        for synth in synths[1:]:
+            assert_allclose(synth, synths[0], rtol=0., atol=1e-10)
+
+    def test_spectra_cache(self):
+        gflib = heart.SeismicGFLibrary(self.index_path)
+        for var in self.varnames:
+            assert os.path.exists(gflib.get_spectra_path(var))
+            assert_allclose(
+                gflib.spectra[var],
+                num.fft.rfft(self.gfs[var], n=gflib.nfft, axis=2),
+                rtol=0., atol=1e-10)
+
+        # traces changed after the spectra were stored
+        gfs = heart.load_linear_gfs(self.index_path, mmap_mode='r+')
+        for var in self.varnames:
+            self.gfs[var] *= 2.
+            gfs[var][0][:] = self.gfs[var]
+            gfs[var][0].flush()
+            os.utime(gflib.get_spectra_path(var), (0., 0.))
+
+        gflib = heart.SeismicGFLibrary(self.index_path)
+        for var in self.varnames:
+            assert_allclose(
+                gflib.spectra[var],
+                num.fft.rfft(self.gfs[var], n=gflib.nfft, axis=2),
+                rtol=0., atol=1e-10)
+
+    def test_pickle(self):
+        gflib = heart.SeismicGFLibrary(self.index_path)
+        outpath = os.path.join(self.tmpdir, 'gflib.pkl')
+        utility.dump_objects(outpath, [gflib])
+
+        nbytes = sum(gf.nbytes for gf in self.gfs.values())
+        self.assertTrue(os.path.getsize(outpath) < nbytes / 2)
+
+        lgflib, = utility.load_objects(outpath)
+        slips = {var: num.random.rand(self.n_patches)
+                 for var in self.varnames}
+        rupture_times = num.random.rand(self.n_patches) * 2.
+        durations = num.random.rand(self.n_patches)
+
+        assert_allclose(
+            lgflib.synthetics(slips, rupture_times, durations),
+            gflib.synthetics(slips, rupture_times, durations),
+            rtol=0., atol=1e-12)
+
+    def test_clip_time_shifts(self):
+        gflib = heart.SeismicGFLibrary(self.index_path)
+
+        slips = {var: num.random.rand(self.n_patches)
+                 for var in self.varnames}
+        durations = num.ones(self.n_patches)
+        rupture_times = num.ones(self.n_patches) * gflib.max_time_shift
+
+        synths = gflib.synthetics(slips, rupture_times, durations)
+        clipped = gflib.synthetics(
+            slips, rupture_times - durations, durations)
+
+        assert_allclose(synths, clipped, rtol=0., atol=1e-10)
+
+    def test_stf(self):
+        gflib = heart.SeismicGFLibrary(self.index_path)
+
+        durations = num.random.rand(self.n_patches) * 5.
+        for stf_type in ['boxcar', 'triangular']:
+            stfs = gflib.get_stf_spectra(durations, stf_type)
+            # unit area
+            assert_allclose(stfs[:, 0], 1.)
+            # centroid delay of half the duration
+            assert_allclose(
+                num.angle(stfs[:, 1]),
+                -gflib.omega[1] * durations / 2., atol=1e-12)
+
+        self.assertRaises(
+            TypeError, gflib.get_stf_spectra, durations, 'gaussian')
+
+
+def _touch_traces(store_dir, nworkers=1, force=False):
+    util.ensuredir(store_dir)
+    open(os.path.join(store_dir, 'traces'), 'w').close()
+
+
+def _fail(store_dir, nworkers=1, force=False):
+    raise ValueError('failed on purpose')
+
+
+class TestBuildGFStores(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='beat_test_stores')
+        self.store_dirs = [
+            os.path.join(self.tmpdir, 'store_%i' % i) for i in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _jobs(self, function):
+        return [(store_dir, function, dict(store_dir=store_dir))
+                for store_dir in self.store_dirs]
+
+    def test_skip_existing(self):
+        _touch_traces(self.store_dirs[0])
+        mtime = os.path.getmtime(os.path.join(self.store_dirs[0], 'traces'))
+
+        heart.build_gf_stores(self._jobs(_touch_traces), nworkers=1)
+
+        for store_dir in self.store_dirs:
+            assert os.path.exists(os.path.join(store_dir, 'traces'))
+
+        self.assertEqual(
+            os.path.getmtime(os.path.join(self.store_dirs[0], 'traces')),
+            mtime)
+
+        # nothing left to do
+        heart.build_gf_stores(self._jobs(_fail), nworkers=1)
+
+    def test_failure(self):
+        self.assertRaises(
+            Exception, heart.build_gf_stores, self._jobs(_fail), nworkers=1)
+
+    def test_parallel(self):
+        heart.build_gf_stores(self._jobs(_touch_traces), nworkers=2)
+
+        for store_dir in self.store_dirs:
+            assert os.path.exists(os.path.join(store_dir, 'traces'))
+
+
+class TestEarthmodelEnsemble(unittest.TestCase):
+
+    def setUp(self):
+        self.ref_model = cake.load_model().extract(depth_max=700 * km)
+
+    def _layer_arrays(self, earthmod):
+        return num.array(
+            [[l.ztop, l.zbot, l.mtop.vp, l.mbot.vp, l.mtop.vs]
+             for l in earthmod.layers()])
+
+    def test_reproducible(self):
+        models = heart.ensemble_earthmodel(
+            self.ref_model, num_vary=10, seed=42)
+        models_prefix = heart.ensemble_earthmodel(
+            self.ref_model, num_vary=3, seed=42)
+
+        for a, b in zip(models, models_prefix):
+            assert_allclose(
+                self._layer_arrays(a), self._layer_arrays(b), rtol=0.)
+
+    def test_only_last(self):
+        models = heart.ensemble_earthmodel(
+            self.ref_model, num_vary=5, seed=42)
+        last = heart.ensemble_earthmodel(
+            self.ref_model, num_vary=5, seed=42, only_last=True)
+
+        self.assertEqual(len(last), 1)
+        assert_allclose(
+            self._layer_arrays(models[-1]), self._layer_arrays(last[0]),
+            rtol=0.)
+
+    def test_constraints(self):
+        models = heart.ensemble_earthmodel(
+            self.ref_model, num_vary=50, error_velocities=0.2,
+            depth_limit_variation=600 * km, seed=1)
+
+        for earthmod in models:
+            layers = self._layer_arrays(earthmod)
+
+            # contiguous layers with positive thickness
+            assert_allclose(layers[1:, 0], layers[:-1, 1], rtol=0.)
+            assert (layers[:, 1] >= layers[:, 0]).all()
+
+            # increasing velocity with depth
+            assert (layers[1:, 2] >= layers[:-1, 3]).all()
+
+
+class _Stub(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class TestMarginalLikelihood(unittest.TestCase):
+
+    def _composite(self, typs, n_obs=(8, 5), n_patches=3):
+        composite = models.GeodeticDistributerComposite.__new__(
+            models.GeodeticDistributerComposite)
+        composite.config = _Stub(
+            fit_plane=False, gf_config=_Stub(reference_model_idx=0))
+        composite.lowrank_weights = None
+        composite._like_name = 'geo_like'
+
+        self.gfs = [num.random.randn(n, n_patches) for n in n_obs]
+        composite.gfs = {0: {'uparr': self.gfs}}
+        composite.weights = [shared(num.eye(n)) for n in n_obs]
+        composite.datasets = [
+            _Stub(typ=typ, samples=n, odw=num.ones(n),
+                  displacement=num.random.randn(n),
+                  covariance=heart.Covariance(data=num.eye(n)))
+            for typ, n in zip(typs, n_obs)]
+
+        self.lower = -num.ones(n_patches)
+        self.upper = num.ones(n_patches) * 2.
+        composite.set_marginal_priors([heart.Parameter(
+            name='uparr', lower=self.lower, upper=self.upper,
+            testvalue=num.zeros(n_patches))])
+        return composite
+
+    def _dense_marginal(self, composite, hps):
+        # slip prior approximated by a Gaussian of same mean and variance
+        mu = (self.upper + self.lower) / 2.
+        sigma2 = (self.upper - self.lower) ** 2 / 12.
+
+        G = num.vstack(self.gfs)
+        d = num.hstack([data.displacement for data in composite.datasets])
+        noise = num.hstack([
+            num.ones(data.samples) * num.exp(2. * hps[data.typ])
+            for data in composite.datasets])
+
+        C = num.diag(noise) + (G * sigma2).dot(G.T)
+        r = d - G.dot(mu)
+        return -0.5 * (
+            d.size * num.log(2 * num.pi) + num.linalg.slogdet(C)[1] +
+            r.dot(num.linalg.solve(C, r)))
+
+    def _check(self, typs):
+        composite = self._composite(typs)
+        hp_vars = dict(
+            ('h_%s' % typ, tt.dscalar('h_%s' % typ)) for typ in set(typs))
+
+        with pm.Model():
+            llk = composite.get_marginal_formula(hp_vars)
+
+        names = sorted(hp_vars.keys())
+        f = function([hp_vars[name] for name in names], llk)
+
+        for hps in ({'SAR': -0.5, 'GPS': 0.3}, {'SAR': 0.2, 'GPS': 0.2}):
+            assert_allclose(
+                f(*[hps[name[2:]] for name in names]),
+                self._dense_marginal(composite, hps), rtol=1e-5)
+
+    def test_common_hyperparameter(self):
+        self._check(['SAR', 'SAR'])
+
+    def test_individual_hyperparameters(self):
+        self._check(['SAR', 'GPS'])
+
+
+class _StubEngine(object):
+    """
+    Static responses with fixed displacements (north, east, up) for every
+    source-target pair.
+    """
+
+    def __init__(self, displacements):
+        self.displacements = displacements
+
+    def process(self, sources, targets):
+        n, e, u = self.displacements.T
+        results = [
+            _Stub(result={
+                'displacement.n': n, 'displacement.e': e,
+                'displacement.d': -u})
+            for source in sources for target in targets]
+        return _Stub(static_results=lambda: results)
+
+
+class TestGeoGeometryResults(unittest.TestCase):
+
+    def setUp(self):
+        n_obs = (6, 4, 9)
+        self.composite = composite = models.GeodeticGeometryComposite.__new__(
+            models.GeodeticGeometryComposite)
+
+        composite.datasets = []
+        for n in n_obs:
+            cov = num.random.rand(n, n) * 0.1
+            composite.datasets.append(_Stub(
+                displacement=num.random.randn(n),
+                los_vector=num.random.randn(n, 3),
+                covariance=heart.Covariance(
+                    data=cov.dot(cov.T) + num.eye(n))))
+
+        disp_list = [data.displacement for data in composite.datasets]
+        composite.Bij = utility.ListToArrayBijection(
+            utility.ListArrayOrdering(disp_list, intype='numpy'), disp_list)
+
+        self.displacements = num.random.randn(sum(n_obs), 3)
+        composite.engine = _StubEngine(self.displacements)
+        composite.sources = [None]
+        composite.targets = [_Stub(lons=num.zeros(sum(n_obs)))]
+        composite._llks = [shared(num.array([1.])) for n in n_obs]
+        composite.point2sources = lambda point: None
+
+    def _reference_synthetics(self):
+        synths = []
+        i = 0
+        for data in self.composite.datasets:
+            n = data.displacement.size
+            synths.append(
+                (self.displacements[i:i + n] * data.los_vector).sum(axis=1))
+            i += n
+
+        return synths
+
+    def test_assemble_results(self):
+        results = self.composite.assemble_results({})
+
+        self.assertEqual(len(results), len(self.composite.datasets))
+        for result, data, synth in zip(
+                results, self.composite.datasets,
+                self._reference_synthetics()):
+            assert_allclose(result.processed_syn, synth, rtol=1e-10)
+            assert_allclose(
+                result.processed_res, data.displacement - synth, rtol=1e-10)
+
+    def test_update_llks(self):
+        self.composite.update_llks({})
+
+        for llk, data, synth in zip(
+                self.composite._llks, self.composite.datasets,
+                self._reference_synthetics()):
+            res = data.displacement - synth
+            assert_allclose(
+                llk.get_value(),
+                [res.dot(num.linalg.solve(data.covariance.data, res))],
+                rtol=1e-6)
+
+
+class TestProjectData(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='beat_test_data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_seismic_roundtrip(self):
+        stations = [model.Station(network='XX', station='S%i' % i,
+                                  lat=float(i), lon=0.) for i in range(3)]
+        data_traces = []
+        for i, station in enumerate(stations):
+            tr = heart.SeismicDataset(
+                network=station.network, station=station.station,
+                channel='Z', tmin=10. * i, deltat=0.5,
+                ydata=num.random.randn(10 + i))
+            tr.set_wavename('any_P')
+            tr.covariance = heart.Covariance(data=num.eye(10 + i))
+            data_traces.append(tr)
+
+        datadir = os.path.join(self.tmpdir, 'seismic_data')
+        heart.dump_seismic_data(datadir, stations, data_traces)
+        lstations, ltraces = heart.load_seismic_data(datadir)
+
+        self.assertEqual(
+            [s.station for s in lstations], [s.station for s in stations])
+        for tr, ltr in zip(data_traces, ltraces):
+            self.assertEqual(tr.nslc_id, ltr.nslc_id)
+            self.assertEqual(tr.tmin, ltr.tmin)
+            self.assertEqual(tr.wavename, ltr.wavename)
+            assert_allclose(tr.ydata, ltr.ydata, rtol=0.)
+            assert_allclose(tr.covariance.data, ltr.covariance.data, rtol=0.)
+
+    def test_geodetic_roundtrip(self):
+        n = 20
+        quadtree = heart.Quadtree(
+            lats=num.random.rand(n), lons=num.random.rand(n),
+            sizeE=num.ones(n), sizeN=num.ones(n))
+        data = heart.DiffIFG(
+            name='track', lats=num.random.rand(n), lons=num.random.rand(n),
+            displacement=num.random.randn(n),
+            incidence=num.ones(n) * 30., heading=num.ones(n) * 190.,
+            odw=num.ones(n), quadtree=quadtree,
+            covariance=heart.Covariance(data=num.eye(n)))
+
+        datadir = os.path.join(self.tmpdir, 'geodetic_data')
+        heart.dump_geodetic_data(datadir, [data])
+        ldata, = heart.load_geodetic_data(datadir)
+
+        self.assertEqual(ldata.name, data.name)
+        for name in ('lats', 'lons', 'displacement', 'incidence', 'odw'):
+            assert_allclose(
+                getattr(ldata, name), getattr(data, name), rtol=0.)
+
+        assert_allclose(ldata.quadtree.sizeE, quadtree.sizeE, rtol=0.)
+        assert_allclose(ldata.covariance.data, data.covariance.data, rtol=0.)
+
+        # arrays of the original dataset are untouched
+        assert data.covariance is not None
+        assert data.lats is not None
+
+
+class TestGPSDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = mkdtemp(prefix='beat_test_gps')
+        self.n = 10
+        with open(os.path.join(self.tmpdir, 'gps.txt'), 'w') as f:
+            f.write('# name lon lat ve vn vu sigma_ve sigma_vn sigma_vu\n')
+            for i in range(self.n):
+                f.write('ST%02i %f %f 1. 2. 3. 0.1 0.2 0.3\n' % (i, i, -i))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_load_and_blacklist(self):
+        compounds = inputf.load_and_blacklist_GPS(
+            self.tmpdir, 'gps.txt', ['ST01', 'ST05'])
+
+        self.assertEqual(
+            set(c.name for c in compounds), set(heart.gps_components))
+        for c in compounds:
+            j = heart.gps_components.index(c.name)
+            self.assertEqual(len(c.station_names), self.n - 2)
+            assert 'ST01' not in c.station_names
+            assert_allclose(c.displacement, (j + 1) / km)
+            assert_allclose(
+                num.diag(c.covariance.data), ((j + 1) * 0.1 / km) ** 2)
+            assert_allclose(c.odw, 1.)
+
+    def test_stations(self):
+        gps_ds = inputf.load_ascii_gps(self.tmpdir, 'gps.txt')
+        station = gps_ds.get_station('ST03')
+
+        self.assertEqual(station.lon, 3.)
+        self.assertEqual(station.get_component('N').v, 2. / km)
+
+        self.assertRaises(Exception, gps_ds.add_station, station)
+        gps_ds.remove_stations(['ST03'])
+        gps_ds.add_station(station)
+        self.assertEqual(gps_ds.get_station_names()[-1], 'ST03')
+
 
 if __name__ == "__main__":
     util.setup_logging('test_heart', 'warning')
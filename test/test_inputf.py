@@ -0,0 +1,196 @@
+import numpy as num
+from beat import heart, inputf
+from pyrocko import io, model, trace
+from tempfile import mkdtemp
+import shutil
+import os
+import logging
+import unittest
+
+
+class TestLoadDataTraces(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = mkdtemp(prefix='beat_test_inputf') + '/'
+        self.stations = [
+            model.Station(network='XX', station='S%i' % i, lat=i, lon=i)
+            for i in range(4)]
+
+        for station in self.stations:
+            self._save_trace(station, deltat=0.5)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def _save_trace(self, station, deltat):
+        nsamples = int(round(200. / deltat))
+        tr = trace.Trace(
+            network=station.network, station=station.station,
+            channel='u', deltat=deltat, tmin=0.,
+            ydata=num.sin(num.arange(nsamples) * deltat * 0.2 * num.pi))
+
+        io.save(tr, os.path.join(
+            self.datadir, 'reference-%s-%s-u.mseed' % (
+                station.network, station.station)))
+
+    def _load(self, **kwargs):
+        return inputf.load_data_traces(
+            datadir=self.datadir, stations=self.stations, channels=['Z'],
+            **kwargs)
+
+    def test_threaded(self):
+        serial = self._load(nworkers=1)
+        threaded = self._load(nworkers=3)
+
+        self.assertEqual(len(serial), len(self.stations))
+        self.assertEqual(
+            [tr.station for tr in serial], [tr.station for tr in threaded])
+        for a, b in zip(serial, threaded):
+            num.testing.assert_array_equal(a.ydata, b.ydata)
+
+    def test_missing_file(self):
+        os.remove(os.path.join(self.datadir, 'reference-XX-S1-u.mseed'))
+        data_traces = self._load(nworkers=2)
+        self.assertEqual(
+            [tr.station for tr in data_traces], ['S0', 'S2', 'S3'])
+
+    def test_corrupt_file(self):
+        with open(os.path.join(
+                self.datadir, 'reference-XX-S2-u.mseed'), 'w') as f:
+            f.write('no miniseed')
+
+        data_traces = self._load(nworkers=2)
+        self.assertEqual(
+            [tr.station for tr in data_traces], ['S0', 'S1', 'S3'])
+
+    def test_downsample(self):
+        original = self._load()
+        data_traces = self._load(deltat=1., nworkers=2)
+
+        for a, b in zip(original, data_traces):
+            self.assertEqual(b.deltat, 1.)
+            self.assertAlmostEqual(b.tmin, a.tmin)
+            self.assertTrue(b.ydata.size < a.ydata.size)
+
+    def test_coarse_sampling(self):
+        self._save_trace(self.stations[2], deltat=2.)
+        self.assertRaises(ValueError, self._load, deltat=1.)
+
+
+class _StubQuadtree(object):
+    """
+    Number of leaves inversely proportional to the variance threshold.
+    """
+
+    def __init__(self, epsilon=1., scale=1e4):
+        self.epsilon = epsilon
+        self.scale = scale
+
+    @property
+    def nleaves(self):
+        return int(self.scale / self.epsilon)
+
+
+class _RecordingHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestKiteScenes(unittest.TestCase):
+
+    def setUp(self):
+        self.datadir = mkdtemp(prefix='beat_test_kite')
+        self.cache_dir = os.path.join(self.datadir, 'kite_cache')
+        os.mkdir(self.cache_dir)
+
+        self.basepath = os.path.join(self.datadir, 'track')
+        for ext, content in (('.yml', 'quadtree: {epsilon: 1.}\n'),
+                             ('.npz', 'displacement')):
+            with open(self.basepath + ext, 'w') as f:
+                f.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.datadir)
+
+    def test_retile_quadtree(self):
+        quadtree = _StubQuadtree()
+        inputf.retile_kite_quadtree(quadtree, 300)
+
+        self.assertTrue(quadtree.nleaves <= 300)
+        # epsilon is the smallest one satisfying the leaf count
+        self.assertTrue(
+            _StubQuadtree(quadtree.epsilon / 1.01).nleaves > 300)
+
+        # fine enough already
+        quadtree = _StubQuadtree()
+        inputf.retile_kite_quadtree(quadtree, 20000)
+        self.assertEqual(quadtree.epsilon, 1.)
+
+    def test_retile_impossible(self):
+        class ConstantQuadtree(_StubQuadtree):
+            nleaves = 1000
+
+        self.assertRaises(
+            ValueError, inputf.retile_kite_quadtree, ConstantQuadtree(), 300)
+
+    def test_cache_key(self):
+        key = inputf.get_kite_cache_key(self.basepath)
+        self.assertEqual(key, inputf.get_kite_cache_key(self.basepath))
+        self.assertNotEqual(
+            key, inputf.get_kite_cache_key(self.basepath, n_leaves_max=100))
+
+        with open(self.basepath + '.yml', 'a') as f:
+            f.write('covariance: {}\n')
+
+        self.assertNotEqual(key, inputf.get_kite_cache_key(self.basepath))
+
+    def test_cache_hit(self):
+        n = 10
+        data = heart.DiffIFG(
+            name='track', lats=num.random.rand(n), lons=num.random.rand(n),
+            displacement=num.random.randn(n),
+            incidence=num.ones(n) * 30., heading=num.ones(n) * 190.,
+            odw=num.ones(n),
+            covariance=heart.Covariance(data=num.eye(n)))
+
+        heart.dump_geodetic_data(
+            os.path.join(
+                self.cache_dir,
+                inputf.get_kite_cache_key(self.basepath, n_leaves_max=50)),
+            [data])
+
+        # the file extension is stripped, kite is not needed for a hit
+        for name in ('track', 'track.yml'):
+            cached = inputf.load_kite_scene(
+                self.datadir, name, cache_dir=self.cache_dir,
+                n_leaves_max=50)
+
+            self.assertEqual(cached.name, data.name)
+            num.testing.assert_array_equal(
+                cached.displacement, data.displacement)
+
+    def test_missing_scene(self):
+        self.assertRaises(
+            IOError, inputf.load_kite_scene, self.datadir, 'missing',
+            cache_dir=self.cache_dir)
+
+        handler = _RecordingHandler()
+        logger = logging.getLogger('inputf')
+        logger.addHandler(handler)
+        try:
+            self.assertIsNone(inputf._load_kite_scene(
+                (self.datadir, 'missing', self.cache_dir, None)))
+        finally:
+            logger.removeHandler(handler)
+
+        self.assertEqual(len(handler.messages), 1)
+        self.assertTrue('does not exist' in handler.messages[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
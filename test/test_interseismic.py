@@ -98,6 +98,25 @@ class TestInterseismic(unittest.TestCase):
             num.testing.assert_allclose(
                 d['rake'], test_rake[i], rtol=0., atol=1e-6)
 
+    def test_backslip_coefficients(self):
+        strike = 20.
+        dip = 70.
+        amplitude = 0.1
+        sdip = num.sin(dip * num.pi / 180.)
+
+        for azimuth in [10., 80., 150., 200.]:
+            d = interseismic.backslip_params(
+                azimuth, strike, dip, amplitude, 5.)
+            slip, opening = interseismic.backslip_coefficients(d)
+
+            # unit responses are for rake 0
+            num.testing.assert_allclose(
+                slip, d['slip'] * num.cos(d['rake'] * num.pi / 180.),
+                rtol=0., atol=1e-12)
+            num.testing.assert_allclose(
+                slip ** 2 + (opening / sdip) ** 2, amplitude ** 2,
+                rtol=1e-10, atol=0.)
+
     def test_block_geometry(self):
 
         if self.reference is None:
@@ -106,6 +125,28 @@ class TestInterseismic(unittest.TestCase):
         return interseismic.block_geometry(lons=self.lons, lats=self.lats,
             sources=self._get_sources(), reference=self.reference)
 
+    def test_block_mask_cache(self):
+
+        if self.reference is None:
+            self._get_synthetic_data()
+
+        sources = self._get_sources()
+        mask = self.test_block_geometry()
+        self.assertIs(mask, interseismic.block_geometry(
+            lons=self.lons, lats=self.lats,
+            sources=sources, reference=self.reference))
+
+        sources[0].strike += 10.
+        changed = interseismic.block_geometry(
+            lons=self.lons, lats=self.lats,
+            sources=sources, reference=self.reference)
+        self.assertIsNot(mask, changed)
+
+        lons = self.lons.copy()
+        self.assertIsNot(mask, interseismic.block_geometry(
+            lons=lons, lats=self.lats,
+            sources=self._get_sources(), reference=self.reference))
+
     def test_block_synthetics(self):
 
         if self.reference is None:
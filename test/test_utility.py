@@ -2,6 +2,7 @@ import numpy as num
 from beat import utility
 from tempfile import mkdtemp
 import shutil
+import os
 import unittest
 from pyrocko import util
 
@@ -24,6 +25,143 @@ class TestUtility(unittest.TestCase):
         num.testing.assert_allclose(self.Rx(90).dot(B), C, rtol=0., atol=1e-6)
         num.testing.assert_allclose(self.Ry(90).dot(C), A, rtol=0., atol=1e-6)
 
+    def test_points_in_polygon(self):
+        # concave polygon
+        vertices = num.array(
+            [[0., 0.], [4., 0.], [4., 4.], [2., 1.], [0., 4.]])
+
+        points = num.array(
+            [[1., 1.], [3., 1.], [2., 0.5], [2., 2.], [5., 1.], [-1., 2.],
+             [0.3, 3.], [3.7, 3.], [1., 3.], [3., 3.], [2., 4.5]])
+        inside = [
+            True, True, True, False, False, False, True, True, False, False,
+            False]
+
+        num.testing.assert_array_equal(
+            utility.points_in_polygon(points, vertices), inside)
+
+    def test_r3map(self):
+        arrays = [num.random.rand(n, 3) for n in [5, 1, 12]]
+        ordering = utility.ListArrayOrdering(
+            [a[:, 0] for a in arrays], intype='numpy')
+        bij = utility.ListToArrayBijection(ordering, arrays)
+
+        for a, b in zip(arrays, bij.r3map(bij.f3map(arrays))):
+            num.testing.assert_array_equal(a, b)
+
+    def test_memmap_references(self):
+        tmpdir = mkdtemp(prefix='beat_test_memmap')
+        fn = os.path.join(tmpdir, 'array.npy')
+        data = num.random.randn(200, 30)
+        num.save(fn, data)
+
+        readonly = num.load(fn, mmap_mode='r')
+        copied = num.load(fn, mmap_mode='c')
+        modified = num.load(fn, mmap_mode='c')
+        modified[0, 0] = 1e3
+
+        outpath = os.path.join(tmpdir, 'objects.pkl')
+        utility.dump_objects(
+            outpath, [readonly, copied, modified, readonly[10:20]],
+            memmap_references=True)
+        self.assertTrue(os.path.getsize(outpath) < 1.5 * data.nbytes)
+
+        lreadonly, lcopied, lmodified, lview = utility.load_objects(outpath)
+        self.assertEqual(lreadonly.mode, 'r')
+        self.assertEqual(lcopied.mode, 'c')
+        for arr in (lreadonly, lcopied):
+            self.assertEqual(utility.get_memmap_reference(arr).filename, fn)
+        num.testing.assert_array_equal(lreadonly, data)
+        num.testing.assert_array_equal(lcopied, data)
+
+        # changes in memory and views are stored with their data
+        self.assertIsNone(utility.get_memmap_reference(lmodified))
+        self.assertEqual(lmodified[0, 0], 1e3)
+        num.testing.assert_array_equal(lview, data[10:20])
+
+        shutil.rmtree(tmpdir)
+
+    def test_load_ascii_table(self):
+        tmpdir = mkdtemp(prefix='beat_test_ascii')
+        fn = os.path.join(tmpdir, 'table.txt')
+
+        data = num.random.randn(20, 6)
+        num.savetxt(fn, data, fmt='%15.7E', header='X Y Z Ux Uy Uz')
+        num.testing.assert_array_equal(
+            utility.load_ascii_table(fn, skiprows=1),
+            num.loadtxt(fn, skiprows=1))
+
+        # single row stays 2d
+        num.savetxt(fn, data[0:1], header='X Y Z Ux Uy Uz')
+        self.assertEqual(utility.load_ascii_table(fn).shape, (1, 6))
+
+        # unparseable token at the start of a row must not truncate
+        with open(fn, 'w') as f:
+            f.write('X Y Z Ux Uy Uz\n')
+            for i, row in enumerate(data):
+                line = ' '.join('%15.7E' % v for v in row)
+                if i == 4:
+                    line = '***************' + line[15:]
+                f.write(line + '\n')
+
+        self.assertRaises(ValueError, utility.load_ascii_table, fn)
+
+        shutil.rmtree(tmpdir)
+
+    def test_scratch_dir(self):
+        tmp = mkdtemp(prefix='beat_test_scratch')
+        prefix = 'testrun-'
+
+        dirname = utility.get_scratch_dir(prefix, tmp)
+        other = utility.get_scratch_dir(prefix, tmp)
+        self.assertNotEqual(dirname, other)
+
+        open(os.path.join(dirname, 'input'), 'w').close()
+        utility.release_scratch_dir(dirname, prefix, tmp)
+        self.assertEqual(os.listdir(dirname), [])
+
+        # warm directory is re-used
+        self.assertEqual(utility.get_scratch_dir(prefix, tmp), dirname)
+
+        utility.release_scratch_dir(dirname, prefix, tmp)
+        utility.release_scratch_dir(other, prefix, tmp)
+        shutil.rmtree(tmp)
+
+    def test_scratch_root(self):
+        environ = os.environ.get('BEAT_SCRATCH_ROOT', None)
+        try:
+            os.environ['BEAT_SCRATCH_ROOT'] = '/scratch'
+            self.assertEqual(utility.default_scratch_root(), '/scratch')
+
+            os.environ['BEAT_SCRATCH_ROOT'] = ''
+            self.assertIsNone(utility.default_scratch_root())
+        finally:
+            if environ is None:
+                del os.environ['BEAT_SCRATCH_ROOT']
+            else:
+                os.environ['BEAT_SCRATCH_ROOT'] = environ
+
+    def test_keep_scratch_dir(self):
+        tmpfs_root = utility._tmpfs_root
+        utility._tmpfs_root = mkdtemp(prefix='beat_test_tmpfs')
+        try:
+            dirname = utility.get_scratch_dir(
+                'testrun-', utility._tmpfs_root)
+            with open(os.path.join(dirname, 'input'), 'w') as f:
+                f.write('input')
+
+            kept = utility.keep_scratch_dir(dirname)
+            self.assertFalse(os.path.exists(dirname))
+            self.assertFalse(kept.startswith(utility._tmpfs_root))
+            with open(os.path.join(kept, 'input')) as f:
+                self.assertEqual(f.read(), 'input')
+
+            shutil.rmtree(kept)
+        finally:
+            shutil.rmtree(utility._tmpfs_root)
+            utility._tmpfs_root = tmpfs_root
+
+
 if __name__ == '__main__':
     util.setup_logging('test_utility', 'warning')
     unittest.main()